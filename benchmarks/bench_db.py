@@ -0,0 +1,110 @@
+# -*- coding: utf-8 -*-
+"""Benchmark the database writes of adding an experiment and recording an uploaded scan, with a commit per CRUDMixin
+call against one transaction per unit of work.
+
+Point it at Postgres to see what each commit costs over a real connection; it runs against a throwaway SQLite file by
+default.  The tables are created, and dropped afterwards, so use a scratch database.
+
+Usage: ::
+
+    python -m benchmarks.bench_db --database-url postgresql://localhost/mbam_bench --iterations 200
+"""
+import datetime as dt
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+import click
+from sqlalchemy import event
+
+from cookiecutter_mbam.app import create_app
+from cookiecutter_mbam.database import db_transaction
+from cookiecutter_mbam.experiment.models import Experiment
+from cookiecutter_mbam.extensions import db
+from cookiecutter_mbam.scan.service import ScanService
+from cookiecutter_mbam.user.models import User
+
+
+@contextmanager
+def nothing():
+    yield
+
+
+class Counter:
+    """Counts the statements and commits sent on an engine."""
+
+    def __init__(self, engine):
+        self.statements = self.commits = 0
+        event.listen(engine, 'before_cursor_execute', self._statement)
+        event.listen(engine, 'commit', self._commit)
+
+    def _statement(self, *args):
+        self.statements += 1
+
+    def _commit(self, *args):
+        self.commits += 1
+
+
+def add_experiment(user, unit_of_work):
+    with unit_of_work():
+        experiment = Experiment.create(date=dt.date(2019, 1, 1), scanner='GE', num_scans=0, user_id=user.id)
+        user.increment('num_experiments')
+    return experiment
+
+
+def record_scan(service, number, unit_of_work):
+    """The database writes ScanService.process makes once a scan is in XNAT"""
+    uri = '/data/archive/projects/P/subjects/000001/experiments/000001_MR1/scans/T1_{}'.format(number)
+    with unit_of_work():
+        scan = service._add_scan(sha256='{:064x}'.format(number))
+        service._update_database_objects(keywords=['subject', 'experiment', 'scan'],
+                                         objects=[service.user, service.experiment, scan],
+                                         ids=['000001', '000001_MR1', 'T1_{}'.format(number)],
+                                         uris=[uri.rsplit('/', 4)[0], uri.rsplit('/', 2)[0], uri])
+
+
+@click.command()
+@click.option('--database-url', default=None, help='The database to run against (default: a temporary SQLite file)')
+@click.option('--iterations', type=int, default=200, help='Experiments added, and scans recorded, by each strategy')
+def main(database_url, iterations):
+    """Compare a commit per CRUDMixin call with db_transaction."""
+    app = create_app('tests.settings')
+    path = None
+    if database_url is None:
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        database_url = 'sqlite:///' + path
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+    click.echo('{:>10}  {:>18}  {:>10}  {:>10}  {:>10}'.format('operation', 'strategy', 'statements', 'commits',
+                                                               'ms/op'))
+    with app.app_context():
+        db.create_all()
+        try:
+            user = User.create(username='bench', email='bench@example.com', num_experiments=0)
+            counter = Counter(db.engine)
+            for strategy, unit_of_work in (('commit per call', nothing), ('db_transaction', db_transaction)):
+                experiment = None
+                for operation in ('experiment', 'scan'):
+                    if operation == 'scan':
+                        service = ScanService(user.id, experiment.id)
+                    statements, commits = counter.statements, counter.commits
+                    start = time.perf_counter()
+                    for i in range(iterations):
+                        if operation == 'experiment':
+                            experiment = add_experiment(user, unit_of_work)
+                        else:
+                            record_scan(service, i, unit_of_work)
+                    seconds = time.perf_counter() - start
+                    click.echo('{:>10}  {:>18}  {:>10.1f}  {:>10.1f}  {:>10.2f}'.format(
+                        operation, strategy, (counter.statements - statements) / iterations,
+                        (counter.commits - commits) / iterations, seconds * 1000 / iterations))
+        finally:
+            db.session.remove()
+            db.drop_all()
+            if path:
+                os.remove(path)
+
+
+if __name__ == '__main__':
+    main()
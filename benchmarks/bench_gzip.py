@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+"""Benchmark single-threaded against parallel gzip of NIfTI-sized inputs.
+
+Usage: ::
+
+    python -m benchmarks.bench_gzip --size 100 --size 500 --size 1000 --workers 4
+"""
+import os
+import tempfile
+
+import click
+
+from cookiecutter_mbam.scan.utils import gzip_file
+
+MB = 1024 * 1024
+
+
+def write_volume(path, size_mb):
+    """Write a file with the texture of an int16 MR volume: a smooth high byte over a noisy low byte."""
+    low_bits = bytes(b & 0x3f for b in range(256))
+    high = bytes(i // 2048 % 8 for i in range(MB // 2))
+    with open(path, 'wb') as f:
+        for _ in range(size_mb):
+            voxels = bytearray(MB)
+            voxels[0::2] = os.urandom(MB // 2).translate(low_bits)
+            voxels[1::2] = high
+            f.write(voxels)
+
+
+@click.command()
+@click.option('--size', 'sizes', type=int, multiple=True, default=(100, 500, 1000), help='Input sizes in MB')
+@click.option('--workers', type=int, default=os.cpu_count(), help='Parallel compression workers')
+@click.option('--level', type=int, default=6, help='gzip compression level')
+def main(sizes, workers, level):
+    """Compare gzip_file on one worker with gzip_file on several."""
+    click.echo('{:>8}  {:>8}  {:>10}  {:>10}  {:>8}'.format('MB', 'workers', 'seconds', 'MB/s', 'ratio'))
+    for size_mb in sizes:
+        with tempfile.NamedTemporaryFile(suffix='.nii') as volume:
+            write_volume(volume.name, size_mb)
+            for n in (1, workers):
+                with open(volume.name, 'rb') as f:
+                    gzipped, stats = gzip_file(f, compresslevel=level, workers=n)
+                    gzipped.close()
+                click.echo('{:>8}  {:>8}  {:>10.2f}  {:>10.1f}  {:>8.3f}'.format(
+                    size_mb, n, stats.seconds, stats.throughput / MB, stats.ratio))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""Benchmark the hot lookups by foreign key and XNAT id on large tables, without the indexes that serve them and with.
+
+The same rows are seeded twice, once into tables without the indexes and once into tables with them, and each lookup
+is explained and timed against both.  Point it at Postgres to see the plans production gets; it runs against a
+throwaway SQLite file by default.  The tables are created, and dropped afterwards, so use a scratch database.
+
+Usage: ::
+
+    python -m benchmarks.bench_indexes --database-url postgresql://localhost/mbam_bench --users 20000
+"""
+import datetime as dt
+import os
+import random
+import tempfile
+import time
+
+import click
+from sqlalchemy import MetaData
+
+from cookiecutter_mbam.app import create_app
+from cookiecutter_mbam.experiment.models import Experiment
+from cookiecutter_mbam.extensions import db
+from cookiecutter_mbam.scan.models import Scan
+from cookiecutter_mbam.user.models import Role, User, roles_users
+
+#: The indexes, and the unique constraint, that serve the lookups below
+INDEXES = ('ix_experiments_user_id_date_id', 'ix_scan_experiment_id', 'ix_users_xnat_subject_id',
+           'ix_experiments_xnat_experiment_id', 'uq_roles_users_user_id_role_id', 'ix_roles_users_role_id')
+
+#: The lookups, each a function of a random user id, experiment id, and role id returning a query
+LOOKUPS = (
+    ('experiment page', lambda user, experiment, role: Experiment.page_for_user(user)),
+    ('scans of experiment', lambda user, experiment, role: Scan.query.filter(Scan.experiment_id == experiment)),
+    ('duplicate scan', lambda user, experiment, role: Scan.query.join(Experiment).filter(
+        Experiment.user_id == user, Scan.sha256 == '{:064x}'.format(experiment)).limit(1)),
+    ('subject by XNAT id', lambda user, experiment, role: User.query.filter(
+        User.xnat_subject_id == '{:06d}'.format(user))),
+    ('experiment by XNAT id', lambda user, experiment, role: Experiment.query.filter(
+        Experiment.xnat_experiment_id == 'MR{:06d}'.format(experiment))),
+    ('roles of user', lambda user, experiment, role: Role.query.join(roles_users).filter(
+        roles_users.c.user_id == user)),
+    ('users with role', lambda user, experiment, role: User.query.join(roles_users).filter(
+        roles_users.c.role_id == role).limit(20)),
+)
+
+BATCH = 5000
+
+
+def schema(indexed):
+    """A copy of the app's tables, with or without the indexes under test."""
+    metadata = MetaData()
+    for table in db.metadata.sorted_tables:
+        copy = table.tometadata(metadata)
+        if not indexed:
+            copy.indexes = {index for index in copy.indexes if index.name not in INDEXES}
+            copy.constraints = {constraint for constraint in copy.constraints if constraint.name not in INDEXES}
+    return metadata
+
+
+def insert(table, rows):
+    for start in range(0, len(rows), BATCH):
+        db.session.execute(table.insert(), rows[start:start + BATCH])
+
+
+def seed(users, experiments, scans, roles):
+    """Fill the tables with users, each with their experiments and scans, and a role or two."""
+    insert(Role.__table__, [{'id': i, 'name': 'role{}'.format(i)} for i in range(1, roles + 1)])
+    insert(User.__table__, [{'id': i, 'username': 'user{}'.format(i), 'email': 'user{}@example.com'.format(i),
+                             'created_at': dt.datetime(2019, 1, 1), 'xnat_subject_id': '{:06d}'.format(i),
+                             'num_experiments': experiments} for i in range(1, users + 1)])
+    insert(roles_users, [{'user_id': i, 'role_id': role} for i in range(1, users + 1)
+                         for role in {1 + i % roles, 1 + i * 7 % roles}])
+    insert(Experiment.__table__, [{'id': i, 'user_id': 1 + (i - 1) // experiments,
+                                   'date': dt.date(2019, 1, 1) + dt.timedelta(days=i % 365), 'scanner': 'GE',
+                                   'num_scans': scans, 'xnat_experiment_id': 'MR{:06d}'.format(i)}
+                                  for i in range(1, users * experiments + 1)])
+    insert(Scan.__table__, [{'id': i, 'experiment_id': 1 + (i - 1) // scans, 'sha256': '{:064x}'.format(i),
+                             'xnat_uri': '/data/archive/projects/P/scans/{}'.format(i)}
+                            for i in range(1, users * experiments * scans + 1)])
+    db.session.commit()
+
+
+def explain(query):
+    """The database's plan for a query, a line at a time."""
+    sql = str(query.statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+    if db.engine.dialect.name == 'sqlite':
+        return [row[-1] for row in db.session.execute('EXPLAIN QUERY PLAN ' + sql)]
+    return [row[0] for row in db.session.execute('EXPLAIN ' + sql)]
+
+
+@click.command()
+@click.option('--database-url', default=None, help='The database to run against (default: a temporary SQLite file)')
+@click.option('--users', type=int, default=5000, help='Users seeded')
+@click.option('--experiments', type=int, default=10, help='Experiments seeded for each user')
+@click.option('--scans', type=int, default=3, help='Scans seeded in each experiment')
+@click.option('--roles', type=int, default=5, help='Roles seeded')
+@click.option('--iterations', type=int, default=500, help='Times each lookup is run, on random keys')
+@click.option('--plans/--no-plans', default=True, help='Whether to print the plan of each lookup')
+def main(database_url, users, experiments, scans, roles, iterations, plans):
+    """Explain and time the hot lookups without the indexes that serve them and with."""
+    app = create_app('tests.settings')
+    path = None
+    if database_url is None:
+        fd, path = tempfile.mkstemp(suffix='.db')
+        os.close(fd)
+        database_url = 'sqlite:///' + path
+    app.config['SQLALCHEMY_DATABASE_URI'] = database_url
+    timings = {}
+    with app.app_context():
+        try:
+            for indexed in (False, True):
+                label = 'indexed' if indexed else 'unindexed'
+                metadata = schema(indexed)
+                metadata.create_all(db.engine)
+                try:
+                    start = time.perf_counter()
+                    seed(users, experiments, scans, roles)
+                    click.echo('{}: seeded {} users, {} experiments and {} scans in {:.1f} s'.format(
+                        label, users, users * experiments, users * experiments * scans, time.perf_counter() - start))
+                    db.session.execute('ANALYZE')
+                    db.session.commit()
+                    for name, lookup in LOOKUPS:
+                        if plans:
+                            click.echo('  {}:'.format(name))
+                            for line in explain(lookup(1, 1, 1)):
+                                click.echo('    {}'.format(line))
+                        keys = random.Random(0)
+                        start = time.perf_counter()
+                        for _ in range(iterations):
+                            lookup(keys.randint(1, users), keys.randint(1, users * experiments),
+                                   keys.randint(1, roles)).all()
+                        timings[name, indexed] = (time.perf_counter() - start) * 1000 / iterations
+                finally:
+                    db.session.remove()
+                    metadata.drop_all(db.engine)
+        finally:
+            if path:
+                os.remove(path)
+    click.echo('{:>22}  {:>12}  {:>12}'.format('lookup', 'unindexed ms', 'indexed ms'))
+    for name, _ in LOOKUPS:
+        click.echo('{:>22}  {:>12.3f}  {:>12.3f}'.format(name, timings[name, False], timings[name, True]))
+
+
+if __name__ == '__main__':
+    main()
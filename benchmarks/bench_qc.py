@@ -0,0 +1,66 @@
+# -*- coding: utf-8 -*-
+"""Benchmark QC metrics on realistic volume sizes, serially and on a process pool.
+
+Usage: ::
+
+    python -m benchmarks.bench_qc --workers 4
+"""
+import os
+import tempfile
+import time
+
+import click
+import numpy as np
+
+from cookiecutter_mbam.scan.qc import compute_qc_metrics, process_pool
+
+#: Typical volumes: a 1 mm T1, a 0.8 mm T1, and a high resolution 0.5 mm T2
+SHAPES = ((176, 256, 256), (208, 300, 320), (320, 448, 448))
+
+MB = 1024 * 1024
+
+
+def write_volume(path, shape):
+    """Write an int16 NIfTI-1 of a noisy ellipsoid with a faint ghost, one z-slice at a time."""
+    nx, ny, nz = shape
+    header = bytearray(352)
+    header[0:4] = (348).to_bytes(4, 'little')
+    header[40:56] = np.array([3, nx, ny, nz, 1, 1, 1, 1], '<i2').tobytes()
+    header[70:74] = np.array([4, 16], '<i2').tobytes()
+    header[76:108] = np.array([1, 1, 1, 1, 0, 0, 0, 0], '<f4').tobytes()
+    header[108:112] = np.array([352], '<f4').tobytes()
+    header[344:348] = b'n+1\0'
+    rng = np.random.RandomState(0)
+    x, y = np.ogrid[:nx, :ny]
+    with open(path, 'wb') as f:
+        f.write(header)
+        for z in range(nz):
+            radius = 1 - ((z - nz / 2) / (nz / 2.5)) ** 2
+            head = ((x - nx / 2) / (nx / 2.5)) ** 2 + ((y - ny / 2) / (ny / 2.5)) ** 2 < radius
+            plane = rng.normal(20, 5, (nx, ny))
+            plane[head] += 600
+            plane[np.roll(head, ny // 2, axis=1) & ~head] += 30
+            f.write(np.clip(plane, 0, None).astype('<i2').tobytes(order='F'))
+
+
+@click.command()
+@click.option('--workers', type=int, default=os.cpu_count(), help='Processes in the QC pool')
+@click.option('--slab-size', type=int, default=16, help='z-slices per task')
+def main(workers, slab_size):
+    """Compare compute_qc_metrics in one process with compute_qc_metrics on a pool."""
+    click.echo('{:>16}  {:>8}  {:>8}  {:>10}  {:>10}'.format('shape', 'MB', 'workers', 'seconds', 'MB/s'))
+    pool = process_pool(workers)
+    for shape in SHAPES:
+        with tempfile.NamedTemporaryFile(suffix='.nii') as volume:
+            write_volume(volume.name, shape)
+            size_mb = os.path.getsize(volume.name) / MB
+            for n, executor in ((1, None), (workers, pool)):
+                start = time.perf_counter()
+                compute_qc_metrics(volume.name, executor=executor, slab_size=slab_size)
+                seconds = time.perf_counter() - start
+                click.echo('{:>16}  {:>8.1f}  {:>8}  {:>10.2f}  {:>10.1f}'.format(
+                    'x'.join(map(str, shape)), size_mb, n, seconds, size_mb / seconds))
+
+
+if __name__ == '__main__':
+    main()
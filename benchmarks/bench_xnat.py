@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""Benchmark uploads to a fake XNAT over a slow link, one after another and concurrently.
+
+Usage: ::
+
+    python -m benchmarks.bench_xnat --uploads 20 --latency 0.05 --bandwidth 20
+"""
+import asyncio
+import time
+from functools import partial
+from io import BytesIO
+
+import click
+import xnat
+
+from cookiecutter_mbam.app import create_app
+from cookiecutter_mbam.xnat import XNATConnection, XNATUploadError
+from cookiecutter_mbam.xnat.aio import AsyncXNATConnection
+from cookiecutter_mbam.xnat.fake import FakeXNAT
+from cookiecutter_mbam.xnat.pool import XNATSessionPool
+
+MB = 1024 * 1024
+
+
+def xnat_ids(subject):
+    return {'subject': {'xnat_id': subject},
+            'experiment': {'xnat_id': subject + '_MR1', 'query_string': '?xnat:mrSessionData/date=06/01/2005'},
+            'scan': {'xnat_id': 'T1_1', 'query_string': '?xsiType=xnat:mrScanData'},
+            'resource': {'xnat_id': 'NIFTI'},
+            'file': {'xnat_id': 'T1.nii.gz', 'query_string': '?xsi:type=xnat:mrScanData'}}
+
+
+@click.command()
+@click.option('--uploads', type=int, default=20, help='Scans to upload, each for a new subject')
+@click.option('--size', type=float, default=1, help='MB in each scan')
+@click.option('--latency', type=float, default=0.05, help='Seconds every request is held')
+@click.option('--bandwidth', type=float, default=20, help='MB per second, per connection')
+@click.option('--error-rate', type=float, default=0.0, help='The probability a request fails')
+@click.option('--limit-per-host', type=int, default=8, help='Connections the async client opens')
+def main(uploads, size, latency, bandwidth, error_rate, limit_per_host):
+    """Compare XNATConnection.upload_scan in a loop with AsyncXNATConnection.upload_scans."""
+    app = create_app('tests.settings')
+    data = bytes(int(size * MB))
+    click.echo('{:>8}  {:>8}  {:>10}  {:>10}  {:>10}'.format('client', 'uploads', 'requests', 'seconds', 'uploads/s'))
+    with app.app_context(), FakeXNAT(projects=(app.config['XNAT'].project,), latency=latency,
+                                     bandwidth=bandwidth * MB, error_rate=error_rate) as server:
+        app.config['XNAT'] = app.config['XNAT']._replace(server=server.url, user='admin', password='admin')
+        XNATSessionPool(app, connect=partial(xnat.connect, no_parse_model=True))
+
+        def report(client, run, first):
+            requests = len(server.requests)
+            start = time.perf_counter()
+            run(['{:06d}'.format(first + i) for i in range(uploads)])
+            seconds = time.perf_counter() - start
+            click.echo('{:>8}  {:>8}  {:>10}  {:>10.2f}  {:>10.1f}'.format(
+                client, uploads, len(server.requests) - requests, seconds, uploads / seconds))
+
+        def sync(subjects):
+            xc = XNATConnection()
+            for subject in subjects:
+                try:
+                    xc.upload_scan(xnat_ids(subject), {}, BytesIO(data))
+                except XNATUploadError:
+                    pass
+
+        async def concurrent(subjects):
+            async with AsyncXNATConnection(limit_per_host=limit_per_host) as xc:
+                await xc.upload_scans([(xnat_ids(subject), {}, BytesIO(data), False) for subject in subjects])
+
+        report('sync', sync, 1)
+        report('async', lambda subjects: asyncio.run(concurrent(subjects)), uploads + 1)
+
+
+if __name__ == '__main__':
+    main()
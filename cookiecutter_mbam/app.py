@@ -2,12 +2,12 @@
 """The app module, containing the app factory function."""
 from flask import Flask, render_template
 
-from cookiecutter_mbam import commands, public, user, experiment, scan
+from cookiecutter_mbam import commands, public, user, experiment, scan, xnat
 from cookiecutter_mbam.user import User, Role
 from cookiecutter_mbam.admin import UserAdmin, RoleAdmin
 from flask_security import SQLAlchemyUserDatastore
 from cookiecutter_mbam.extensions import admin, bcrypt, cache, csrf_protect, db, debug_toolbar, login_manager, migrate,\
-    security, webpack
+    security, webpack, xnat_cache, xnat_pool, xnat_responses
 from .hooks import create_test_users
 
 def create_app(config_object='cookiecutter_mbam.settings'):
@@ -17,6 +17,7 @@ def create_app(config_object='cookiecutter_mbam.settings'):
     """
     app = Flask(__name__.split('.')[0])
     app.config.from_object(config_object)
+    xnat.config.init_app(app)
     register_extensions(app)
     register_blueprints(app)
     register_errorhandlers(app)
@@ -40,6 +41,9 @@ def register_extensions(app):
     migrate.init_app(app, db)
     webpack.init_app(app)
     admin.init_app(app, endpoint='admin')
+    xnat_cache.init_app(app)
+    xnat_pool.init_app(app)
+    xnat_responses.init_app(app)
     return None
 
 
@@ -82,6 +86,8 @@ def register_commands(app):
     app.cli.add_command(commands.lint)
     app.cli.add_command(commands.clean)
     app.cli.add_command(commands.urls)
+    app.cli.add_command(commands.scan_worker)
+    app.cli.add_command(commands.xnat_reconcile)
 
 def register_admin_views():
     """Register Flask admin views"""
@@ -124,3 +124,43 @@ def urls(url, order):
 
     for row in rows:
         click.echo(str_template.format(*row[:column_length]))
+
+
+@click.command('scan-worker')
+@click.option('-p', '--processes', default=2, help='Number of worker processes (default: 2)')
+@click.option('--poll-interval', default=2.0, help='Seconds to wait when the queue is empty (default: 2)')
+@click.option('--burst', default=False, is_flag=True, help='Exit once the queue is empty')
+@with_appcontext
+def scan_worker(processes, poll_interval, burst):
+    """Process queued scan uploads."""
+    from cookiecutter_mbam.scan.jobs import run_workers
+    run_workers(current_app._get_current_object(), processes=processes, poll_interval=poll_interval, burst=burst)
+
+
+@click.command('xnat-reconcile')
+@click.option('-b', '--backend', multiple=True, help='An XNAT backend to check (default: all of them)')
+@click.option('--repair', default=False, is_flag=True, help="Clear the records of objects XNAT doesn't hold")
+@click.option('-w', '--workers', default=None, type=int,
+              help="Experiments whose scans are listed at once (default: XNAT_POOL_SIZE)")
+@click.option('--batch-size', default=1000, help='Records read, and cleared, at a time (default: 1000)')
+@click.option('-v', '--verbose', default=False, is_flag=True, help='List every discrepancy')
+@with_appcontext
+def xnat_reconcile(backend, repair, workers, batch_size, verbose):
+    """Check the XNAT identifiers in the database against XNAT."""
+    from cookiecutter_mbam.xnat.config import backend_names
+    from cookiecutter_mbam.xnat.reconcile import reconcile
+    missing = False
+    for name in backend or backend_names():
+        report = reconcile(name, workers=workers, repair=repair, batch_size=batch_size)
+        for kind, result in report.items():
+            click.echo('{} {}: {} checked, {} missing from XNAT{}, {} not in the database, {} unchecked'.format(
+                name, kind, result.checked, len(result.missing), ' (cleared)' if repair and result.missing else '',
+                len(result.orphaned), result.unchecked))
+            if verbose:
+                for id, xnat_id in sorted(result.missing.items()):
+                    click.echo('  missing: {} {}'.format(id, xnat_id))
+                for xnat_id in result.orphaned:
+                    click.echo('  not in the database: {}'.format(xnat_id))
+            missing = missing or bool(result.missing)
+    if missing and not repair:
+        exit(1)
@@ -1,5 +1,12 @@
 # -*- coding: utf-8 -*-
 """Database module, including the SQLAlchemy database object and DB-related utilities."""
+import json
+from contextlib import contextmanager
+
+from sqlalchemy import func
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.types import Text, TypeDecorator
+
 from .compat import basestring
 from .extensions import db
 
@@ -8,9 +15,49 @@ Column = db.Column
 relationship = db.relationship
 Table = db.Table
 
+#: The key in the session's info of how many db_transaction blocks are open
+_TRANSACTION_DEPTH = 'transaction_depth'
+
+
+def in_transaction():
+    """Whether the current session is in a db_transaction block, so CRUDMixin's methods shouldn't commit."""
+    return db.session.info.get(_TRANSACTION_DEPTH, 0) > 0
+
+
+@contextmanager
+def db_transaction():
+    """A unit of work: CRUDMixin's methods don't commit inside the block, and its changes are committed at the end
+
+    The changes are flushed and committed together when the outermost block exits, or rolled back if it raises.  Blocks
+    nest, joining the outermost one.  Rows created in the block have no ids until they are flushed, so anything that
+    needs one should wait until the block has exited, or flush the session itself.
+
+    Usage: ::
+
+        with db_transaction():
+            scan = Scan.create(experiment_id=experiment.id)
+            experiment.increment('num_scans')
+    """
+    session = db.session()
+    depth = session.info.get(_TRANSACTION_DEPTH, 0)
+    session.info[_TRANSACTION_DEPTH] = depth + 1
+    try:
+        yield session
+        if not depth:
+            session.commit()
+    except Exception:
+        if not depth:
+            session.rollback()
+        raise
+    finally:
+        session.info[_TRANSACTION_DEPTH] = depth
+
 
 class CRUDMixin(object):
-    """Mixin that adds convenience methods for CRUD (create, read, update, delete) operations."""
+    """Mixin that adds convenience methods for CRUD (create, read, update, delete) operations.
+
+    Commits are deferred to the end of any db_transaction block the methods are called in.
+    """
 
     @classmethod
     def create(cls, **kwargs):
@@ -24,17 +71,45 @@ class CRUDMixin(object):
             setattr(self, attr, value)
         return commit and self.save() or self
 
+    def increment(self, column, by=1, commit=True):
+        """Add to a counter column of the record in the database, rather than in Python
+
+        The counter is read and written by one UPDATE, which the database serializes with any other writer of the row,
+        so concurrent increments aren't lost.  The new value is read back in the same statement with RETURNING where
+        the database supports it, and otherwise by a SELECT in the same transaction, which the UPDATE has already locked
+        the row for.  The record takes the new value without being marked as changed.
+
+        :param str column: the name of the counter column
+        :param int by: the amount to add, which may be negative
+        :param bool commit: whether to commit, outside of a db_transaction block
+        :return: the new value of the counter
+        :rtype: int
+        """
+        table = self.__table__
+        counter = table.c[column]
+        statement = table.update().where(table.c.id == self.id).values({column: func.coalesce(counter, 0) + by})
+        connection = db.session.connection()
+        if connection.dialect.implicit_returning:
+            value = connection.execute(statement.returning(counter)).scalar()
+        else:
+            connection.execute(statement)
+            value = connection.execute(db.select([counter]).where(table.c.id == self.id)).scalar()
+        set_committed_value(self, column, value)
+        if commit and not in_transaction():
+            db.session.commit()
+        return value
+
     def save(self, commit=True):
         """Save the record."""
         db.session.add(self)
-        if commit:
+        if commit and not in_transaction():
             db.session.commit()
         return self
 
     def delete(self, commit=True):
         """Remove the record from the database."""
         db.session.delete(self)
-        return commit and db.session.commit()
+        return commit and not in_transaction() and db.session.commit()
 
 
 class Model(CRUDMixin, db.Model):
@@ -76,3 +151,20 @@ def reference_col(tablename, nullable=False, pk_name='id', **kwargs):
         nullable=nullable, **kwargs)
 
 
+class JSONText(TypeDecorator):
+    """A JSON-serializable value stored as text, for databases without a native JSON type.
+
+    Usage: ::
+
+        metadata = Column(JSONText)
+    """
+
+    impl = Text
+
+    def process_bind_param(self, value, dialect):
+        """Serialize the value on the way into the database."""
+        return None if value is None else json.dumps(value, sort_keys=True)
+
+    def process_result_value(self, value, dialect):
+        """Deserialize the value on the way out of the database."""
+        return None if value is None else json.loads(value)
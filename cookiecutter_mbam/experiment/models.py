@@ -1,5 +1,7 @@
 # -*- coding: utf-8 -*-
 """Experiment model."""
+from sqlalchemy import and_, or_
+from sqlalchemy.orm import selectinload
 
 from cookiecutter_mbam.database import Column, Model, SurrogatePK, db, reference_col, relationship
 
@@ -12,10 +14,16 @@ class Experiment(SurrogatePK, Model):
     """A user's experiment, during which they are scanned."""
 
     __tablename__ = 'experiments'
+    __table_args__ = (
+        # Also serves lookups by user_id alone
+        db.Index('ix_experiments_user_id_date_id', 'user_id', 'date', 'id'),
+    )
     date = Column(db.Date(), nullable=False)
     scanner = Column(db.String(80), nullable=True)
     num_scans = Column(db.Integer(), nullable=True, default=0)
-    xnat_experiment_id = Column(db.String(80), nullable=True)
+    xnat_experiment_id = Column(db.String(80), nullable=True, index=True)
+    #: The label reserved for the experiment in XNAT, which it is created with by its first upload
+    xnat_label = Column(db.String(80), nullable=True)
     user = relationship('User', backref='experiments')
     user_id = reference_col('users', nullable=True)
 
@@ -23,6 +31,38 @@ class Experiment(SurrogatePK, Model):
         """Create instance."""
         db.Model.__init__(self, date=date, scanner=scanner, user_id=user_id, **kwargs)
 
+    @classmethod
+    def page_for_user(cls, user_id, before=None, limit=20):
+        """Query a page of a user's experiments, newest first, with their scans
+
+        Pages are found by keyset rather than offset: each starts after the (date, id) of the last experiment on the
+        previous one, and is read from the (user_id, date, id) index, so a page deep in a long listing costs no more
+        than the first.  The scans of the whole page are loaded in one further query.
+
+        :param int user_id: the user's id
+        :param tuple before: the date and id of the last experiment on the previous page, or None for the first page
+        :param int limit: the most experiments on the page
+        :return: a query for the page
+        :rtype: Query
+        """
+        query = cls.query.filter(cls.user_id == user_id)
+        if before is not None:
+            date, id = before
+            # The first condition is redundant, but lets the index be searched rather than scanned up to the page
+            query = query.filter(cls.date <= date, or_(cls.date < date, and_(cls.date == date, cls.id < id)))
+        return query.order_by(cls.date.desc(), cls.id.desc()).options(selectinload('scans')).limit(limit)
+
+    def to_dict(self):
+        """The experiment and its scans as a JSON-serializable dict."""
+        return {
+            'id': self.id,
+            'date': self.date.isoformat(),
+            'scanner': self.scanner,
+            'num_scans': self.num_scans,
+            'xnat_experiment_id': self.xnat_experiment_id,
+            'scans': [{'id': scan.id, 'xnat_uri': scan.xnat_uri} for scan in self.scans],
+        }
+
     def __repr__(self):
         """Represent instance as a unique string."""
         return '<Experiment({date})>'.format(date=self.date)
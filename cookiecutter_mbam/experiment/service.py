@@ -1,14 +1,50 @@
 # -*- coding: utf-8 -*-
 """Experiment service.
 """
+import datetime as dt
 
+from cookiecutter_mbam.database import db_transaction
+from cookiecutter_mbam.xnat.ids import experiment_labels
 from .models import Experiment
 
+
+class InvalidCursor(ValueError):
+    """A page cursor that wasn't made by ExperimentService.page."""
+
+
 class ExperimentService:
 
     def add(self, user, date, scanner, num_scans):
-        exp = Experiment.create(date=date, scanner=scanner, num_scans=num_scans, user_id=user.id)
-        user.update(num_experiments=user.num_experiments + 1)
+        with db_transaction():
+            # Before the increment, which the label's sequence starts after
+            exp = Experiment.create(date=date, scanner=scanner, num_scans=num_scans, user_id=user.id,
+                                    xnat_label=experiment_labels(user)[0])
+            user.increment('num_experiments')
         return exp
 
+    def page(self, user, cursor=None, per_page=20):
+        """A page of a user's experiments, newest first, with their scans loaded
+
+        :param User user: the user
+        :param str cursor: the cursor of the page, from the previous page, or None for the first page
+        :param int per_page: the most experiments on the page
+        :return: the experiments, and the cursor of the next page, or None if this is the last
+        :rtype: tuple
+        :raises InvalidCursor: if the cursor can't be read
+        """
+        before = self._decode_cursor(cursor) if cursor else None
+        experiments = Experiment.page_for_user(user.id, before=before, limit=per_page + 1).all()
+        if len(experiments) <= per_page:
+            return experiments, None
+        last = experiments[per_page - 1]
+        return experiments[:per_page], '{}.{}'.format(last.date.isoformat(), last.id)
+
+    @staticmethod
+    def _decode_cursor(cursor):
+        try:
+            date, id = cursor.split('.')
+            return dt.datetime.strptime(date, '%Y-%m-%d').date(), int(id)
+        except ValueError:
+            raise InvalidCursor('Invalid page cursor {!r}'.format(cursor))
+
         # todo: make sure deleting an experiment decrements this count
\ No newline at end of file
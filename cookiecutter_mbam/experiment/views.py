@@ -1,19 +1,44 @@
 # -*- coding: utf-8 -*-
 """Experiment views."""
-from flask import Blueprint, render_template, request, flash, redirect, url_for, session
+from flask import Blueprint, render_template, request, flash, redirect, url_for, session, abort, jsonify, current_app
 from flask_login import current_user
+from flask_security import login_required
 from .models import Experiment
 from .forms import ExperimentForm
-from .service import ExperimentService
+from .service import ExperimentService, InvalidCursor
 from cookiecutter_mbam.utils import flash_errors
 
 blueprint = Blueprint('experiment', __name__, url_prefix='/experiments', static_folder='../static')
 
+
 @blueprint.route('/')
+@login_required
 def experiments():
-    """List experiments."""
-    experiments = Experiment.query.all()
-    return render_template('experiments/experiments.html', experiments=experiments)
+    """List the user's experiments, a page at a time."""
+    experiments, cursor = _page()
+    next_url = url_for('experiment.experiments', cursor=cursor) if cursor else None
+    return render_template('experiments/experiments.html', experiments=experiments, next_url=next_url)
+
+
+@blueprint.route('/json')
+@login_required
+def experiments_json():
+    """List the user's experiments and their scans as JSON, a page at a time."""
+    experiments, cursor = _page()
+    next_url = url_for('experiment.experiments_json', cursor=cursor, per_page=request.args.get('per_page'))
+    return jsonify(experiments=[experiment.to_dict() for experiment in experiments],
+                   next=next_url if cursor else None)
+
+
+def _page():
+    """The page of the user's experiments the request asks for, and the cursor of the next page."""
+    max_per_page = current_app.config.get('EXPERIMENTS_PER_PAGE', 20)
+    per_page = min(request.args.get('per_page', max_per_page, type=int), max_per_page)
+    try:
+        return ExperimentService().page(current_user, cursor=request.args.get('cursor'), per_page=max(per_page, 1))
+    except InvalidCursor:
+        abort(400)
+
 
 @blueprint.route('/add', methods=['GET', 'POST'])
 def add():
@@ -21,15 +46,20 @@ def add():
     form = ExperimentForm(request.form)
     if form.validate_on_submit():
         exp = ExperimentService().add(date=form.date.data, scanner=form.scanner.data, num_scans=form.num_scans.data,
-                                user=current_user)
+                                      user=current_user)
         flash('You successfully created a new experiment.', 'success')
         session['curr_experiment'] = exp.id
         return redirect(url_for('experiment.single_experiment', id=exp.id))
     else:
         flash_errors(form)
-    return render_template('experiments/new_experiment.html',session_form=form)
+    return render_template('experiments/new_experiment.html', session_form=form)
+
 
 @blueprint.route('/<id>', methods=['GET'])
+@login_required
 def single_experiment(id):
-    """Display a single experiment"""
-    return render_template('experiments/experiment.html', id=id)
\ No newline at end of file
+    """Display a single experiment of the user's"""
+    experiment = Experiment.get_by_id(id)
+    if experiment is None or experiment.user_id != current_user.id:
+        abort(404)
+    return render_template('experiments/experiment.html', id=id, experiment=experiment)
@@ -11,6 +11,9 @@ from flask_webpack import Webpack
 from flask_wtf.csrf import CSRFProtect
 from flask_admin import Admin
 
+from cookiecutter_mbam.xnat.cache import XNATExistenceCache, XNATResponseCache
+from cookiecutter_mbam.xnat.pool import XNATSessionPool
+
 admin = Admin()
 bcrypt = Bcrypt()
 csrf_protect = CSRFProtect()
@@ -21,3 +24,6 @@ migrate = Migrate()
 cache = Cache()
 debug_toolbar = DebugToolbarExtension()
 webpack = Webpack()
+xnat_cache = XNATExistenceCache()
+xnat_responses = XNATResponseCache()
+xnat_pool = XNATSessionPool()
@@ -1,3 +1,7 @@
-from . import views
-from .models import Scan
-from . import service
\ No newline at end of file
+# -*- coding: utf-8 -*-
+"""The scan module."""
+from . import views  # noqa
+from .models import Scan, UploadJob
+from . import service  # noqa
+
+__all__ = ['Scan', 'UploadJob']
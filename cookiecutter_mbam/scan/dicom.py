@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+"""Inspection of zip archives of DICOM files.
+
+Reads the zip central directory and the first few kilobytes of each member, which is enough to parse the DICOM
+preamble and the identifying tags at the start of the data set.  Nothing is extracted to disk, and the pixel data is
+never decompressed, so an archive can be checked and indexed before it is sent to XNAT.
+"""
+import posixpath
+import struct
+import zipfile
+from collections import OrderedDict
+
+from .utils import UnsupportedScanFile
+
+#: The number of bytes of each member read when looking for its tags
+MEMBER_HEAD_SIZE = 16 * 1024
+
+IMPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2'
+EXPLICIT_VR_BIG_ENDIAN = '1.2.840.10008.1.2.2'
+DEFLATED_EXPLICIT_VR_LITTLE_ENDIAN = '1.2.840.10008.1.2.1.99'
+
+TRANSFER_SYNTAX_UID = (0x0002, 0x0010)
+SOP_INSTANCE_UID = (0x0008, 0x0018)
+MODALITY = (0x0008, 0x0060)
+STUDY_INSTANCE_UID = (0x0020, 0x000D)
+SERIES_INSTANCE_UID = (0x0020, 0x000E)
+SERIES_NUMBER = (0x0020, 0x0011)
+
+#: The tags read from each member, by the names used in the index
+TAGS = OrderedDict([
+    ('sop_instance_uid', SOP_INSTANCE_UID),
+    ('modality', MODALITY),
+    ('study_instance_uid', STUDY_INSTANCE_UID),
+    ('series_instance_uid', SERIES_INSTANCE_UID),
+    ('series_number', SERIES_NUMBER),
+])
+
+ITEM = (0xFFFE, 0xE000)
+ITEM_DELIMITATION = (0xFFFE, 0xE00D)
+SEQUENCE_DELIMITATION = (0xFFFE, 0xE0DD)
+UNDEFINED_LENGTH = 0xFFFFFFFF
+
+# VRs whose explicit encoding has two reserved bytes and a four byte length
+LONG_VRS = {b'OB', b'OD', b'OF', b'OL', b'OV', b'OW', b'SQ', b'SV', b'UC', b'UN', b'UR', b'UT', b'UV'}
+
+
+class _Truncated(Exception):
+    """The head of the member ended before the tags we want."""
+
+
+def _elements(buf, pos, explicit, endian):
+    """Yield (tag, value, next position) for each data element in buf from pos, stepping over nested data sets.
+
+    The value of a sequence or item is None.  Stops after yielding an item or sequence delimitation tag.
+    """
+    while pos < len(buf):
+        if pos + 8 > len(buf):
+            raise _Truncated()
+        group, element = struct.unpack_from(endian + 'HH', buf, pos)
+        tag = (group, element)
+        vr = None
+        if group == 0xFFFE or not (explicit or group == 0x0002):
+            # Items and delimitation tags are always implicit
+            length = struct.unpack_from(endian + 'I', buf, pos + 4)[0]
+            pos += 8
+        else:
+            vr = buf[pos + 4:pos + 6]
+            if vr in LONG_VRS:
+                if pos + 12 > len(buf):
+                    raise _Truncated()
+                length = struct.unpack_from(endian + 'I', buf, pos + 8)[0]
+                pos += 12
+            else:
+                length = struct.unpack_from(endian + 'H', buf, pos + 6)[0]
+                pos += 8
+        if tag in (ITEM_DELIMITATION, SEQUENCE_DELIMITATION):
+            yield tag, None, pos
+            return
+        if length == UNDEFINED_LENGTH:
+            # A sequence or item of undefined length runs until its delimitation tag
+            closing = ITEM_DELIMITATION if tag == ITEM else SEQUENCE_DELIMITATION
+            for inner_tag, _, pos in _elements(buf, pos, explicit, endian):
+                if inner_tag == closing:
+                    break
+            else:
+                raise _Truncated()
+            yield tag, None, pos
+        elif tag == ITEM or vr == b'SQ':
+            pos += length
+            yield tag, None, pos
+        else:
+            if pos + length > len(buf):
+                raise _Truncated()
+            pos += length
+            yield tag, buf[pos - length:pos], pos
+
+
+def read_dicom_tags(head):
+    """Parse the identifying tags from the head of a DICOM Part 10 file
+
+    :param bytes head: the first bytes of the file
+    :return: a dict of the TAGS found, keyed by name, or None if head does not start with a DICOM preamble
+    :rtype: dict
+    """
+    if head[128:132] != b'DICM':
+        return None
+    tags = {}
+    wanted = {tag: name for name, tag in TAGS.items()}
+    last_tag = max(wanted)
+    transfer_syntax = None
+    pos = 132
+    try:
+        # The file meta information group is always explicit VR little endian
+        for tag, value, next_pos in _elements(head, pos, True, '<'):
+            if tag[0] != 0x0002:
+                break
+            pos = next_pos
+            if tag == TRANSFER_SYNTAX_UID:
+                transfer_syntax = value.rstrip(b'\0 ').decode('ascii', 'replace')
+        if transfer_syntax == DEFLATED_EXPLICIT_VR_LITTLE_ENDIAN:
+            return tags
+        explicit = transfer_syntax != IMPLICIT_VR_LITTLE_ENDIAN
+        endian = '>' if transfer_syntax == EXPLICIT_VR_BIG_ENDIAN else '<'
+        for tag, value, _ in _elements(head, pos, explicit, endian):
+            if tag > last_tag:
+                break
+            if tag in wanted and value is not None:
+                tags[wanted[tag]] = value.rstrip(b'\0 ').decode('ascii', 'replace')
+    except (_Truncated, struct.error):
+        pass
+    return tags
+
+
+def inspect_dicom_zip(file, max_members=20000, max_uncompressed_size=16 * 1024 ** 3, max_ratio=200):
+    """Index the DICOM files in a zip archive without extracting it
+
+    Checks the central directory first, so archives with too many members, too much uncompressed data, a suspicious
+    compression ratio or paths that escape the archive are rejected before any member is read.  Then parses the tags at
+    the head of each member, and counts instances per series.
+
+    The index is a dict with the number of ``dicom_files`` and ``other_files``, the total ``uncompressed_size``, the
+    sorted list of ``modalities``, and a list of ``series``, each with its ``uid``, ``number``, ``modality`` and number
+    of ``instances``.
+
+    :param file file: a seekable binary file object holding the archive; its position is restored afterwards
+    :param int max_members: the most members an archive may have
+    :param int max_uncompressed_size: the most bytes an archive may expand to
+    :param int max_ratio: the largest uncompressed to compressed size ratio an archive may have
+    :return: the index
+    :rtype: dict
+    :raises UnsupportedScanFile: if the archive is unreadable, too large, or contains no DICOM files
+    """
+    position = file.tell()
+    try:
+        try:
+            archive = zipfile.ZipFile(file)
+        except (zipfile.BadZipFile, OSError):
+            raise UnsupportedScanFile('The zip file is damaged')
+        members = [info for info in archive.infolist() if not info.filename.endswith('/')]
+        _check_central_directory(members, max_members, max_uncompressed_size, max_ratio)
+        series = OrderedDict()
+        dicom_files = 0
+        for info in members:
+            try:
+                with archive.open(info) as member:
+                    tags = read_dicom_tags(member.read(MEMBER_HEAD_SIZE))
+            except (zipfile.BadZipFile, NotImplementedError, RuntimeError, OSError):
+                tags = None
+            if tags is None:
+                continue
+            dicom_files += 1
+            uid = tags.get('series_instance_uid', '')
+            entry = series.setdefault(uid, {'uid': uid, 'number': tags.get('series_number'),
+                                            'modality': tags.get('modality'), 'instances': set()})
+            entry['instances'].add(tags.get('sop_instance_uid') or info.filename)
+    finally:
+        file.seek(position)
+    if not dicom_files:
+        raise UnsupportedScanFile('The zip file contains no DICOM files')
+    for entry in series.values():
+        entry['instances'] = len(entry['instances'])
+    return {
+        'dicom_files': dicom_files,
+        'other_files': len(members) - dicom_files,
+        'uncompressed_size': sum(info.file_size for info in members),
+        'modalities': sorted({entry['modality'] for entry in series.values() if entry['modality']}),
+        'series': list(series.values()),
+    }
+
+
+def _check_central_directory(members, max_members, max_uncompressed_size, max_ratio):
+    """Reject an archive on the strength of its central directory alone."""
+    if len(members) > max_members:
+        raise UnsupportedScanFile('The zip file has more than {} files'.format(max_members))
+    uncompressed = sum(info.file_size for info in members)
+    compressed = sum(info.compress_size for info in members)
+    if uncompressed > max_uncompressed_size:
+        raise UnsupportedScanFile('The zip file expands to more than {} bytes'.format(max_uncompressed_size))
+    if compressed and uncompressed / compressed > max_ratio:
+        raise UnsupportedScanFile('The zip file is compressed suspiciously well')
+    for info in members:
+        name = info.filename.replace('\\', '/')
+        if name.startswith('/') or '..' in posixpath.normpath(name).split('/'):
+            raise UnsupportedScanFile('The zip file contains unsafe paths')
@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+"""Background processing of scan uploads.
+
+``ScanService.upload`` stages the uploaded file on disk and inserts an UploadJob row.  Worker processes started with
+``flask scan-worker`` poll the table, claim one job at a time and run ``ScanService.process`` on it.  Because both the
+file and the job live outside the web process, queued jobs survive restarts, and a job whose worker died mid-upload is
+picked up again when its lease expires.
+
+Claiming is a compare-and-swap UPDATE on (id, status, attempts), so any number of workers on any number of hosts can
+share the table without double-processing a job, on SQLite as well as Postgres.
+"""
+import datetime as dt
+import multiprocessing
+import os
+import time
+
+from flask import current_app
+from sqlalchemy import and_, or_
+from werkzeug.datastructures import FileStorage
+
+from cookiecutter_mbam.extensions import db
+from .models import UploadJob
+from .service import ScanService, UploadSessionService
+from .utils import UnsupportedScanFile
+
+#: Seconds between sweeps for abandoned resumable uploads
+EXPIRY_SWEEP_INTERVAL = 60
+
+
+def claim_job():
+    """Claim the next runnable job for this worker
+
+    A job is runnable if it is queued and its retry delay has passed, or if it is running but its lease has expired.
+
+    :return: the claimed job, or None if there is nothing to do
+    :rtype: UploadJob
+    """
+    now = dt.datetime.utcnow()
+    lease = dt.timedelta(seconds=current_app.config.get('SCAN_JOB_LEASE', 2 * 60 * 60))
+    candidates = UploadJob.query.filter(or_(
+        and_(UploadJob.status == UploadJob.QUEUED, UploadJob.run_after <= now),
+        and_(UploadJob.status == UploadJob.RUNNING, UploadJob.locked_until < now),
+    )).order_by(UploadJob.id).limit(10).all()
+    for job in candidates:
+        claimed = UploadJob.query.filter_by(id=job.id, status=job.status, attempts=job.attempts).update(
+            {'status': UploadJob.RUNNING, 'attempts': job.attempts + 1, 'locked_until': now + lease},
+            synchronize_session=False)
+        db.session.commit()
+        if claimed:
+            db.session.refresh(job)
+            return job
+    return None
+
+
+def run_job(job):
+    """Run a claimed job, and record its outcome
+
+    On success the staged file is removed and the job points at its new scan.  On failure the job is requeued with
+    exponential backoff until it has used up SCAN_JOB_MAX_ATTEMPTS, then marked failed.  Files that turn out not to be
+    scans fail straight away.
+
+    :param UploadJob job: a job claimed by this worker
+    :return: None
+    """
+    try:
+        with open(job.path, 'rb') as f:
+            service = ScanService(job.user_id, job.experiment_id)
+            scan = service.process(FileStorage(f, filename=job.filename), dicom_index=job.dicom_index,
+                                   progress=_log_progress(job))
+    except Exception as e:
+        current_app.logger.exception('Upload job {} failed on attempt {}'.format(job.id, job.attempts))
+        db.session.rollback()
+        retry = not isinstance(e, UnsupportedScanFile)
+        if retry and job.attempts < current_app.config.get('SCAN_JOB_MAX_ATTEMPTS', 5):
+            delay = current_app.config.get('SCAN_JOB_RETRY_DELAY', 30) * 2 ** (job.attempts - 1)
+            job.update(status=UploadJob.QUEUED, error=repr(e),
+                       run_after=dt.datetime.utcnow() + dt.timedelta(seconds=delay))
+        else:
+            job.update(status=UploadJob.FAILED, error=repr(e), finished_at=dt.datetime.utcnow())
+            _remove_staged_file(job)
+    else:
+        job.update(status=UploadJob.DONE, scan_id=scan.id, error=None, finished_at=dt.datetime.utcnow())
+        _remove_staged_file(job)
+
+
+def _log_progress(job):
+    """A progress callback that logs each tenth of a job's file as it is sent to XNAT"""
+    logged = [0]
+
+    def progress(sent, total):
+        tenths = sent * 10 // total if total else 10
+        if tenths > logged[0]:
+            logged[0] = tenths
+            current_app.logger.info('Upload job {}: sent {} of {} bytes to XNAT'.format(job.id, sent, total))
+    return progress
+
+
+def _remove_staged_file(job):
+    try:
+        os.remove(job.path)
+    except OSError:
+        pass
+
+
+def work(poll_interval=2.0, burst=False):
+    """Claim and run jobs until interrupted
+
+    Idle workers also clear out abandoned resumable uploads.
+
+    :param float poll_interval: seconds to sleep when the queue is empty
+    :param bool burst: return as soon as the queue is empty instead of polling
+    :return: None
+    """
+    last_sweep = 0
+    while True:
+        if time.monotonic() - last_sweep > EXPIRY_SWEEP_INTERVAL:
+            UploadSessionService.expire_sessions()
+            last_sweep = time.monotonic()
+        job = claim_job()
+        if job:
+            run_job(job)
+        elif burst:
+            return
+        else:
+            time.sleep(poll_interval)
+        db.session.remove()
+
+
+def _work_in_child(app, poll_interval, burst):
+    with app.app_context():
+        # Connections inherited through fork must not be shared with the parent
+        db.engine.dispose()
+        work(poll_interval=poll_interval, burst=burst)
+
+
+def run_workers(app, processes=2, poll_interval=2.0, burst=False):
+    """Start a pool of worker processes and wait for them
+
+    :param Flask app: the application the workers run in
+    :param int processes: the number of worker processes
+    :param float poll_interval: seconds each worker sleeps when the queue is empty
+    :param bool burst: have the workers exit when the queue is empty
+    :return: None
+    """
+    workers = [multiprocessing.Process(target=_work_in_child, args=(app, poll_interval, burst))
+               for _ in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
@@ -1,20 +1,173 @@
 # -*- coding: utf-8 -*-
 """Scan model."""
+import datetime as dt
+
+from cookiecutter_mbam.database import Column, JSONText, Model, SurrogatePK, db, reference_col, relationship
 
-from cookiecutter_mbam.database import Model, SurrogatePK, db, reference_col, relationship
 
 class Scan(SurrogatePK, Model):
     """A user's scan."""
 
     __tablename__ = 'scan'
+    __table_args__ = (
+        db.Index('ix_scan_dims', 'dim_x', 'dim_y', 'dim_z'),
+        db.Index('ix_scan_pixdims', 'pixdim_x', 'pixdim_y', 'pixdim_z'),
+    )
     xnat_uri = db.Column(db.String(255))
-    experiment_id = reference_col('experiments', nullable=True)
+    #: For zips of DICOM files, the series and instances they hold (see cookiecutter_mbam.scan.dicom)
+    dicom_index = Column(JSONText, nullable=True)
+    #: The SHA-256 of the file as it was uploaded, to recognize repeat uploads
+    sha256 = Column(db.String(64), nullable=True, index=True)
+    #: For NIfTI files, the acquisition geometry from the header (see cookiecutter_mbam.scan.nifti)
+    nifti_version = Column(db.SmallInteger(), nullable=True)
+    datatype = Column(db.SmallInteger(), nullable=True)
+    qform_code = Column(db.SmallInteger(), nullable=True)
+    sform_code = Column(db.SmallInteger(), nullable=True)
+    dim_x = Column(db.Integer(), nullable=True)
+    dim_y = Column(db.Integer(), nullable=True)
+    dim_z = Column(db.Integer(), nullable=True)
+    dim_t = Column(db.Integer(), nullable=True)
+    #: Voxel size in millimeters
+    pixdim_x = Column(db.Float(), nullable=True)
+    pixdim_y = Column(db.Float(), nullable=True)
+    pixdim_z = Column(db.Float(), nullable=True)
+    #: Repetition time in seconds
+    tr = Column(db.Float(), nullable=True, index=True)
+    #: For NIfTI files, automated quality control metrics (see cookiecutter_mbam.scan.qc)
+    qc_metrics = Column(JSONText, nullable=True)
+    experiment_id = reference_col('experiments', nullable=True, index=True)
     experiment = relationship('Experiment', backref='scans')
 
     def __init__(self, experiment_id, **kwargs):
         """Create instance."""
         db.Model.__init__(self, experiment_id=experiment_id, **kwargs)
 
+    @classmethod
+    def with_geometry(cls, shape=None, voxel_size=None, tr=None, tolerance=0.01):
+        """Query scans by their acquisition geometry
+
+        :param tuple shape: the number of voxels along x, y and z
+        :param tuple voxel_size: the voxel size along x, y and z in millimeters
+        :param float tr: the repetition time in seconds
+        :param float tolerance: how far voxel sizes and repetition times may be from the values given
+        :return: a query for the matching scans
+        :rtype: Query
+        """
+        query = cls.query
+        if shape is not None:
+            query = query.filter(cls.dim_x == shape[0], cls.dim_y == shape[1], cls.dim_z == shape[2])
+        if voxel_size is not None:
+            for column, size in zip((cls.pixdim_x, cls.pixdim_y, cls.pixdim_z), voxel_size):
+                query = query.filter(column.between(size - tolerance, size + tolerance))
+        if tr is not None:
+            query = query.filter(cls.tr.between(tr - tolerance, tr + tolerance))
+        return query
+
+    @classmethod
+    def isotropic(cls, size, tolerance=0.01):
+        """Query scans whose voxels are size millimeters along every axis
+
+        :param float size: the voxel size in millimeters
+        :param float tolerance: how far voxel sizes may be from size
+        :return: a query for the matching scans
+        :rtype: Query
+        """
+        return cls.with_geometry(voxel_size=(size, size, size), tolerance=tolerance)
+
     def __repr__(self):
         """Represent instance as a unique string."""
         return '<Scan({uri})>'.format(uri=self.xnat_uri)
+
+
+class UploadJob(SurrogatePK, Model):
+    """A scan file waiting to be, or being, uploaded to XNAT by a background worker.
+
+    The uploaded file is staged on disk at ``path`` so the job survives restarts of both the web and worker processes.
+    A worker claims a job by moving it to ``running`` and holding it until ``locked_until``; a job whose worker died is
+    claimed again once that lease runs out.  Failed attempts go back to ``queued`` until ``run_after``.
+    """
+
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+    __tablename__ = 'scan_upload_jobs'
+    status = Column(db.String(16), nullable=False, default=QUEUED, index=True)
+    filename = Column(db.String(255), nullable=False)
+    path = Column(db.String(1024), nullable=False)
+    attempts = Column(db.Integer(), nullable=False, default=0)
+    error = Column(db.Text(), nullable=True)
+    created_at = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+    run_after = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+    locked_until = Column(db.DateTime, nullable=True)
+    finished_at = Column(db.DateTime, nullable=True)
+    dicom_index = Column(JSONText, nullable=True)
+    user_id = reference_col('users')
+    experiment_id = reference_col('experiments')
+    scan_id = reference_col('scan', nullable=True)
+    scan = relationship('Scan')
+
+    def __init__(self, user_id, experiment_id, filename, path, **kwargs):
+        """Create instance."""
+        db.Model.__init__(self, user_id=user_id, experiment_id=experiment_id, filename=filename, path=path, **kwargs)
+
+    def to_dict(self):
+        """The job's status as a JSON-serializable dict."""
+        return {
+            'id': self.id,
+            'status': self.status,
+            'filename': self.filename,
+            'attempts': self.attempts,
+            'error': self.error,
+            'created_at': self.created_at.isoformat(),
+            'finished_at': self.finished_at.isoformat() if self.finished_at else None,
+            'experiment_id': self.experiment_id,
+            'scan_id': self.scan_id,
+        }
+
+    def __repr__(self):
+        """Represent instance as a unique string."""
+        return '<UploadJob({id}, {status})>'.format(id=self.id, status=self.status)
+
+
+class UploadSession(SurrogatePK, Model):
+    """A resumable, chunked upload of a scan file that is still in progress.
+
+    Chunks are appended to the staged file at ``path``; ``offset`` is the number of bytes received so far.  When it
+    reaches ``length`` the file is handed to an UploadJob and the session is finished.  Sessions that see no chunks
+    before ``expires_at`` are abandoned and cleaned up.
+    """
+
+    __tablename__ = 'scan_upload_sessions'
+    token = Column(db.String(32), unique=True, nullable=False)
+    filename = Column(db.String(255), nullable=False)
+    path = Column(db.String(1024), nullable=False)
+    length = Column(db.BigInteger(), nullable=False)
+    offset = Column(db.BigInteger(), nullable=False, default=0)
+    created_at = Column(db.DateTime, nullable=False, default=dt.datetime.utcnow)
+    expires_at = Column(db.DateTime, nullable=False, index=True)
+    user_id = reference_col('users')
+    experiment_id = reference_col('experiments')
+    job_id = reference_col('scan_upload_jobs', nullable=True)
+    job = relationship('UploadJob')
+
+    def __init__(self, token, user_id, experiment_id, filename, path, length, expires_at, **kwargs):
+        """Create instance."""
+        db.Model.__init__(self, token=token, user_id=user_id, experiment_id=experiment_id, filename=filename,
+                          path=path, length=length, expires_at=expires_at, **kwargs)
+
+    @property
+    def is_complete(self):
+        """Whether every byte of the file has been received."""
+        return self.offset == self.length
+
+    @property
+    def is_expired(self):
+        """Whether the session has been abandoned."""
+        return not self.is_complete and self.expires_at < dt.datetime.utcnow()
+
+    def __repr__(self):
+        """Represent instance as a unique string."""
+        return '<UploadSession({token}, {offset}/{length})>'.format(token=self.token, offset=self.offset,
+                                                                    length=self.length)
@@ -0,0 +1,141 @@
+# -*- coding: utf-8 -*-
+"""Parsing of NIfTI-1 and NIfTI-2 headers.
+
+Only the head of the file is read: the 348 byte NIfTI-1 header or the 540 byte NIfTI-2 header, decompressing just
+enough of a .nii.gz to reach its end.  The fields that describe the acquisition geometry are returned in the units the
+scan table stores them in, millimeters and seconds, so they can be compared across files whatever units they were
+written in.
+"""
+import struct
+import zlib
+from collections import namedtuple
+
+from .utils import peek
+
+NIFTI1_HEADER_SIZE = 348
+NIFTI2_HEADER_SIZE = 540
+
+# Multipliers from the spatial and temporal units codes of xyzt_units to millimeters and seconds
+SPATIAL_UNITS = {1: 1000.0, 2: 1.0, 3: 0.001}
+TEMPORAL_UNITS = {8: 1.0, 16: 0.001, 24: 0.000001}
+
+#: NumPy type codes of the NIfTI datatypes of real-valued voxels
+NUMPY_DTYPES = {2: 'u1', 4: 'i2', 8: 'i4', 16: 'f4', 64: 'f8', 256: 'i1', 512: 'u2', 768: 'u4', 1024: 'i8', 1280: 'u8'}
+
+#: The raw fields of a NIfTI header that describe the layout and geometry of the image
+NiftiHeader = namedtuple('NiftiHeader', ['version', 'byteorder', 'dim', 'datatype', 'pixdim', 'vox_offset',
+                                         'xyzt_units', 'qform_code', 'sform_code'])
+
+
+def _byte_order(head, size):
+    """The struct byte order prefix under which head starts with sizeof_hdr == size, or None."""
+    for endian in ('<', '>'):
+        if struct.unpack_from(endian + 'i', head)[0] == size:
+            return endian
+    return None
+
+
+def _unpack_nifti1(head, endian):
+    dim = struct.unpack_from(endian + '8h', head, 40)
+    datatype = struct.unpack_from(endian + 'h', head, 70)[0]
+    pixdim = struct.unpack_from(endian + '8f', head, 76)
+    vox_offset = struct.unpack_from(endian + 'f', head, 108)[0]
+    xyzt_units = head[123]
+    qform_code, sform_code = struct.unpack_from(endian + '2h', head, 252)
+    return NiftiHeader(1, endian, dim, datatype, pixdim, int(vox_offset), xyzt_units, qform_code, sform_code)
+
+
+def _unpack_nifti2(head, endian):
+    datatype = struct.unpack_from(endian + 'h', head, 12)[0]
+    dim = struct.unpack_from(endian + '8q', head, 16)
+    pixdim = struct.unpack_from(endian + '8d', head, 104)
+    vox_offset = struct.unpack_from(endian + 'q', head, 168)[0]
+    qform_code, sform_code = struct.unpack_from(endian + '2i', head, 344)
+    xyzt_units = struct.unpack_from(endian + 'i', head, 500)[0]
+    return NiftiHeader(2, endian, dim, datatype, pixdim, vox_offset, xyzt_units, qform_code, sform_code)
+
+
+def unpack_nifti_header(head):
+    """Unpack the raw layout and geometry fields of a NIfTI-1 or NIfTI-2 header
+
+    :param bytes head: at least the first 348 bytes of a NIfTI-1 file, or 540 bytes of a NIfTI-2 file
+    :return: the fields, or None if head is not a NIfTI header
+    :rtype: NiftiHeader
+    """
+    if len(head) >= NIFTI1_HEADER_SIZE and head[344:348] in (b'n+1\0', b'ni1\0'):
+        endian = _byte_order(head, NIFTI1_HEADER_SIZE)
+        unpack = _unpack_nifti1
+    elif len(head) >= NIFTI2_HEADER_SIZE and head[4:12] in (b'n+2\0\r\n\x1a\n', b'ni2\0\r\n\x1a\n'):
+        endian = _byte_order(head, NIFTI2_HEADER_SIZE)
+        unpack = _unpack_nifti2
+    else:
+        return None
+    if endian is None:
+        return None
+    return unpack(head, endian)
+
+
+def volume_layout(header):
+    """The layout on disk of the first 3-d volume of a NIfTI image
+
+    :param NiftiHeader header: the unpacked header
+    :return: a two-tuple of the NumPy dtype string of the voxels and the (x, y, z) shape of the volume, which is
+        stored x-fastest, or None if the voxels are not real numbers or the image has fewer than two dimensions
+    :rtype: tuple
+    """
+    if header.datatype not in NUMPY_DTYPES or header.dim[0] < 2:
+        return None
+    dtype = header.byteorder + NUMPY_DTYPES[header.datatype]
+    shape = tuple(max(int(header.dim[i]), 1) if i <= header.dim[0] else 1 for i in (1, 2, 3))
+    return dtype, shape
+
+
+def read_nifti_header(head):
+    """Parse the geometry of a NIfTI image from the head of an uncompressed file
+
+    The result has the ``nifti_version``, the ``datatype`` code, the ``qform_code`` and ``sform_code``, the size of
+    the image along each axis as ``dim_x`` to ``dim_t``, the voxel size in millimeters as ``pixdim_x`` to ``pixdim_z``
+    and the repetition time in seconds as ``tr``.  Axes beyond the image's dimensionality, and a repetition time on a
+    single volume, are None.
+
+    :param bytes head: at least the first 348 bytes of a NIfTI-1 file, or 540 bytes of a NIfTI-2 file
+    :return: the header fields, keyed by the names of the matching Scan columns, or None if head is not a NIfTI header
+    :rtype: dict
+    """
+    raw = unpack_nifti_header(head)
+    if raw is None:
+        return None
+    version, _, dim, datatype, pixdim, _, xyzt_units, qform_code, sform_code = raw
+    ndim = min(max(dim[0], 0), 7)
+    spatial = SPATIAL_UNITS.get(xyzt_units & 0x07, 1.0)
+    temporal = TEMPORAL_UNITS.get(xyzt_units & 0x38)
+    header = {
+        'nifti_version': version,
+        'datatype': datatype,
+        'qform_code': qform_code,
+        'sform_code': sform_code,
+    }
+    for i, axis in enumerate('xyzt', 1):
+        header['dim_' + axis] = dim[i] if i <= ndim else None
+    for i, axis in enumerate('xyz', 1):
+        header['pixdim_' + axis] = abs(pixdim[i]) * spatial if i <= ndim else None
+    tr = pixdim[4] * (temporal or 1.0) if ndim >= 4 and dim[4] > 1 else None
+    header['tr'] = tr if tr and tr > 0 else None
+    return header
+
+
+def read_nifti_file_header(file):
+    """Parse the geometry of a NIfTI image from a .nii or .nii.gz file, leaving its position where it was
+
+    :param file file: a seekable or peekable binary file object (e.g. a werkzeug FileStorage)
+    :return: the header fields (see read_nifti_header), or None if the file is not a NIfTI image
+    :rtype: dict
+    """
+    head = peek(file, NIFTI2_HEADER_SIZE)
+    if head[:2] == b'\x1f\x8b':
+        head = peek(file)
+        try:
+            head = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(head, NIFTI2_HEADER_SIZE)
+        except zlib.error:
+            return None
+    return read_nifti_header(head)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""Thumbnails of the three orthogonal mid-slices of a NIfTI image.
+
+Previews are made by the upload worker while the uploaded file is still on local disk, so showing one never means
+fetching the scan back from XNAT.  An uncompressed .nii is memory-mapped, so only the pages under the three slices are
+read.  A .nii.gz, or an upload that isn't a file on disk, is read as a stream one z-slice at a time, keeping just the
+rows and columns the sagittal and coronal slices need, so memory use is bounded by a single slice whatever the size of
+the volume.
+
+Each slice is windowed to its 1st to 99th percentile and written as an 8-bit grayscale PNG to a cache directory keyed
+by scan id.
+"""
+import gzip
+import os
+import struct
+import zlib
+
+import numpy as np
+
+from .nifti import NIFTI2_HEADER_SIZE, unpack_nifti_header, volume_layout
+from .utils import peek
+
+AXES = ('sagittal', 'coronal', 'axial')
+
+
+def preview_path(folder, scan_id, axis):
+    """The path of the cached preview of a scan along an axis
+
+    :param str folder: the preview cache directory
+    :param int scan_id: the scan's id
+    :param str axis: one of AXES
+    :return: the path
+    :rtype: str
+    """
+    return os.path.join(folder, str(scan_id), '{}.png'.format(axis))
+
+
+def write_previews(folder, scan_id, file, max_size=256):
+    """Make the previews of a NIfTI image and write them to the cache
+
+    :param str folder: the preview cache directory
+    :param int scan_id: the id of the scan the image belongs to
+    :param file file: a seekable binary file object holding a .nii or .nii.gz image; it is read from the start
+    :param int max_size: the largest width or height of a preview, in pixels
+    :return: the paths of the previews by axis, or None if the image can't be previewed
+    :rtype: dict
+    """
+    slices = mid_slices(file)
+    if slices is None:
+        return None
+    os.makedirs(os.path.join(folder, str(scan_id)), exist_ok=True)
+    paths = {}
+    for axis, image in zip(AXES, slices):
+        path = preview_path(folder, scan_id, axis)
+        step = -(-max(image.shape) // max_size)
+        with open(path + '.tmp', 'wb') as f:
+            f.write(encode_png(window(image[::step, ::step])))
+        os.replace(path + '.tmp', path)
+        paths[axis] = path
+    return paths
+
+
+def mid_slices(file):
+    """Extract the sagittal, coronal and axial slices through the middle of the first volume of a NIfTI image
+
+    Slices are oriented for display, with the first row at the top: anterior up for the axial slice and superior up
+    for the others, assuming the voxel axes run towards the patient's left, anterior and superior.
+
+    :param file file: a seekable binary file object holding a .nii or .nii.gz image
+    :return: a three-tuple of 2-d arrays, or None if the file is not a NIfTI image of a type we can preview
+    :rtype: tuple
+    """
+    file.seek(0)
+    compressed = peek(file, 2) == b'\x1f\x8b'
+    stream = gzip.GzipFile(fileobj=file, mode='rb') if compressed else file
+    header = unpack_nifti_header(stream.read(NIFTI2_HEADER_SIZE))
+    layout = header and volume_layout(header)
+    if layout is None:
+        return None
+    dtype, shape = np.dtype(layout[0]), layout[1]
+    if compressed or not _has_fileno(file):
+        stream.seek(header.vox_offset)
+        sagittal, coronal, axial = _stream_slices(stream, dtype, shape)
+    else:
+        volume = np.memmap(file, dtype=dtype, mode='r', offset=header.vox_offset, shape=shape, order='F')
+        sagittal = np.array(volume[shape[0] // 2, :, :])
+        coronal = np.array(volume[:, shape[1] // 2, :])
+        axial = np.array(volume[:, :, shape[2] // 2])
+        del volume
+    return tuple(np.flipud(image.T) for image in (sagittal, coronal, axial))
+
+
+def _has_fileno(file):
+    try:
+        file.fileno()
+    except (AttributeError, OSError):
+        return False
+    return True
+
+
+def _stream_slices(stream, dtype, shape):
+    """Read the three mid-slices from a stream of voxels in x-fastest order, one z-slice at a time."""
+    nx, ny, nz = shape
+    sagittal = np.empty((ny, nz), dtype)
+    coronal = np.empty((nx, nz), dtype)
+    axial = None
+    size = nx * ny * dtype.itemsize
+    for z in range(nz):
+        data = stream.read(size)
+        if len(data) < size:
+            raise ValueError('The image ends before its last slice')
+        plane = np.frombuffer(data, dtype).reshape((nx, ny), order='F')
+        sagittal[:, z] = plane[nx // 2, :]
+        coronal[:, z] = plane[:, ny // 2]
+        if z == nz // 2:
+            axial = plane.copy()
+    return sagittal, coronal, axial
+
+
+def window(image, low=1, high=99):
+    """Scale an image to 8 bits, clipping it to a window between two percentiles of its intensity
+
+    :param numpy.ndarray image: a 2-d array of any real type
+    :param float low: the percentile mapped to black
+    :param float high: the percentile mapped to white
+    :return: the windowed image
+    :rtype: numpy.ndarray
+    """
+    image = np.nan_to_num(image.astype(np.float32))
+    lo, hi = np.percentile(image, (low, high))
+    if hi <= lo:
+        return np.zeros(image.shape, np.uint8)
+    scaled = (image - lo) * (255.0 / (hi - lo))
+    return np.clip(scaled, 0, 255).astype(np.uint8)
+
+
+def encode_png(image):
+    """Encode an 8-bit grayscale image as a PNG
+
+    :param numpy.ndarray image: a 2-d array of uint8
+    :return: the PNG file's contents
+    :rtype: bytes
+    """
+    height, width = image.shape
+    # Each scanline starts with its filter type, 0 for none
+    raw = np.zeros((height, width + 1), np.uint8)
+    raw[:, 1:] = image
+    return b''.join([
+        b'\x89PNG\r\n\x1a\n',
+        _png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)),
+        _png_chunk(b'IDAT', zlib.compress(raw.tobytes(), 9)),
+        _png_chunk(b'IEND', b''),
+    ])
+
+
+def _png_chunk(kind, data):
+    return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data))
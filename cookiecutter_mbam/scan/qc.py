@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""Automated quality control metrics for NIfTI scans.
+
+The metrics are computed with NumPy on a pool of processes, each of which memory-maps the image and works on a slab of
+z-slices, so no process ever copies the whole volume and the slabs of a large image are processed on every core.  A
+.nii.gz is first decompressed, as a stream, to a temporary file so it can be mapped the same way.
+
+There are three passes over the slabs, each reduced in the calling process: the intensity range, a fine histogram
+over that range, and, given the foreground threshold chosen from the histogram by Otsu's method, sums over the
+foreground, the background and the ghost region.  The ghost region is the background under the foreground mask shifted
+by half the field of view along y, where Nyquist ghosts appear when y is the phase encoding direction.
+
+The metrics are a dict of:
+
+* ``min``, ``max``: the intensity range
+* ``robust_min``, ``robust_max``: the 0.5th and 99.5th percentiles
+* ``histogram``: ``counts`` in HISTOGRAM_BINS equal bins between ``min`` and ``max``
+* ``foreground_threshold`` and ``foreground_fraction``: the Otsu threshold and the fraction of voxels above it
+* ``snr``: the mean of the foreground over the standard deviation of the background
+* ``ghosting_ratio``: the mean of the ghost region, less the mean of the rest of the background, over the mean of the
+  foreground
+"""
+import gzip
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import numpy as np
+
+from .nifti import NIFTI2_HEADER_SIZE, unpack_nifti_header, volume_layout
+from .utils import CHUNK_SIZE, peek
+
+#: The number of bins in the stored histogram
+HISTOGRAM_BINS = 64
+
+#: The number of bins in the histogram percentiles and the threshold are found from
+FINE_BINS = HISTOGRAM_BINS * 64
+
+#: The number of z-slices in each task given to the pool
+SLAB_SIZE = 16
+
+_pools = {}
+
+
+def process_pool(workers):
+    """A process pool for QC work, shared by every scan processed in this process
+
+    :param int workers: the number of processes in the pool
+    :return: the pool
+    :rtype: ProcessPoolExecutor
+    """
+    key = ('processes', os.getpid(), workers)
+    if key not in _pools:
+        _pools[key] = ProcessPoolExecutor(max_workers=workers)
+    return _pools[key]
+
+
+def submit_qc(file, workers=2, slab_size=SLAB_SIZE):
+    """Start computing the QC metrics of a NIfTI image in the background
+
+    The file is copied, or decompressed, to a temporary file first unless it is an uncompressed image already on disk,
+    so the caller is free to reuse file once this returns.
+
+    :param file file: a seekable binary file object holding a .nii or .nii.gz image; it is read from the start
+    :param int workers: the number of processes the slabs are spread over
+    :param int slab_size: the number of z-slices in each task
+    :return: a future of the metrics, or of None if the image isn't one we can measure
+    :rtype: concurrent.futures.Future
+    """
+    file.seek(0)
+    path = getattr(file, 'name', None)
+    temporary = peek(file, 2) == b'\x1f\x8b' or not (isinstance(path, str) and os.path.isfile(path))
+    if temporary:
+        path = _spill(file)
+    file.seek(0)
+    key = ('threads', os.getpid())
+    if key not in _pools:
+        _pools[key] = ThreadPoolExecutor(max_workers=1)
+    return _pools[key].submit(_compute_and_clean_up, path, temporary, process_pool(workers), slab_size)
+
+
+def _spill(file):
+    """Copy file to a temporary file on disk, decompressing it if it is gzipped, and return its path."""
+    source = gzip.GzipFile(fileobj=file, mode='rb') if peek(file, 2) == b'\x1f\x8b' else file
+    with tempfile.NamedTemporaryFile(suffix='.nii', delete=False) as f:
+        shutil.copyfileobj(source, f, CHUNK_SIZE)
+    return f.name
+
+
+def _compute_and_clean_up(path, temporary, executor, slab_size):
+    try:
+        return compute_qc_metrics(path, executor=executor, slab_size=slab_size)
+    finally:
+        if temporary:
+            os.remove(path)
+
+
+def compute_qc_metrics(path, executor=None, slab_size=SLAB_SIZE):
+    """Compute the QC metrics of the first volume of an uncompressed NIfTI image
+
+    :param str path: the path of the .nii file
+    :param concurrent.futures.Executor executor: the pool the slabs are processed on; in this process if None
+    :param int slab_size: the number of z-slices in each task
+    :return: the metrics, or None if the image isn't one we can measure
+    :rtype: dict
+    """
+    with open(path, 'rb') as f:
+        header = unpack_nifti_header(f.read(NIFTI2_HEADER_SIZE))
+    layout = header and volume_layout(header)
+    if layout is None:
+        return None
+    dtype, shape = layout
+    image = (path, header.vox_offset, dtype, shape)
+    slabs = [(z, min(z + slab_size, shape[2])) for z in range(0, shape[2], slab_size)]
+    run = executor.map if executor else map
+
+    ranges = list(run(_slab_range, *zip(*[image + slab for slab in slabs])))
+    low = min(r[0] for r in ranges)
+    high = max(r[1] for r in ranges)
+    top = high if high > low else low + 1
+    counts = sum(run(_slab_histogram, *zip(*[image + slab + (low, top) for slab in slabs])))
+    edges = np.linspace(low, top, FINE_BINS + 1)
+    threshold = _otsu_threshold(counts, edges)
+    sums = sum(run(_slab_sums, *zip(*[image + slab + (threshold,) for slab in slabs])))
+
+    fg_count, fg_sum, bg_count, bg_sum, bg_sum_sq, ghost_count, ghost_sum = sums
+    fg_mean = fg_sum / fg_count if fg_count else 0.0
+    bg_all = bg_count + ghost_count
+    bg_mean = (bg_sum + ghost_sum) / bg_all if bg_all else 0.0
+    bg_std = np.sqrt(max(bg_sum_sq / bg_all - bg_mean ** 2, 0.0)) if bg_all else 0.0
+    rest_mean = bg_sum / bg_count if bg_count else 0.0
+    ghost_mean = ghost_sum / ghost_count if ghost_count else rest_mean
+    robust_min, robust_max = _histogram_percentiles(counts, edges, (0.5, 99.5))
+    return {
+        'min': float(low),
+        'max': float(high),
+        'robust_min': robust_min,
+        'robust_max': robust_max,
+        'histogram': {'counts': counts.reshape(HISTOGRAM_BINS, -1).sum(axis=1).tolist()},
+        'foreground_threshold': threshold,
+        'foreground_fraction': float(fg_count / counts.sum()),
+        'snr': float(fg_mean / bg_std) if bg_std else None,
+        'ghosting_ratio': float((ghost_mean - rest_mean) / fg_mean) if fg_mean else None,
+    }
+
+
+def _map_slab(path, offset, dtype, shape, z0, z1):
+    """Memory-map z-slices z0 to z1 of the first volume of the image at path; floating point NaNs read as 0."""
+    nx, ny, _ = shape
+    plane = nx * ny * np.dtype(dtype).itemsize
+    slab = np.memmap(path, dtype=dtype, mode='r', offset=offset + z0 * plane, shape=(nx, ny, z1 - z0), order='F')
+    if slab.dtype.kind == 'f':
+        return np.nan_to_num(slab)
+    return slab
+
+
+def _slab_range(path, offset, dtype, shape, z0, z1):
+    slab = _map_slab(path, offset, dtype, shape, z0, z1)
+    return float(slab.min()), float(slab.max())
+
+
+def _slab_histogram(path, offset, dtype, shape, z0, z1, low, high):
+    slab = _map_slab(path, offset, dtype, shape, z0, z1)
+    # Equal bins, so each value's bin can be computed directly rather than searched for as np.histogram does
+    bins = np.subtract(slab, low, dtype=np.float64)
+    bins *= FINE_BINS / (high - low)
+    bins = bins.astype(np.intp)
+    np.clip(bins, 0, FINE_BINS - 1, out=bins)
+    return np.bincount(bins.ravel(order='K'), minlength=FINE_BINS)
+
+
+def _slab_sums(path, offset, dtype, shape, z0, z1, threshold):
+    """Counts and sums of the foreground, the ghost region and the rest of the background of a slab."""
+    slab = _map_slab(path, offset, dtype, shape, z0, z1)
+    foreground = slab > threshold
+    ghost = np.roll(foreground, shape[1] // 2, axis=1)
+    ghost &= ~foreground
+    background = ~foreground
+    background &= ~ghost
+    squares = np.square(slab, dtype=np.float64)
+    return np.array([
+        np.count_nonzero(foreground), slab.sum(where=foreground, dtype=np.float64),
+        np.count_nonzero(background), slab.sum(where=background, dtype=np.float64),
+        squares.sum(where=~foreground),
+        np.count_nonzero(ghost), slab.sum(where=ghost, dtype=np.float64),
+    ], dtype=np.float64)
+
+
+def _otsu_threshold(counts, edges):
+    """The threshold that maximizes the between-class variance of a histogram."""
+    centers = (edges[:-1] + edges[1:]) / 2
+    weight = np.cumsum(counts)
+    total = weight[-1]
+    cumulative = np.cumsum(counts * centers)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_below = cumulative / weight
+        mean_above = (cumulative[-1] - cumulative) / (total - weight)
+        between = np.nan_to_num(weight * (total - weight) * (mean_below - mean_above) ** 2)
+    # Splitting after the last bin leaves no foreground
+    between = between[:-1]
+    if not between.size or not between.max() > 0:
+        return float(edges[-1])
+    return float(edges[between.argmax() + 1])
+
+
+def _histogram_percentiles(counts, edges, percentiles):
+    """Percentiles of the data a histogram was made from, to the resolution of its bins."""
+    cumulative = np.cumsum(counts) / counts.sum()
+    indices = np.searchsorted(cumulative, np.asarray(percentiles) / 100.0)
+    return [float(edges[min(i + 1, len(edges) - 1)]) for i in indices]
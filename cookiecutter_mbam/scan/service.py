@@ -3,114 +3,288 @@
 
 This module implements uploading a scan file to XNAT and adding a scan to the database.
 
-Todo: Maybe the public method should be called add, and that should kick off an upload procedure, rather than the
-other way around.
-
-Todo: do we want to infer file type from extension?  Or use some other method?
-
 Todo: Right now if we use the import service XNAT is inferring its own scan id.  What do we want to do about that?
 
-Todo: if someone uploads a zip file we don't actually know that there are dicoms inside (could be NIFTI).  Consider this
-fact.
-
-Todo: Upload security for zip files?
-
 
 """
+import datetime as dt
+import fcntl
+import hashlib
 import os
+import posixpath
+import uuid
+from werkzeug.exceptions import ClientDisconnected
+from werkzeug.utils import secure_filename
+from cookiecutter_mbam.database import db_transaction
+from cookiecutter_mbam.extensions import db
 from cookiecutter_mbam.xnat import XNATConnection
+from cookiecutter_mbam.xnat.config import backend_config
+from cookiecutter_mbam.xnat.ids import experiment_label, scan_labels, subject_label
 from cookiecutter_mbam.experiment import Experiment
 from cookiecutter_mbam.user import User
-from .models import Scan
-from .utils import gzip_file
+from .dicom import inspect_dicom_zip
+from .nifti import read_nifti_file_header
+from .preview import write_previews
+from .qc import submit_qc
+from .models import Scan, UploadJob, UploadSession
+from .utils import (gzip_file, hash_file, sniff_file_type, UnsupportedScanFile, CHUNK_SIZE, NIFTI, NIFTI_GZ,
+                    NIFTI_ZIP, DICOM_ZIP, ZIP)
 
 from flask import current_app
 def debug():
     assert current_app.debug == False, "Don't panic! You're here by request of debug()"
 
 
+def staging_path(filename):
+    """Generate a unique path in the upload staging directory for a file with the given name
+
+    :param str filename: the name the file was uploaded with
+    :return: the path
+    :rtype: str
+    """
+    staging_dir = os.path.join(current_app.config['UPLOAD_FOLDER'], 'jobs')
+    os.makedirs(staging_dir, exist_ok=True)
+    return os.path.join(staging_dir, '{}_{}'.format(uuid.uuid4().hex, secure_filename(filename)))
+
+
+def preview_folder():
+    """The directory scan previews are cached in
+
+    :return: the path
+    :rtype: str
+    """
+    return os.path.join(current_app.config['UPLOAD_FOLDER'], 'previews')
+
+
 class ScanService:
 
     def __init__(self, user_id, exp_id):
         self.user_id = user_id
         self.user = User.get_by_id(self.user_id)
         self.experiment = Experiment.get_by_id(exp_id)
-        self.xc = XNATConnection()
+        self.xnat_backend = XNATConnection.backend_for(self.user,
+                                                       self.user.xnat_subject_id or subject_label(self.user_id))
+        self.xc = XNATConnection(backend_config(self.xnat_backend))
 
-    # todo: what is the actual URI of the experiment I've created?  Why does it have the XNAT prefix?
-    # maybe that's the accessor?  Is the accessor in the URI?
     def upload(self, image_file):
         """The top level public method for adding a scan
 
+        Stages the uploaded file on disk and queues a job for a background worker to process it (see
+        cookiecutter_mbam.scan.jobs), so the request returns without waiting on compression or the XNAT transfer.
+
+        :param file object image_file: the uploaded file object
+        :return: the queued job
+        :rtype: UploadJob
+        :raises UnsupportedScanFile: if the file is not a NIfTI file or a zip of DICOM files
+        """
+        dicom_index = self._index_file(image_file)
+        path = staging_path(image_file.filename)
+        image_file.save(path)
+        return self.enqueue(path, image_file.filename, dicom_index=dicom_index)
+
+    def enqueue(self, path, filename, dicom_index=None):
+        """Queue a job to process a file that is already staged on disk
+
+        :param str path: the path of the staged file, which the job takes ownership of
+        :param str filename: the name the file was uploaded with
+        :param dict dicom_index: the index of a zip of DICOM files, if it has already been built
+        :return: the queued job
+        :rtype: UploadJob
+        """
+        return UploadJob.create(user_id=self.user.id, experiment_id=self.experiment.id, filename=filename, path=path,
+                                dicom_index=dicom_index)
+
+    # todo: what is the actual URI of the experiment I've created?  Why does it have the XNAT prefix?
+    # maybe that's the accessor?  Is the accessor in the URI?
+    def process(self, image_file, dicom_index=None, progress=None):
+        """Process an uploaded scan and add it to XNAT and the database
+
         Calls methods to infer file type and further process the file, generate xnat identifiers and query strings,
         check what XNAT identifiers objects have, upload the scan to XNAT, add the scan to the database, and update
-        user, experiment, and scan database objects with their XNAT-related attributes.
+        user, experiment, and scan database objects with their XNAT-related attributes.  The geometry in the header of
+        a NIfTI file is recorded on the scan, its previews are cached, and its QC metrics are computed on a process pool
+        while it is sent to XNAT.  The database changes are made in one transaction, once the file is in XNAT.  Called
+        by the upload job worker.
 
-        :param file object image_file: the file object
-        :return: None
+        If the user already has a scan with exactly the same content, the existing scan is returned instead, before
+        the file is compressed, its QC is started or anything is sent to XNAT.  The SHA-256 that tells is computed in
+        a read of the file as uploaded, which costs far less than the compression it can save.
 
+        :param file object image_file: the file object
+        :param dict dicom_index: the index of a zip of DICOM files, if it has already been built
+        :param function progress: called with the bytes sent to XNAT so far and the size of the file as it is sent
+        :return: the new scan, or the existing scan with the same content
+        :rtype: Scan
         """
+        if dicom_index is None:
+            dicom_index = self._index_file(image_file)
+        sha256 = hash_file(image_file)
+        duplicate = self._find_duplicate(sha256)
+        if duplicate:
+            current_app.logger.info('{0} duplicates {1}; skipping upload'.format(image_file.filename, duplicate))
+            return duplicate
+        geometry = read_nifti_file_header(image_file) or {}
         file, dcm = self._process_file(image_file)
+        qc = self._submit_qc(image_file) if geometry else None
         xnat_ids = self._generate_xnat_identifiers(dcm=dcm)
         existing_attributes = self._check_for_existing_xnat_ids()
-        uris = self.xc.upload_scan(xnat_ids, existing_attributes, image_file, import_service=dcm)
-        scan = self._add_scan()
+        uris = self.xc.upload_scan(xnat_ids, existing_attributes, file, import_service=dcm, progress=progress)
+        qc_metrics = self._qc_result(qc)
         keywords = ['subject', 'experiment', 'scan']
-        self._update_database_objects(keywords=keywords, objects=[self.user, self.experiment, scan],
-                                     ids=['{}_id'.format(xnat_ids[kw]['xnat_id']) for kw in keywords], uris=uris)
+        ids = [xnat_ids[kw]['xnat_id'] for kw in keywords]
+        if dcm:
+            # The import service numbers the scan itself
+            ids[2] = posixpath.basename(uris[2]) if uris[2] else None
+        with db_transaction():
+            # The subject is on its backend now
+            self.user.xnat_backend = self.user.xnat_backend or self.xnat_backend
+            scan = self._add_scan(dicom_index=dicom_index, sha256=sha256, qc_metrics=qc_metrics, **geometry)
+            self._update_database_objects(keywords=keywords, objects=[self.user, self.experiment, scan], ids=ids,
+                                          uris=uris)
+        if geometry:
+            # After the commit, which gives the scan its id
+            self._write_previews(scan, image_file)
+        return scan
 
-    def _add_scan(self):
+    def _add_scan(self, **kwargs):
         """Add a scan to the database
 
         Creates the scan object, adds it to the database, and increments the parent experiment's scan count
+        :param kwargs: further attributes of the scan
         :return: scan
         """
-        scan = Scan.create(experiment_id=self.experiment.id)
-        self.experiment.num_scans += 1
+        scan = Scan.create(experiment_id=self.experiment.id, **kwargs)
+        self.experiment.increment('num_scans')
         return scan
 
+    def _submit_qc(self, image_file):
+        """Start computing the QC metrics of a NIfTI scan in the background
+
+        :param file object image_file: the uploaded file object
+        :return: a future of the metrics, or None if they can't be computed
+        :rtype: concurrent.futures.Future
+        """
+        try:
+            return submit_qc(getattr(image_file, 'stream', image_file),
+                             workers=current_app.config.get('SCAN_QC_WORKERS', 2))
+        except Exception:
+            current_app.logger.exception('Could not start QC of {}'.format(image_file.filename))
+            return None
+
+    def _qc_result(self, qc):
+        """Wait for the QC metrics of a scan, logging rather than raising any failure
+
+        :param concurrent.futures.Future qc: the future from _submit_qc, or None
+        :return: the metrics, or None
+        :rtype: dict
+        """
+        if qc is None:
+            return None
+        try:
+            return qc.result(timeout=current_app.config.get('SCAN_QC_TIMEOUT', 600))
+        except Exception:
+            current_app.logger.exception('QC failed')
+            return None
+
+    def _write_previews(self, scan, image_file):
+        """Cache the mid-slice previews of a NIfTI scan
+
+        A preview that can't be made is logged rather than raised, since the scan itself is already in XNAT.
+
+        :param Scan scan: the scan
+        :param file object image_file: the uploaded file object
+        :return: None
+        """
+        try:
+            write_previews(preview_folder(), scan.id, getattr(image_file, 'stream', image_file),
+                           max_size=current_app.config.get('SCAN_PREVIEW_SIZE', 256))
+        except Exception:
+            current_app.logger.exception('Could not make previews of {}'.format(scan))
 
     def _process_file(self, image_file):
-        """Infer file type from extension and respond to file type as necessary
+        """Infer file type from the file's header and respond to file type as necessary
 
-        Uses file extension to infer whether file should be left alone or gzipped, or whether zip file will be sent to
-        import service.
+        Sniffs the first few kilobytes of the file to decide whether it should be gzipped, left alone, or sent to the
+        import service as a zip of DICOM files.
 
         :param file object image_file: the file object
         :return: a two-tuple of the image file, and a boolean indicating the file type is dcm
         :rtype: tuple
-
         """
-        image_file_name = image_file.filename
-        file_name, file_ext = os.path.splitext(image_file_name)
+        file_type = self._check_file_type(image_file)
         dcm = False
-        if file_ext == '.nii':
-            image_file = (gzip_file(image_file, file_name))
-        if file_ext == '.zip':
+        if file_type == NIFTI:
+            image_file_name = image_file.filename
+            image_file, stats = gzip_file(image_file, compresslevel=current_app.config['SCAN_GZIP_LEVEL'],
+                                          workers=current_app.config['SCAN_GZIP_WORKERS'])
+            current_app.logger.info('Compressed {0}: {1}'.format(image_file_name, stats))
+        if file_type in (DICOM_ZIP, ZIP):
             dcm = True
         return (image_file, dcm)
 
+    def _find_duplicate(self, sha256):
+        """Find a scan of this user's with the given content
+
+        :param str sha256: the SHA-256 of the uploaded file
+        :return: the scan, or None
+        :rtype: Scan
+        """
+        return Scan.query.join(Experiment).filter(Experiment.user_id == self.user.id, Scan.sha256 == sha256).first()
+
+    @staticmethod
+    def _check_file_type(image_file):
+        """Sniff the file type, and reject files we can't send to XNAT
+
+        :param file object image_file: the file object
+        :return: the file type, one of NIFTI, NIFTI_GZ, DICOM_ZIP or ZIP
+        :rtype: str
+        :raises UnsupportedScanFile: if the file is not a NIfTI file or a zip of DICOM files
+        """
+        file_type = sniff_file_type(image_file)
+        if file_type == NIFTI_ZIP:
+            raise UnsupportedScanFile('Zip files must contain DICOM files; upload NIfTI files individually')
+        if file_type not in (NIFTI, NIFTI_GZ, DICOM_ZIP, ZIP):
+            raise UnsupportedScanFile('Scans must be NIfTI files or zip files of DICOM files')
+        return file_type
+
+    @classmethod
+    def _index_file(cls, image_file):
+        """Check the file type, and index the contents of zip files
+
+        :param file object image_file: the file object
+        :return: the index of the DICOM files in a zip file (see cookiecutter_mbam.scan.dicom), or None for NIfTI files
+        :rtype: dict
+        :raises UnsupportedScanFile: if the file is not a NIfTI file or a zip of DICOM files, or the zip is too large
+        """
+        if cls._check_file_type(image_file) not in (DICOM_ZIP, ZIP):
+            return None
+        config = current_app.config
+        return inspect_dicom_zip(image_file, max_members=config.get('SCAN_ZIP_MAX_MEMBERS', 20000),
+                                 max_uncompressed_size=config.get('SCAN_ZIP_MAX_UNCOMPRESSED_SIZE', 16 * 1024 ** 3),
+                                 max_ratio=config.get('SCAN_ZIP_MAX_RATIO', 200))
+
     def _generate_xnat_identifiers(self, dcm=False):
         """Generate object ids for use in XNAT
 
         Creates a dictionary with keys for type of XNAT object, including subject, experiment, scan, resource and file.
         The values in the dictionary are dictionaries with keys 'xnat_id' and, optionally, 'query_string'.  'xnat_id'
         points to the identifier of the object in XNAT, and 'query_string' to the query that will be used in the put
-        request to create the object.
+        request to create the object.  A new scan's label is reserved from its experiment's sequence (see
+        cookiecutter_mbam.xnat.ids), so concurrent uploads are never given the same one; an experiment's label was
+        reserved when it was added.
 
         :return: xnat_id dictionary
         :rtype: dict
         """
         xnat_ids = {}
 
-        xnat_ids['subject'] = {'xnat_id': str(self.user_id).zfill(6)}
+        xnat_ids['subject'] = {'xnat_id': subject_label(self.user_id)}
 
-        xnat_exp_id = '{}_MR{}'.format(xnat_ids['subject']['xnat_id'], self.user.num_experiments)
+        xnat_exp_id = self.experiment.xnat_experiment_id or experiment_label(self.experiment)
         exp_date = self.experiment.date.strftime('%m/%d/%Y')
         xnat_ids['experiment'] = {'xnat_id': xnat_exp_id, 'query_string':'?xnat:mrSessionData/date={}'.format(exp_date)}
 
-        scan_number = self.experiment.num_scans + 1
-        xnat_scan_id = 'T1_{}'.format(scan_number)
+        xnat_scan_id = scan_labels(self.experiment)[0]
         xnat_ids['scan'] = {'xnat_id':xnat_scan_id, 'query_string':'?xsiType=xnat:mrScanData'}
 
         if dcm:
@@ -137,12 +311,12 @@ class ScanService:
                                                                        'xnat_experiment_id': self.experiment}.items()}
 
 
-    # todo: the check for existence before reassigning the values is verbose.  Decide whether its important.
     def _update_database_objects(self, objects=[], keywords=[], uris=[], ids=[],):
         """Update database objects
 
         After uploading a scan, ensures that user, experient, and scan are updated in the database with their xnat uri
-        and xnat id.
+        and xnat id, where they have columns for them that aren't already set.  Once set, the ids tell later uploads
+        that the objects already exist in XNAT.
 
         :param list objects: user, experiment, and scan
         :param list keywords: 'subject', 'experiment', and 'scan'
@@ -152,19 +326,163 @@ class ScanService:
         """
         attributes = zip(objects, keywords, uris, ids)
         for (obj, kw, uri, id) in attributes:
-            if not hasattr(obj, 'xnat_uri'):
-                obj.update({'xnat_uri': uri})
-            if not hasattr(obj,'xnat_{}_id'.format(kw)):
-                obj.update({'xnat_{}_id'.format(kw): id})
+            for attr, value in (('xnat_uri', uri), ('xnat_{}_id'.format(kw), id)):
+                if hasattr(obj, attr) and not getattr(obj, attr):
+                    setattr(obj, attr, value)
+            obj.save()
 
 
+class UploadSessionError(Exception):
+    """A resumable upload request that cannot be honored; code is the HTTP status to report it with."""
 
+    code = 400
 
 
+class OffsetMismatch(UploadSessionError):
+    code = 409
 
 
+class SessionExpired(UploadSessionError):
+    code = 410
 
 
+class SessionBusy(UploadSessionError):
+    code = 423
 
 
+class ChecksumMismatch(UploadSessionError):
+    code = 460
 
+
+class UploadSessionService:
+    """Resumable, chunked uploads of scan files
+
+    A client creates a session for a file of known length, then sends it in chunks, each tagged with the offset it
+    starts at and optionally a checksum.  After a dropped connection the client asks for the session's offset and
+    carries on from there.  Chunks are streamed straight into the staged file, and the completed file is queued for
+    processing in place, so no part of the upload is ever held in memory in full.
+    """
+
+    ALLOWED_EXTENSIONS = ('.nii', '.nii.gz', '.zip')
+
+    def __init__(self, user_id, exp_id):
+        self.user_id = user_id
+        self.exp_id = exp_id
+
+    def create(self, filename, length):
+        """Start a resumable upload
+
+        :param str filename: the name of the file being uploaded
+        :param int length: the size of the file in bytes
+        :return: the new session
+        :rtype: UploadSession
+        """
+        experiment = Experiment.get_by_id(self.exp_id)
+        if experiment is None or experiment.user_id != int(self.user_id):
+            raise UploadSessionError('Unknown experiment')
+        if not filename.lower().endswith(self.ALLOWED_EXTENSIONS):
+            raise UploadSessionError('Scans must be .nii, .nii.gz or .zip files')
+        if not 0 < length <= current_app.config.get('SCAN_UPLOAD_MAX_SIZE', 8 * 1024 ** 3):
+            raise UploadSessionError('Invalid upload length')
+        path = staging_path(filename)
+        open(path, 'wb').close()
+        return UploadSession.create(token=uuid.uuid4().hex, user_id=self.user_id, experiment_id=experiment.id,
+                                    filename=filename, path=path, length=length, expires_at=self._expiry())
+
+    @classmethod
+    def append(cls, upload, offset, stream, checksum=None):
+        """Append a chunk to an upload
+
+        The chunk is streamed to disk as it arrives.  If the client disconnects part way through, the bytes received
+        so far are kept, unless a checksum was given, in which case the chunk is discarded as unverifiable.  When the
+        last byte arrives the file is queued for processing.
+
+        :param UploadSession upload: the session
+        :param int offset: the offset the client believes the chunk starts at
+        :param file object stream: the request body
+        :param tuple checksum: an optional two-tuple of a hashlib algorithm name and the expected digest of the chunk
+        :return: the updated session
+        :rtype: UploadSession
+        """
+        if upload.is_expired:
+            raise SessionExpired('Upload session has expired')
+        digest = hashlib.new(checksum[0]) if checksum else None
+        with open(upload.path, 'r+b') as f:
+            try:
+                fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise SessionBusy('Another chunk is being written to this upload')
+            # The offset may have moved while we waited for the lock
+            db.session.refresh(upload)
+            if upload.is_complete or offset != upload.offset:
+                raise OffsetMismatch('Upload is at offset {}'.format(upload.offset))
+            # Discard the tail of any earlier chunk that was interrupted before it was recorded
+            f.seek(offset)
+            f.truncate()
+            received = 0
+            try:
+                for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+                    received += len(chunk)
+                    if offset + received > upload.length:
+                        f.truncate(offset)
+                        raise UploadSessionError('Chunk runs past the end of the upload')
+                    if digest:
+                        digest.update(chunk)
+                    f.write(chunk)
+            except ClientDisconnected:
+                if digest:
+                    f.truncate(offset)
+                    raise
+                digest = None
+            if digest and digest.digest() != checksum[1]:
+                f.truncate(offset)
+                raise ChecksumMismatch('Chunk checksum does not match')
+            f.flush()
+            os.fsync(f.fileno())
+            upload.update(offset=offset + received, expires_at=cls._expiry())
+        if upload.is_complete:
+            with open(upload.path, 'rb') as f:
+                try:
+                    dicom_index = ScanService._index_file(f)
+                except UnsupportedScanFile as e:
+                    cls.terminate(upload)
+                    raise UploadSessionError(str(e))
+            job = ScanService(upload.user_id, upload.experiment_id).enqueue(upload.path, upload.filename,
+                                                                            dicom_index=dicom_index)
+            upload.update(job_id=job.id)
+        return upload
+
+    @staticmethod
+    def terminate(upload):
+        """Abandon an upload and remove its staged file
+
+        :param UploadSession upload: the session
+        :return: None
+        """
+        if not upload.job_id:
+            _remove_file(upload.path)
+        upload.delete()
+
+    @classmethod
+    def expire_sessions(cls):
+        """Remove sessions, and their staged files, that have seen no chunks before their expiry
+
+        :return: the number of sessions removed
+        :rtype: int
+        """
+        expired = UploadSession.query.filter(UploadSession.job_id.is_(None),
+                                             UploadSession.expires_at < dt.datetime.utcnow()).all()
+        for upload in expired:
+            cls.terminate(upload)
+        return len(expired)
+
+    @staticmethod
+    def _expiry():
+        return dt.datetime.utcnow() + dt.timedelta(seconds=current_app.config.get('SCAN_UPLOAD_SESSION_TTL', 86400))
+
+
+def _remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
@@ -1,14 +1,245 @@
 import gzip
+import hashlib
+import struct
+import tempfile
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-def gzip_file(file, file_name):
+#: Size of the blocks read from the upload stream
+CHUNK_SIZE = 1024 * 1024
+
+#: Size of the independently compressed blocks when gzipping on more than one worker
+BLOCK_SIZE = 4 * 1024 * 1024
+
+#: Compressed output larger than this rolls over from memory to a temporary file on disk
+SPOOL_SIZE = 16 * 1024 * 1024
+
+#: The number of bytes at the head of a file that sniff_file_type looks at
+SNIFF_SIZE = 4096
+
+# File types recognized by sniff_file_type
+NIFTI = 'nifti'
+NIFTI_GZ = 'nifti.gz'
+DICOM = 'dicom'
+DICOM_ZIP = 'dicom.zip'
+NIFTI_ZIP = 'nifti.zip'
+ZIP = 'zip'
+UNKNOWN = 'unknown'
+
+
+class UnsupportedScanFile(ValueError):
+    """An uploaded file that is not a type of scan we can send to XNAT."""
+
+
+class CompressionStats:
+    """Byte counts, timing and the SHA-256 of the input for a single compression pass."""
+
+    def __init__(self):
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+        self.sha256 = None
+
+    @property
+    def ratio(self):
+        """Compressed size as a fraction of the input size."""
+        return self.bytes_out / self.bytes_in if self.bytes_in else 0.0
+
+    @property
+    def throughput(self):
+        """Input bytes compressed per second."""
+        return self.bytes_in / self.seconds if self.seconds else 0.0
+
+    def __repr__(self):
+        """Represent instance as a unique string."""
+        return '<CompressionStats(in={0}, out={1}, {2:.1f} MB/s)>'.format(
+            self.bytes_in, self.bytes_out, self.throughput / 1e6)
+
+
+def gzip_file(file, compresslevel=6, workers=1, chunk_size=CHUNK_SIZE, block_size=BLOCK_SIZE,
+              spool_size=SPOOL_SIZE):
     """ Gzip a file
-    :param file file:
-    :param str file_name:
-    :return: the gzipped file
-    :rtype: gzip file
+
+    Reads the file in fixed size chunks and compresses them into a spooled temporary file, so memory use is bounded by
+    the chunk size and the spool size no matter how large the upload is, and nothing is left behind in the working
+    directory.
+
+    With more than one worker the input is split into blocks of block_size bytes which are compressed concurrently,
+    pigz-style, each into its own gzip member.  The members are written out in order, and a concatenation of gzip
+    members is itself a valid gzip stream, so the result reads like any other .nii.gz.  zlib releases the GIL while it
+    compresses, so a thread pool is enough to use several cores.
+
+    :param file file: a readable binary file object (e.g. a werkzeug FileStorage)
+    :param int compresslevel: gzip compression level, 1 (fastest) to 9 (smallest)
+    :param int workers: the number of threads compressing blocks in parallel
+    :param int chunk_size: the number of bytes to read from file at a time when compressing on a single worker
+    :param int block_size: the number of bytes in each independently compressed block when using several workers
+    :param int spool_size: the compressed size above which output is written to disk rather than held in memory
+    :return: a two-tuple of the gzipped stream, positioned at its start, and the compression stats
+    :rtype: tuple
+    """
+    stats = CompressionStats()
+    digest = hashlib.sha256()
+    start = time.perf_counter()
+    gzipped_file = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    if workers > 1:
+        _parallel_gzip(file, gzipped_file, stats, digest, compresslevel, workers, block_size)
+    else:
+        _serial_gzip(file, gzipped_file, stats, digest, compresslevel, chunk_size)
+    stats.sha256 = digest.hexdigest()
+    stats.bytes_out = gzipped_file.tell()
+    stats.seconds = time.perf_counter() - start
+    gzipped_file.seek(0)
+    return gzipped_file, stats
+
+
+def _serial_gzip(file, out, stats, digest, compresslevel, chunk_size):
+    """Compress file into out as a single gzip member."""
+    with gzip.GzipFile(fileobj=out, mode='wb', compresslevel=compresslevel, mtime=0) as compressor:
+        for chunk in iter(lambda: file.read(chunk_size), b''):
+            stats.bytes_in += len(chunk)
+            digest.update(chunk)
+            compressor.write(chunk)
+
+
+def _gzip_member(block, compresslevel):
+    """Compress a block into a complete, standalone gzip member."""
+    compressor = zlib.compressobj(compresslevel, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(block) + compressor.flush()
+
+
+def _parallel_gzip(file, out, stats, digest, compresslevel, workers, block_size):
+    """Compress file into out as a sequence of gzip members, one per block, on a thread pool.
+
+    At most two blocks per worker are in flight at once, which bounds memory at roughly 2 * workers * block_size.
+    """
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for block in iter(lambda: file.read(block_size), b''):
+            stats.bytes_in += len(block)
+            pending.append(executor.submit(_gzip_member, block, compresslevel))
+            # Hash this block while the pool compresses it
+            digest.update(block)
+            if len(pending) >= 2 * workers:
+                out.write(pending.popleft().result())
+        while pending:
+            out.write(pending.popleft().result())
+        if not stats.bytes_in:
+            out.write(_gzip_member(b'', compresslevel))
+
+
+def hash_file(file, chunk_size=CHUNK_SIZE):
+    """Compute the SHA-256 of a file in fixed size chunks, leaving its position where it was
+
+    :param file file: a seekable binary file object
+    :param int chunk_size: the number of bytes to read at a time
+    :return: the hex digest
+    :rtype: str
     """
-    with gzip.open(file_name + '.gz', 'wb') as gzipped_file:
-        gzipped_file.writelines(file)
-    return gzipped_file
+    position = file.tell()
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: file.read(chunk_size), b''):
+        digest.update(chunk)
+    file.seek(position)
+    return digest.hexdigest()
 
 
+def peek(file, size=SNIFF_SIZE):
+    """Read up to size bytes from the head of file without consuming them
+
+    :param file file: a seekable binary file object, or a buffered one that supports peek
+    :param int size: the number of bytes wanted
+    :return: the bytes
+    :rtype: bytes
+    """
+    if _seekable(file):
+        position = file.tell()
+        head = file.read(size)
+        file.seek(position)
+        return head
+    if hasattr(file, 'peek'):
+        return file.peek(size)[:size]
+    raise ValueError('Cannot look ahead in a stream that is neither seekable nor buffered')
+
+
+def _seekable(file):
+    """Whether a file can be read and rewound
+
+    The SpooledTemporaryFile werkzeug spools form uploads to can be, but before Python 3.11 has no seekable method.
+    """
+    if hasattr(file, 'seekable'):
+        return file.seekable()
+    return hasattr(file, 'seek') and hasattr(file, 'tell')
+
+
+def _is_nifti(head):
+    """Whether head starts with a NIfTI-1 or NIfTI-2 header, in either byte order."""
+    if len(head) >= 348 and head[344:348] in (b'n+1\0', b'ni1\0'):
+        return struct.unpack('<i', head[:4])[0] == 348 or struct.unpack('>i', head[:4])[0] == 348
+    if len(head) >= 12 and head[4:12] in (b'n+2\0\r\n\x1a\n', b'ni2\0\r\n\x1a\n'):
+        return struct.unpack('<i', head[:4])[0] == 540 or struct.unpack('>i', head[:4])[0] == 540
+    return False
+
+
+def _is_dicom(head):
+    """Whether head starts with the 128 byte DICOM preamble and DICM prefix."""
+    return head[128:132] == b'DICM'
+
+
+def _sniff_zip(head):
+    """Classify a zip archive by the local headers of the members that fit in head."""
+    offset = 0
+    while head[offset:offset + 4] == b'PK\x03\x04' and offset + 30 <= len(head):
+        method, compressed_size = struct.unpack('<H8xI', head[offset + 8:offset + 22])
+        name_length, extra_length = struct.unpack('<HH', head[offset + 26:offset + 30])
+        name = head[offset + 30:offset + 30 + name_length].decode('utf-8', 'replace').lower()
+        start = offset + 30 + name_length + extra_length
+        if name.endswith('/') or name.startswith('__macosx/') or name.rsplit('/', 1)[-1].startswith('.'):
+            # Directories and resource forks say nothing about the scan; skip to the next member if we can see it
+            offset = start + compressed_size
+            continue
+        if name.endswith(('.nii', '.nii.gz')):
+            return NIFTI_ZIP
+        data = head[start:]
+        try:
+            if method == 8:
+                data = zlib.decompressobj(-zlib.MAX_WBITS).decompress(data, 540)
+            elif method != 0:
+                data = b''
+        except zlib.error:
+            data = b''
+        if _is_nifti(data):
+            return NIFTI_ZIP
+        if _is_dicom(data) or name.endswith(('.dcm', '.ima')):
+            return DICOM_ZIP
+        return ZIP
+    return ZIP
+
+
+def sniff_file_type(file):
+    """Infer the type of a scan file from its first few kilobytes
+
+    Recognizes NIfTI-1 and NIfTI-2 headers, whether bare or gzipped, DICOM files by their preamble, and zip archives,
+    which are classified by their first member as containing DICOM or NIfTI files.  The file's position is left where
+    it was, so it can still be read from the start.
+
+    :param file file: a seekable or peekable binary file object (e.g. a werkzeug FileStorage)
+    :return: one of NIFTI, NIFTI_GZ, DICOM, DICOM_ZIP, NIFTI_ZIP, ZIP or UNKNOWN
+    :rtype: str
+    """
+    head = peek(file)
+    if _is_nifti(head):
+        return NIFTI
+    if head[:2] == b'\x1f\x8b':
+        try:
+            inner = zlib.decompressobj(16 + zlib.MAX_WBITS).decompress(head, 540)
+        except zlib.error:
+            return UNKNOWN
+        return NIFTI_GZ if _is_nifti(inner) else UNKNOWN
+    if head[:4] == b'PK\x03\x04':
+        return _sniff_zip(head)
+    if _is_dicom(head):
+        return DICOM
+    return UNKNOWN
@@ -1,9 +1,17 @@
 # -*- coding: utf-8 -*-
 """Scan views."""
-from flask import Blueprint, render_template, flash, redirect, url_for, session
+import base64
+import binascii
+import os
+from flask import (Blueprint, render_template, flash, redirect, url_for, session, abort, jsonify, request,
+                   send_file)
 from flask_login import current_user
+from flask_security import login_required
 from .forms import ScanForm
-from .service import ScanService
+from .models import Scan, UploadJob, UploadSession
+from .preview import AXES, preview_path
+from .service import ScanService, UploadSessionService, UploadSessionError, preview_folder
+from .utils import UnsupportedScanFile
 from cookiecutter_mbam.utils import flash_errors
 
 blueprint = Blueprint('scan', __name__, url_prefix='/scans', static_folder='../static')
@@ -16,15 +24,156 @@ def debug():
 
 @blueprint.route('/add', methods=['GET', 'POST'])
 def add():
-    """Add a scan."""
+    """Add a scan.
+
+    Clients that ask for JSON are answered 202 Accepted with the queued job's status, and its status URL as Location.
+    """
     form = ScanForm()
     if form.validate_on_submit():
         f = form.scan_file.data
         user_id = str(current_user.get_id())
         exp_id = str(session['curr_experiment'])
-        ScanService(user_id, exp_id).upload(f)
-        flash('You successfully added a new scan.', 'success')
+        try:
+            job = ScanService(user_id, exp_id).upload(f)
+        except UnsupportedScanFile as e:
+            flash(str(e), 'warning')
+            return render_template('scans/upload.html', scan_form=form)
+        if request.accept_mimetypes.best_match(['text/html', 'application/json']) == 'application/json':
+            response = jsonify(job.to_dict())
+            response.status_code = 202
+            response.headers['Location'] = url_for('scan.job_status', job_id=job.id)
+            return response
+        flash('Your scan is being uploaded (job {}).'.format(job.id), 'success')
         return redirect(url_for('experiment.experiments'))
     else:
         flash_errors(form)
-    return render_template('scans/upload.html',scan_form=form)
\ No newline at end of file
+    return render_template('scans/upload.html', scan_form=form)
+
+
+@blueprint.route('/jobs/<int:job_id>', methods=['GET'])
+@login_required
+def job_status(job_id):
+    """Report the status of a scan upload job."""
+    job = UploadJob.get_by_id(job_id)
+    if job is None or job.user_id != current_user.id:
+        abort(404)
+    return jsonify(job.to_dict())
+
+
+@blueprint.route('/<int:scan_id>/preview/<axis>.png', methods=['GET'])
+@login_required
+def preview(scan_id, axis):
+    """Serve a cached mid-slice preview of a scan.
+
+    A scan's previews never change, so browsers may keep them for as long as SCAN_PREVIEW_MAX_AGE.
+    """
+    scan = Scan.get_by_id(scan_id)
+    if scan is None or axis not in AXES or scan.experiment.user_id != current_user.id:
+        abort(404)
+    path = preview_path(preview_folder(), scan.id, axis)
+    if not os.path.exists(path):
+        abort(404)
+    return send_file(path, mimetype='image/png', conditional=True,
+                     cache_timeout=current_app.config.get('SCAN_PREVIEW_MAX_AGE', 365 * 24 * 60 * 60))
+
+
+# Resumable uploads, modeled on the tus protocol (https://tus.io/protocols/resumable-upload.html).  Clients POST the
+# length and name of a file to /uploads, then PATCH chunks to the returned Location with an Upload-Offset header and
+# optionally an Upload-Checksum of "<algorithm> <base64 digest>".  HEAD reports how much has been received, so an
+# interrupted upload can resume.  Like every other POST in the app these requests need the CSRF token, sent as an
+# X-CSRFToken header.
+
+@blueprint.route('/uploads', methods=['POST'])
+@login_required
+def create_upload():
+    """Start a resumable upload."""
+    metadata = _parse_upload_metadata(request.headers.get('Upload-Metadata', ''))
+    try:
+        length = int(request.headers['Upload-Length'])
+    except (KeyError, ValueError):
+        abort(400)
+    if 'filename' not in metadata:
+        abort(400)
+    exp_id = metadata.get('experiment') or str(session.get('curr_experiment'))
+    try:
+        upload = UploadSessionService(current_user.get_id(), exp_id).create(metadata['filename'], length)
+    except UploadSessionError as e:
+        return _upload_error(e)
+    response = _upload_response(upload, 201)
+    response.headers['Location'] = url_for('scan.upload_session', token=upload.token, _external=True)
+    return response
+
+
+@blueprint.route('/uploads/<token>', methods=['HEAD', 'PATCH', 'DELETE'])
+@login_required
+def upload_session(token):
+    """Report the progress of, append a chunk to, or abandon a resumable upload."""
+    upload = UploadSession.query.filter_by(token=token).first()
+    if upload is None or upload.user_id != current_user.id:
+        abort(404)
+    if request.method == 'DELETE':
+        UploadSessionService.terminate(upload)
+        return '', 204
+    if upload.is_expired:
+        return _upload_error(UploadSessionError('Upload session has expired'), code=410)
+    if request.method == 'HEAD':
+        return _upload_response(upload, 200)
+    if request.mimetype != 'application/offset+octet-stream':
+        abort(415)
+    try:
+        offset = int(request.headers['Upload-Offset'])
+    except (KeyError, ValueError):
+        abort(400)
+    checksum = _parse_checksum(request.headers.get('Upload-Checksum'))
+    try:
+        upload = UploadSessionService.append(upload, offset, request.stream, checksum=checksum)
+    except UploadSessionError as e:
+        return _upload_error(e)
+    return _upload_response(upload, 204)
+
+
+def _upload_response(upload, status):
+    response = current_app.response_class(status=status)
+    if status == 204:
+        # A response with no content has no content type
+        del response.headers['Content-Type']
+    response.headers['Tus-Resumable'] = '1.0.0'
+    response.headers['Upload-Offset'] = str(upload.offset)
+    response.headers['Upload-Length'] = str(upload.length)
+    response.headers['Upload-Expires'] = upload.expires_at.strftime('%a, %d %b %Y %H:%M:%S GMT')
+    response.headers['Cache-Control'] = 'no-store'
+    if upload.job_id:
+        response.headers['Upload-Job'] = url_for('scan.job_status', job_id=upload.job_id)
+    return response
+
+
+def _upload_error(error, code=None):
+    response = jsonify(error=str(error))
+    response.status_code = code or error.code
+    response.headers['Tus-Resumable'] = '1.0.0'
+    return response
+
+
+def _parse_upload_metadata(header):
+    """Parse an Upload-Metadata header of comma separated "key base64(value)" pairs."""
+    metadata = {}
+    for pair in filter(None, (p.strip() for p in header.split(','))):
+        key, _, value = pair.partition(' ')
+        try:
+            metadata[key] = base64.b64decode(value).decode('utf-8')
+        except (binascii.Error, UnicodeDecodeError):
+            abort(400)
+    return metadata
+
+
+def _parse_checksum(header):
+    """Parse an Upload-Checksum header into a hashlib algorithm name and a digest."""
+    if not header:
+        return None
+    algorithm, _, value = header.partition(' ')
+    if algorithm not in ('md5', 'sha1', 'sha256'):
+        abort(400)
+    try:
+        return algorithm, base64.b64decode(value)
+    except binascii.Error:
+        abort(400)
@@ -20,7 +20,36 @@ DEBUG_TB_ENABLED = DEBUG
 DEBUG_TB_INTERCEPT_REDIRECTS = False
 CACHE_TYPE = 'simple'  # Can be "memcached", "redis", etc.
 SQLALCHEMY_TRACK_MODIFICATIONS = False
-UPLOAD_FOLDER='/Users/katie/spiro/cookiecutter_mbam/files'
+UPLOAD_FOLDER = env.str('UPLOAD_FOLDER', default='/Users/katie/spiro/cookiecutter_mbam/files')
+EXPERIMENTS_PER_PAGE = env.int('EXPERIMENTS_PER_PAGE', default=20)  # the most experiments listed on a page
+SCAN_GZIP_LEVEL = env.int('SCAN_GZIP_LEVEL', default=6)
+SCAN_GZIP_WORKERS = env.int('SCAN_GZIP_WORKERS', default=4)
+SCAN_JOB_MAX_ATTEMPTS = env.int('SCAN_JOB_MAX_ATTEMPTS', default=5)
+SCAN_JOB_RETRY_DELAY = env.int('SCAN_JOB_RETRY_DELAY', default=30)  # seconds, doubled on each retry
+SCAN_JOB_LEASE = env.int('SCAN_JOB_LEASE', default=2 * 60 * 60)  # seconds a worker may hold a job
+SCAN_UPLOAD_MAX_SIZE = env.int('SCAN_UPLOAD_MAX_SIZE', default=8 * 1024 ** 3)  # bytes, for resumable uploads
+SCAN_UPLOAD_SESSION_TTL = env.int('SCAN_UPLOAD_SESSION_TTL', default=24 * 60 * 60)  # seconds without a chunk
+SCAN_ZIP_MAX_MEMBERS = env.int('SCAN_ZIP_MAX_MEMBERS', default=20000)
+SCAN_ZIP_MAX_UNCOMPRESSED_SIZE = env.int('SCAN_ZIP_MAX_UNCOMPRESSED_SIZE', default=16 * 1024 ** 3)  # bytes
+SCAN_ZIP_MAX_RATIO = env.int('SCAN_ZIP_MAX_RATIO', default=200)  # uncompressed / compressed size
+SCAN_PREVIEW_SIZE = env.int('SCAN_PREVIEW_SIZE', default=256)  # pixels along the longer side
+SCAN_PREVIEW_MAX_AGE = env.int('SCAN_PREVIEW_MAX_AGE', default=365 * 24 * 60 * 60)  # seconds browsers may cache them
+SCAN_QC_WORKERS = env.int('SCAN_QC_WORKERS', default=2)  # processes computing QC metrics, per upload worker
+SCAN_QC_TIMEOUT = env.int('SCAN_QC_TIMEOUT', default=600)  # seconds to wait for QC metrics before storing none
+XNAT_CONFIG_FILE = env.str('XNAT_CONFIG_FILE', default=None)  # setup.cfg at the project root if not set
+XNAT_SERVER = env.str('XNAT_SERVER', default=None)  # these override the [XNAT] and [uploads] sections of the file
+XNAT_USER = env.str('XNAT_USER', default=None)
+XNAT_PASSWORD = env.str('XNAT_PASSWORD', default=None)
+XNAT_PROJECT = env.str('XNAT_PROJECT', default=None)
+XNAT_UPLOAD_DEST = env.str('XNAT_UPLOAD_DEST', default=None)
+XNAT_POOL_SIZE = env.int('XNAT_POOL_SIZE', default=4)  # open XNAT sessions per process
+XNAT_POOL_IDLE_TIMEOUT = env.int('XNAT_POOL_IDLE_TIMEOUT', default=5 * 60)  # seconds before an idle session is closed
+XNAT_POOL_CHECK_INTERVAL = env.int('XNAT_POOL_CHECK_INTERVAL', default=60)  # seconds unused before a health check
+XNAT_POOL_TIMEOUT = env.int('XNAT_POOL_TIMEOUT', default=30)  # seconds to wait for a free session
+XNAT_CACHE_SIZE = env.int('XNAT_CACHE_SIZE', default=10000)  # XNAT objects remembered as existing, per process
+XNAT_CACHE_TTL = env.int('XNAT_CACHE_TTL', default=10 * 60)  # seconds an XNAT object is remembered as existing
+XNAT_RESPONSE_CACHE_SIZE = env.int('XNAT_RESPONSE_CACHE_SIZE', default=1000)  # XNAT GET responses kept to revalidate
+XNAT_UPLOAD_BANDWIDTH = env.int('XNAT_UPLOAD_BANDWIDTH', default=0)  # bytes/s a process may send to XNAT; 0 for no cap
 WEBPACK_MANIFEST_PATH = 'webpack/manifest.json'
 SECURITY_PASSWORD_SALT = 'super-secret-random-salt' # erm, keep out of our repo in real prod version?
 
@@ -13,7 +13,9 @@ from cookiecutter_mbam.extensions import bcrypt
 roles_users = Table(
     'roles_users',
     db.Column('user_id', db.Integer(), db.ForeignKey('users.id')),
-    db.Column('role_id', db.Integer(), db.ForeignKey('roles.id'))
+    db.Column('role_id', db.Integer(), db.ForeignKey('roles.id')),
+    db.UniqueConstraint('user_id', 'role_id', name='uq_roles_users_user_id_role_id'),
+    db.Index('ix_roles_users_role_id', 'role_id'),
 )
 
 class Role(SurrogatePK, Model):
@@ -46,7 +48,8 @@ class User(UserMixin, SurrogatePK, Model):
     last_name = Column(db.String(30), nullable=True)
     active = Column(db.Boolean(), default=False)
     is_admin = Column(db.Boolean(), default=False)
-    xnat_subject_id = Column(db.String(80), nullable=True)
+    xnat_subject_id = Column(db.String(80), nullable=True, index=True)
+    xnat_backend = Column(db.String(80), nullable=True)
     num_experiments = Column(db.Integer(), default=0)
     roles = db.relationship(
         'Role',
@@ -1 +1,3 @@
-from .service import XNATConnection
\ No newline at end of file
+from .service import XNATConnection
+from .protocol import XNATUploadError
+from .config import XNATConfig, load_xnat_config
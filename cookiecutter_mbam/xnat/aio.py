@@ -0,0 +1,205 @@
+# -*- coding: utf-8 -*-
+"""An asyncio XNAT client.
+
+AsyncXNATConnection uploads scans the way XNATConnection does, walking the same hierarchy and consulting the same
+cache of existing objects, but over aiohttp, so one process can keep many uploads and listings in flight at once
+instead of waiting out each round trip in turn.  Within an upload, the existence checks of a plan go together, but its
+PUTs go one after another, since each object needs its parent to exist; most of the concurrency comes from running
+many uploads together with upload_scans.
+
+Connections to the XNAT host are capped at limit_per_host, and files are streamed to XNAT in chunks read on a thread,
+so neither the event loop nor memory is tied up by a large scan.  Uploads report their progress and keep to the
+process's bandwidth cap the way XNATConnection's do (see cookiecutter_mbam.xnat.transfer).
+
+Usage: ::
+
+    async with AsyncXNATConnection() as xc:
+        uris = await xc.upload_scans([(xnat_ids, existing_xnat_ids, image_file, False), ...])
+"""
+import asyncio
+import io
+
+import aiohttp
+from flask import current_app
+
+from .protocol import (import_query, imported_uri, inbody_url, listing_changed_by, listing_rows, upload_steps,
+                       xnat_url)
+from .transfer import CHUNK_SIZE, upload_bucket
+
+
+class AsyncXNATConnection:
+    """Concurrent uploads to XNAT
+
+    :param XNATConfig config: the XNAT configuration; the app's by default
+    :param XNATExistenceCache cache: the cache of XNAT objects known to exist; the app's by default
+    :param XNATResponseCache responses: the cache of XNAT responses to revalidate; the app's by default
+    :param int limit_per_host: the most connections open to the XNAT host at once
+    :param float timeout: seconds a request may take, including streaming its body
+    :param int chunk_size: the number of bytes of a file sent at a time
+    :param TokenBucket bucket: the bandwidth cap; the process's share of XNAT_UPLOAD_BANDWIDTH by default
+    """
+
+    def __init__(self, config=None, cache=None, responses=None, limit_per_host=8, timeout=60 * 60,
+                 chunk_size=CHUNK_SIZE, bucket=None):
+        self.config = config or current_app.config['XNAT']
+        self.cache = cache if cache is not None else current_app.extensions['xnat_cache']
+        self.responses = responses if responses is not None else current_app.extensions['xnat_responses']
+        self.logger = current_app.logger
+        self.limit_per_host = limit_per_host
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.bucket = bucket or upload_bucket(current_app.config.get('XNAT_UPLOAD_BANDWIDTH'))
+        self.session = None
+
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit_per_host=self.limit_per_host),
+            auth=aiohttp.BasicAuth(self.config.user, self.config.password),
+            timeout=aiohttp.ClientTimeout(total=self.timeout),
+            raise_for_status=True,
+        )
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+        self.session = None
+
+    async def _read_chunks(self, file, progress=None):
+        """Stream a file in chunks, reading each on a thread so the event loop isn't blocked on disk."""
+        loop = asyncio.get_running_loop()
+        file.seek(0, io.SEEK_END)
+        size = file.tell()
+        file.seek(0)
+        sent = 0
+        while True:
+            chunk = await loop.run_in_executor(None, file.read, self.chunk_size)
+            if not chunk:
+                return
+            if self.bucket is not None:
+                await asyncio.sleep(self.bucket.delay(len(chunk)))
+            yield chunk
+            sent += len(chunk)
+            if progress is not None:
+                progress(sent, size)
+
+    async def xnat_put(self, url='', file=None, imp=False, progress=None, **kwargs):
+        """Create an XNAT object, upload a file, or send a zip of DICOM files to the import service
+
+        :param str url: a put route in the XNAT URI
+        :param file object file: a file object to upload
+        :param bool imp: whether to use the import service (True if file is zip of dicoms, otherwise False)
+        :param function progress: called with the bytes of the file sent so far and its size as it is sent
+        :param kwargs kwargs: the project, subject and experiment for the import service
+        :return: whether the object was created
+        :rtype: bool
+        """
+        if imp:
+            return await self.xnat_import(file, progress=progress, **kwargs) is not None
+        try:
+            if file is not None:
+                async with self.session.put(xnat_url(self.config.server, inbody_url(url)),
+                                            data=self._read_chunks(file, progress),
+                                            headers={'Content-Type': 'application/octet-stream'}):
+                    pass
+            else:
+                async with self.session.put(xnat_url(self.config.server, url)):
+                    pass
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.logger.exception('XNAT PUT of {} failed'.format(url))
+            return False
+        self.responses.discard(xnat_url(self.config.server, listing_changed_by(url)))
+        return True
+
+    async def xnat_import(self, file, project, subject, experiment, progress=None):
+        """Send a zip of DICOM files to the XNAT import service (see XNATConnection.xnat_import)
+
+        :param file object file: the zip file
+        :param str project: the project to import into
+        :param str subject: the subject to import into
+        :param str experiment: the experiment to import into
+        :param function progress: called with the bytes of the file sent so far and its size as it is sent
+        :return: the URI XNAT archived the experiment at, or None if the import failed
+        :rtype: str
+        """
+        params = import_query(project, subject, experiment)
+        try:
+            async with self.session.post(xnat_url(self.config.server, '/data/services/import'), params=params,
+                                         data=self._read_chunks(file, progress),
+                                         headers={'Content-Type': 'application/zip'}) as response:
+                return imported_uri(await response.text())
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            self.logger.exception('XNAT import of {} failed'.format(params))
+            return None
+
+    async def xnat_get(self, uri, query=None):
+        """Read JSON from XNAT, revalidating the last response from the same URL (see XNATConnection.xnat_get)
+
+        :param str uri: the URI to read
+        :param dict query: the query string's parameters
+        :return: the decoded body, which is shared with the cache and must not be modified, or None if there is
+            nothing at uri
+        :raises aiohttp.ClientError: if XNAT can't be reached or answers with an error
+        """
+        url = xnat_url(self.config.server, uri, query)
+        cached = self.responses.get(url)
+        headers = cached.validators if cached else {}
+        params = dict(query or {}, format='json')
+        async with self.session.get(xnat_url(self.config.server, uri), params=params, headers=headers,
+                                    raise_for_status=False) as response:
+            if response.status == 404:
+                return None
+            response.raise_for_status()
+            if response.status == 304 and cached:
+                return cached.body
+            body = await response.json(content_type=None)
+            self.responses.store(url, body, response.headers)
+            return body
+
+    async def xnat_list(self, uri):
+        """List the members of an XNAT collection
+
+        :param str uri: the collection's URI, e.g. a project's subjects
+        :return: the members' rows from the listing's ResultSet, or None if the collection's parent doesn't exist or
+            the listing failed
+        :rtype: list
+        """
+        try:
+            return listing_rows(await self.xnat_get(uri))
+        except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError):
+            self.logger.exception('XNAT listing of {} failed'.format(uri))
+            return None
+
+    async def upload_scan(self, xnat_ids, existing_xnat_ids, image_file, import_service=False, progress=None):
+        """Upload a scan to XNAT, creating the objects above it that don't exist yet (see XNATConnection.upload_scan)
+
+        Sends the same stages of requests as XNATConnection.upload_scan (see cookiecutter_mbam.xnat.protocol), the
+        requests of each stage together on the event loop.
+
+        :param dict xnat_ids: a dictionary of xnat identifiers and query strings for put urls
+        :param dict existing_xnat_ids: a dictionary of XNAT identifiers that already existed on user and experiment
+        :param file object image_file: the scan file to upload
+        :param bool import_service: whether to use the XNAT import service. True if file is a .zip, default False.
+        :param function progress: called with the bytes of the file sent so far and its size as it is sent
+        :return: three-tuple of the xnat uris for subject, experiment, and scan
+        :rtype: tuple
+        :raises XNATUploadError: if an object or the file couldn't be created, or the import failed or archived no scan
+        """
+        steps = upload_steps(self.config, self.cache, xnat_ids, existing_xnat_ids, image_file,
+                             import_service=import_service, progress=progress, logger=self.logger)
+        answers = None
+        while True:
+            try:
+                stage = steps.send(answers)
+            except StopIteration as stop:
+                return stop.value
+            answers = await asyncio.gather(*(getattr(self, request.method)(*request.args, **request.kwargs)
+                                             for request in stage))
+
+    async def upload_scans(self, uploads):
+        """Upload several scans concurrently
+
+        :param list uploads: tuples of the arguments to upload_scan
+        :return: the uris of each scan, in order, or the exception its upload raised
+        :rtype: list
+        """
+        return await asyncio.gather(*(self.upload_scan(*upload) for upload in uploads), return_exceptions=True)
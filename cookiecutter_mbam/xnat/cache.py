@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+"""Caches of what we know about XNAT.
+
+XNATExistenceCache remembers which objects exist.  XNATConnection.upload_scan consults it before creating a subject,
+experiment, scan or resource, so objects that already exist are not PUT again.  Entries come from successful PUTs and
+from listings of XNAT collections, which seed the cache with every sibling of the object looked for in one request.
+Entries expire after a TTL, since objects can be removed in XNAT behind our back, and the least recently used are
+evicted once the cache is full.
+
+XNATResponseCache keeps the JSON bodies of GETs, with their ETag and Last-Modified validators.  XNATConnection.xnat_get
+sends the validators of a cached body with the next GET of the same URL, and XNAT answers with an empty 304 if the body
+hasn't changed, so rereading a listing costs a round trip but no download.  Entries never go stale, since every read
+is revalidated, but the least recently used are evicted once the cache is full.
+"""
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+
+class XNATExistenceCache:
+    """A bounded set of XNAT URIs with a time to live
+
+    :param Flask app: the app to configure the cache from
+    :param int maxsize: the most URIs to remember
+    :param float ttl: seconds a URI is remembered for
+    :param function clock: returns the time in seconds
+    """
+
+    def __init__(self, app=None, maxsize=10000, ttl=600, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Configure the cache from the app's XNAT_CACHE_SIZE and XNAT_CACHE_TTL settings and register it on the app
+
+        :param Flask app: the app
+        :return: None
+        """
+        self.maxsize = app.config.get('XNAT_CACHE_SIZE', self.maxsize)
+        self.ttl = app.config.get('XNAT_CACHE_TTL', self.ttl)
+        app.extensions['xnat_cache'] = self
+
+    def __contains__(self, uri):
+        with self._lock:
+            expires = self._entries.get(uri)
+            if expires is None:
+                return False
+            if expires < self._clock():
+                del self._entries[uri]
+                return False
+            self._entries.move_to_end(uri)
+            return True
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, uri):
+        """Remember that an object exists
+
+        :param str uri: the object's URI
+        :return: None
+        """
+        self.seed([uri])
+
+    def seed(self, uris):
+        """Remember that several objects exist, e.g. the members of a collection
+
+        :param iterable uris: the objects' URIs
+        :return: None
+        """
+        expires = self._clock() + self.ttl
+        with self._lock:
+            for uri in uris:
+                self._entries[uri] = expires
+                self._entries.move_to_end(uri)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, uri):
+        """Forget an object, e.g. because it was deleted
+
+        :param str uri: the object's URI
+        :return: None
+        """
+        with self._lock:
+            self._entries.pop(uri, None)
+
+    def clear(self):
+        """Forget every object
+
+        :return: None
+        """
+        with self._lock:
+            self._entries.clear()
+
+
+class CachedResponse(namedtuple('CachedResponse', ['body', 'etag', 'last_modified'])):
+    """A response body and the validators XNAT sent with it"""
+
+    @property
+    def validators(self):
+        """The headers that make a GET conditional on the body having changed"""
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class XNATResponseCache:
+    """A bounded map of URLs to the bodies of their last responses
+
+    :param Flask app: the app to configure the cache from
+    :param int maxsize: the most responses to keep
+    """
+
+    def __init__(self, app=None, maxsize=1000):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Configure the cache from the app's XNAT_RESPONSE_CACHE_SIZE setting and register it on the app
+
+        :param Flask app: the app
+        :return: None
+        """
+        self.maxsize = app.config.get('XNAT_RESPONSE_CACHE_SIZE', self.maxsize)
+        app.extensions['xnat_responses'] = self
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, url):
+        """The last response from a URL
+
+        :param str url: the URL, including its query string
+        :return: the response, or None if there is none
+        :rtype: CachedResponse
+        """
+        with self._lock:
+            response = self._entries.get(url)
+            if response is not None:
+                self._entries.move_to_end(url)
+            return response
+
+    def store(self, url, body, headers):
+        """Keep a response, if it came with validators to revalidate it by
+
+        :param str url: the URL, including its query string
+        :param body: the decoded body, which callers must not modify
+        :param dict headers: the response's headers
+        :return: None
+        """
+        response = CachedResponse(body, headers.get('ETag'), headers.get('Last-Modified'))
+        with self._lock:
+            if not response.validators:
+                self._entries.pop(url, None)
+                return
+            self._entries[url] = response
+            self._entries.move_to_end(url)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def discard(self, url):
+        """Forget the response from a URL, e.g. because it was just changed
+
+        :param str url: the URL, including its query string
+        :return: None
+        """
+        with self._lock:
+            self._entries.pop(url, None)
+
+    def clear(self):
+        """Forget every response
+
+        :return: None
+        """
+        with self._lock:
+            self._entries.clear()
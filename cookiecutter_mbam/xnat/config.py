@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""XNAT configuration, read once when the app is created.
+
+Scans go to the XNAT server and project in the [XNAT] section of the config file, the default backend, and to any
+further backends in sections named [XNAT:<name>], whose settings default to those of [XNAT]: ::
+
+    [XNAT]
+    server = https://xnat1.example.org
+    user = admin
+    password = admin
+    project = MBAM
+
+    [XNAT:xnat2]
+    server = https://xnat2.example.org
+
+New subjects are spread over the backends by consistent hashing (see cookiecutter_mbam.xnat.sharding).
+"""
+import configparser
+import os
+from collections import OrderedDict, namedtuple
+
+from flask import current_app
+
+#: The setup.cfg at the root of the project
+DEFAULT_CONFIG_FILE = os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))),
+                                   'setup.cfg')
+
+#: The name of the backend configured by the [XNAT] section
+DEFAULT_BACKEND = 'default'
+
+#: The XNAT server, credentials and project, the URI prefixes of the project in the archive and prearchive, and the
+#: directory files are staged in for the import service
+XNATConfig = namedtuple('XNATConfig', ['server', 'user', 'password', 'project', 'archive_prefix', 'prearchive_prefix',
+                                       'file_dest'])
+
+
+def load_xnat_config(path=DEFAULT_CONFIG_FILE, server=None, user=None, password=None, project=None, file_dest=None,
+                     section='XNAT', parser=None):
+    """Read the XNAT configuration from the [XNAT] and [uploads] sections of a config file
+
+    Any of the settings given as arguments override the file.
+
+    :param str path: the config file
+    :param str server: the XNAT server's URL
+    :param str user: the XNAT user
+    :param str password: the XNAT user's password
+    :param str project: the XNAT project scans are uploaded to
+    :param str file_dest: the directory files are staged in for the import service
+    :param str section: the section to read, e.g. that of another backend; settings it lacks are read from [XNAT]
+    :param ConfigParser parser: the file, if it has been read already
+    :return: the configuration
+    :rtype: XNATConfig
+    """
+    if parser is None:
+        parser = configparser.ConfigParser()
+        parser.read(path)
+    xnat = dict(parser['XNAT']) if parser.has_section('XNAT') else {}
+    if section != 'XNAT' and parser.has_section(section):
+        xnat.update(parser[section])
+    uploads = parser['uploads'] if parser.has_section('uploads') else {}
+    project = project or xnat.get('project')
+    return XNATConfig(
+        server=server or xnat.get('server'),
+        user=user or xnat.get('user'),
+        password=password or xnat.get('password'),
+        project=project,
+        archive_prefix='/data/archive/projects/{}'.format(project),
+        prearchive_prefix='/data/prearchive/projects/{}'.format(project),
+        file_dest=file_dest or uploads.get('uploaded_scans_dest'),
+    )
+
+
+def load_xnat_backends(path=DEFAULT_CONFIG_FILE, **overrides):
+    """Read the configuration of every XNAT backend from a config file
+
+    :param str path: the config file
+    :param overrides: settings that override the file's for the default backend (see load_xnat_config)
+    :return: the configuration of each backend by name, the default first
+    :rtype: OrderedDict
+    """
+    parser = configparser.ConfigParser()
+    parser.read(path)
+    backends = OrderedDict([(DEFAULT_BACKEND, load_xnat_config(path, parser=parser, **overrides))])
+    for section in parser.sections():
+        if section.startswith('XNAT:'):
+            backends[section[len('XNAT:'):]] = load_xnat_config(path, section=section, parser=parser)
+    return backends
+
+
+def backend_names():
+    """The names of the app's XNAT backends, the default first
+
+    :return: the names
+    :rtype: tuple
+    """
+    return tuple(current_app.config.get('XNAT_BACKENDS') or (DEFAULT_BACKEND,))
+
+
+def backend_config(name=DEFAULT_BACKEND):
+    """The configuration of one of the app's XNAT backends
+
+    The default backend's is XNAT, so that overriding XNAT overrides it.
+
+    :param str name: the backend's name
+    :return: the configuration
+    :rtype: XNATConfig
+    :raises KeyError: if there is no such backend
+    """
+    if name == DEFAULT_BACKEND:
+        return current_app.config['XNAT']
+    return current_app.config['XNAT_BACKENDS'][name]
+
+
+def init_app(app):
+    """Load the XNAT configuration into the app's config, from XNAT_CONFIG_FILE and the XNAT_* settings
+
+    Every backend's configuration is XNAT_BACKENDS, by name, and the default backend's is also XNAT.
+
+    :param Flask app: the app
+    :return: None
+    """
+    config = app.config
+    config['XNAT_BACKENDS'] = load_xnat_backends(config.get('XNAT_CONFIG_FILE') or DEFAULT_CONFIG_FILE,
+                                                 server=config.get('XNAT_SERVER'), user=config.get('XNAT_USER'),
+                                                 password=config.get('XNAT_PASSWORD'),
+                                                 project=config.get('XNAT_PROJECT'),
+                                                 file_dest=config.get('XNAT_UPLOAD_DEST'))
+    config['XNAT'] = config['XNAT_BACKENDS'][DEFAULT_BACKEND]
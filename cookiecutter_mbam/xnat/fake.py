@@ -0,0 +1,420 @@
+# -*- coding: utf-8 -*-
+"""A fake XNAT server, for tests and benchmarks.
+
+FakeXNAT serves, from memory, the parts of XNAT's REST API the app uses: logging in, creating subjects, experiments,
+scans and resources with PUTs under /data/archive/projects, uploading files into resources, the import service, and
+JSON listings of every collection, with ETags for conditional GETs.  It runs on a thread of the calling process, so
+XNATConnection and ScanService can be exercised and timed against it with nothing else installed.
+
+Latency, bandwidth and errors can be injected to see how uploads behave over a slow or unreliable link: every request
+is held for ``latency`` seconds, request and response bodies move at ``bandwidth`` bytes per second, and a request
+fails with a 503 with probability ``error_rate``, or with any status for the next requests queued with fail().
+
+Usage: ::
+
+    with FakeXNAT(latency=0.05, bandwidth=10 * 1024 ** 2) as xnat:
+        xc = XNATConnection(app.config['XNAT']._replace(server=xnat.url))
+
+Or, to serve on a port until interrupted: ::
+
+    python -m cookiecutter_mbam.xnat.fake --port 8080 --latency 0.05
+"""
+import base64
+import hashlib
+import json
+import posixpath
+import random
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+#: The collections of the archive, from the top down, and the object type created in each
+COLLECTIONS = {'projects': 'xnat:projectData', 'subjects': 'xnat:subjectData', 'experiments': 'xnat:mrSessionData',
+               'scans': 'xnat:mrScanData', 'resources': 'xnat:resourceCatalog', 'files': None}
+
+#: The levels XNAT creates when a PUT is made to the level below them, keyed by the level below
+IMPLICIT_PARENTS = {'experiments': 'subjects', 'files': 'resources'}
+
+#: The number of bytes moved between checks of the bandwidth
+BLOCK_SIZE = 64 * 1024
+
+
+class FakeXNAT:
+    """An in-memory XNAT served over HTTP on a thread
+
+    :param tuple projects: the ids of the projects that exist
+    :param dict users: passwords by user name
+    :param float latency: seconds every request is held before it is answered
+    :param float bandwidth: bytes per second request and response bodies are moved at, per connection; unlimited if
+        None
+    :param float error_rate: the probability that a request fails with a 503
+    :param int seed: seeds the choice of the requests that fail
+    :param int port: the port to listen on; any free port if 0
+    """
+
+    def __init__(self, projects=('MBAM_TEST',), users=None, latency=0.0, bandwidth=None, error_rate=0.0, seed=0,
+                 port=0):
+        self.users = users or {'admin': 'admin'}
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.error_rate = error_rate
+        self.objects = {posixpath.join('/data/archive/projects', project): {} for project in projects}
+        self.files = {}
+        #: The method and path of every request
+        self.requests = []
+        #: The number of requests being served, and the most there have been at once
+        self.in_flight = self.most_in_flight = 0
+        self.sessions = set()
+        self._failures = []
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), _handler(self))
+        self._server.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        """The server's URL"""
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        """Serve requests on a thread
+
+        :return: the server
+        :rtype: FakeXNAT
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close the socket
+
+        :return: None
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def fail(self, count=1, status=500, method=None):
+        """Make the next requests fail
+
+        :param int count: the number of requests to fail
+        :param int status: the status to answer them with
+        :param str method: fail only requests with this method, e.g. 'PUT'
+        :return: None
+        """
+        with self._lock:
+            self._failures.extend([(status, method)] * count)
+
+    def count(self, method=None, prefix=''):
+        """The number of requests made
+
+        :param str method: count only requests with this method
+        :param str prefix: count only requests to paths starting with this
+        :return: the number of requests
+        :rtype: int
+        """
+        return sum(1 for m, path in self.requests if (method is None or m == method) and path.startswith(prefix))
+
+    def _injected_failure(self, method):
+        with self._lock:
+            for i, (status, only) in enumerate(self._failures):
+                if only is None or only == method:
+                    del self._failures[i]
+                    return status
+            if self.error_rate and self._random.random() < self.error_rate:
+                return 503
+        return None
+
+    # The archive
+
+    def exists(self, uri):
+        """Whether an object exists
+
+        :param str uri: the object's URI under /data/archive
+        :return: whether it exists
+        :rtype: bool
+        """
+        return uri in self.objects or uri in self.files
+
+    def create(self, uri, attributes=None):
+        """Create an object, and the parents XNAT would create along with it
+
+        :param str uri: the object's URI under /data/archive
+        :param dict attributes: the object's fields, from the query string of its PUT
+        :return: the status XNAT would answer the PUT with
+        :rtype: int
+        """
+        parent = posixpath.dirname(posixpath.dirname(uri))
+        collection = posixpath.basename(posixpath.dirname(uri))
+        if collection not in COLLECTIONS or collection == 'projects':
+            return 404
+        with self._lock:
+            if parent not in self.objects:
+                grandparent = posixpath.dirname(posixpath.dirname(parent))
+                if IMPLICIT_PARENTS.get(collection) != posixpath.basename(posixpath.dirname(parent)) or \
+                        grandparent not in self.objects:
+                    return 404
+                self.objects[parent] = {}
+            if collection == 'files':
+                self.files[uri] = (attributes or {}).pop('content', b'')
+            else:
+                self.objects.setdefault(uri, {}).update(attributes or {})
+        return 200
+
+    def members(self, collection):
+        """The ids of the members of a collection, or None if its parent doesn't exist"""
+        parent = posixpath.dirname(collection)
+        if parent not in self.objects or posixpath.basename(collection) not in COLLECTIONS:
+            return None
+        store = self.files if posixpath.basename(collection) == 'files' else self.objects
+        return sorted(posixpath.basename(uri) for uri in list(store) if posixpath.dirname(uri) == collection)
+
+    def listing(self, collection):
+        """The rows of a collection's listing, or None if its parent doesn't exist
+
+        A project's experiments are listed along with the subjects they belong to, as XNAT lists them.
+        """
+        parent = posixpath.dirname(collection)
+        if posixpath.basename(collection) == 'experiments' and posixpath.basename(posixpath.dirname(parent)) == \
+                'projects':
+            if parent not in self.objects:
+                return None
+            subjects = parent + '/subjects/'
+            experiments = sorted(uri for uri in list(self.objects) if uri.startswith(subjects)
+                                 if posixpath.basename(posixpath.dirname(uri)) == 'experiments')
+            return [{'ID': posixpath.basename(uri), 'label': posixpath.basename(uri), 'URI': uri,
+                     'subject_ID': posixpath.basename(posixpath.dirname(posixpath.dirname(uri))),
+                     'subject_label': posixpath.basename(posixpath.dirname(posixpath.dirname(uri)))}
+                    for uri in experiments]
+        members = self.members(collection)
+        if members is None:
+            return None
+        return [{'ID': id, 'label': id, 'URI': posixpath.join(collection, id)} for id in members]
+
+    def import_zip(self, project, subject, session, content):
+        """Archive a zip of DICOM files as the next scan of an experiment, the way the import service does
+
+        :return: the experiment's URI
+        :rtype: str
+        """
+        experiment = '/data/archive/projects/{}/subjects/{}/experiments/{}'.format(project, subject, session)
+        with self._lock:
+            if posixpath.join('/data/archive/projects', project) not in self.objects:
+                return None
+            self.objects.setdefault(posixpath.dirname(posixpath.dirname(experiment)), {})
+            self.objects.setdefault(experiment, {})
+            numbers = [int(id) for id in self.members(experiment + '/scans') if id.isdigit()]
+            scan = '{}/scans/{}'.format(experiment, max(numbers, default=0) + 1)
+            self.objects[scan] = {'xsiType': 'xnat:mrScanData'}
+            self.objects[scan + '/resources/DICOM'] = {}
+            self.files[scan + '/resources/DICOM/files/dicoms.zip'] = content
+        return experiment
+
+
+def _handler(xnat):
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            self._handle('GET')
+
+        def do_PUT(self):
+            self._handle('PUT')
+
+        def do_POST(self):
+            self._handle('POST')
+
+        def do_DELETE(self):
+            self._handle('DELETE')
+
+        def _handle(self, method):
+            with xnat._lock:
+                xnat.in_flight += 1
+                xnat.most_in_flight = max(xnat.most_in_flight, xnat.in_flight)
+            self._served = False
+            try:
+                self._route(method)
+            finally:
+                self._done()
+
+        def _done(self):
+            # Called before the last byte of the response is sent, so a client that has its answer, and sends its next
+            # request on a new connection, can't find this one still counted
+            if not self._served:
+                self._served = True
+                with xnat._lock:
+                    xnat.in_flight -= 1
+
+        def _route(self, method):
+            url = urlsplit(self.path)
+            path, query = url.path.rstrip('/') or '/', dict(parse_qsl(url.query))
+            body = self._read_body()
+            xnat.requests.append((method, path))
+            if xnat.latency:
+                time.sleep(xnat.latency)
+            failure = xnat._injected_failure(method)
+            if failure:
+                return self._respond(failure, 'Injected failure')
+            if path in ('/', '/data/JSESSION', '/data/auth', '/data/services/auth'):
+                return self._session(method, path, body)
+            if not self._authenticated():
+                return self._respond(401, 'Login attempt failed. Please try again.')
+            if path in ('/xapi/siteConfig/buildInfo', '/data/version'):
+                return self._respond(200, {'version': '1.7.5', 'buildNumber': '1'})
+            if path == '/data/services/import' and method == 'POST':
+                experiment = xnat.import_zip(query.get('project'), query.get('subject'), query.get('session'), body)
+                return self._respond(200, experiment + '\r\n') if experiment else self._respond(404, 'No project')
+            if path.startswith('/data/projects/'):
+                # XNAT serves the archive under /data as well as /data/archive
+                path = '/data/archive' + path[len('/data'):]
+            if not path.startswith('/data/archive/projects/'):
+                return self._respond(404, 'Not found')
+            if method == 'PUT':
+                attributes = {key: value for key, value in query.items() if key != 'inbody'}
+                if posixpath.basename(posixpath.dirname(path)) == 'files':
+                    attributes['content'] = body
+                status = xnat.create(path, attributes)
+                return self._respond(status, '' if status == 200 else 'Not found')
+            if method == 'GET':
+                return self._read(path)
+            return self._respond(405, 'Method not allowed')
+
+        def _session(self, method, path, body):
+            if method == 'DELETE':
+                xnat.sessions.discard(self._cookie())
+                return self._respond(200, '')
+            if path == '/':
+                return self._respond(200, '<html>XNAT</html>')
+            if path == '/data/services/auth':
+                form = dict(parse_qsl(body.decode()))
+                if xnat.users.get(form.get('username')) != form.get('password'):
+                    return self._respond(401, '<h3>Login attempt failed. Please try again.</h3>')
+                self._user = form['username']
+            elif not self._authenticated():
+                return self._respond(401, 'Login attempt failed. Please try again.')
+            if path == '/data/auth':
+                return self._respond(200, "User '{}' is logged in".format(self._user or 'admin'))
+            session = self._cookie() if self._cookie() in xnat.sessions else str(uuid.uuid4()).upper()
+            xnat.sessions.add(session)
+            return self._respond(200, session, cookie=session)
+
+        def _authenticated(self):
+            self._user = None
+            header = self.headers.get('Authorization', '')
+            if header.startswith('Basic '):
+                user, _, password = base64.b64decode(header[6:]).decode().partition(':')
+                self._user = user
+                return xnat.users.get(user) == password
+            return self._cookie() in xnat.sessions
+
+        def _cookie(self):
+            for cookie in self.headers.get('Cookie', '').split(';'):
+                name, _, value = cookie.strip().partition('=')
+                if name == 'JSESSIONID':
+                    return value
+            return None
+
+        def _read(self, path):
+            if path in xnat.files:
+                return self._respond(200, xnat.files[path], content_type='application/octet-stream')
+            if path in xnat.objects:
+                level = posixpath.basename(posixpath.dirname(path))
+                item = {'meta': {'isHistory': False, 'xsi:type': COLLECTIONS[level]},
+                        'data_fields': dict(xnat.objects[path], ID=posixpath.basename(path),
+                                            label=posixpath.basename(path))}
+                return self._respond(200, {'items': [item]})
+            rows = xnat.listing(path)
+            if rows is None:
+                return self._respond(404, 'Not found')
+            listing = {'ResultSet': {'Result': rows, 'totalRecords': str(len(rows))}}
+            etag = '"{}"'.format(hashlib.md5(json.dumps(listing, sort_keys=True).encode()).hexdigest())
+            if self.headers.get('If-None-Match') == etag:
+                return self._respond(304, b'', etag=etag)
+            return self._respond(200, listing, etag=etag)
+
+        def _read_body(self):
+            if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+                chunks = []
+                while True:
+                    size = int(self.rfile.readline().split(b';')[0], 16)
+                    if not size:
+                        self.rfile.readline()
+                        break
+                    chunks.append(self._throttled_read(size))
+                    self.rfile.readline()
+                return b''.join(chunks)
+            return self._throttled_read(int(self.headers.get('Content-Length') or 0))
+
+        def _throttled_read(self, size):
+            blocks = []
+            while size:
+                block = self.rfile.read(min(size, BLOCK_SIZE))
+                if not block:
+                    break
+                blocks.append(block)
+                size -= len(block)
+                self._throttle(len(block))
+            return b''.join(blocks)
+
+        def _throttle(self, size):
+            if xnat.bandwidth:
+                time.sleep(size / xnat.bandwidth)
+
+        def _respond(self, status, body, content_type=None, etag=None, cookie=None):
+            if isinstance(body, (dict, list)):
+                body, content_type = json.dumps(body).encode(), 'application/json'
+            elif isinstance(body, str):
+                body = body.encode()
+            self.send_response(status)
+            self.send_header('Content-Type', content_type or 'text/plain')
+            self.send_header('Content-Length', str(len(body)) if status != 304 else '0')
+            if etag:
+                self.send_header('ETag', etag)
+            if cookie:
+                self.send_header('Set-Cookie', 'JSESSIONID={}; Path=/'.format(cookie))
+            if status == 304 or not body:
+                self._done()
+                self.end_headers()
+                return
+            self.end_headers()
+            for i in range(0, len(body), BLOCK_SIZE):
+                if i + BLOCK_SIZE >= len(body):
+                    self._done()
+                self.wfile.write(body[i:i + BLOCK_SIZE])
+                self._throttle(len(body[i:i + BLOCK_SIZE]))
+
+    return Handler
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--project', action='append', dest='projects')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds every request is held')
+    parser.add_argument('--bandwidth', type=float, help='bytes per second bodies are moved at')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='the probability a request fails')
+    args = parser.parse_args()
+    server = FakeXNAT(projects=tuple(args.projects or ['MBAM_TEST']), latency=args.latency, bandwidth=args.bandwidth,
+                      error_rate=args.error_rate, port=args.port)
+    print('Serving a fake XNAT at {}'.format(server.url))
+    try:
+        server._server.serve_forever()
+    except KeyboardInterrupt:
+        server._server.server_close()
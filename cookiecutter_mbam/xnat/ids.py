@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -*-
+"""Allocation of the labels of new XNAT subjects, experiments and scans.
+
+Experiments are numbered per subject and scans per experiment, from sequences kept in the xnat_id_sequences table, so
+two uploads can't be given the same label however many workers and processes run them.  A range of numbers is reserved
+in one statement, which lets bulk imports claim the labels of many objects at once:
+
+* On Postgres, an upsert with RETURNING both creates a missing sequence and reserves from it, on a connection of its
+  own in autocommit mode, so the sequence's row is locked only for the statement and a failed upload can't hand its
+  numbers out again.  Like a Postgres sequence, numbers reserved by an upload that fails are skipped.
+* Elsewhere, the sequence is updated and read back in the session's transaction.  SQLite locks the whole database for
+  the first write of a transaction, so nothing can reserve from the sequence in between.
+
+A sequence starts after a floor, the count of objects labelled before it existed, so that it doesn't hand out the
+labels they were given.  Subjects are labelled with their user's id, which the database already allocates.
+
+An experiment's label is reserved once, when the experiment is added, and kept on it until its first upload creates it
+in XNAT, so every upload to it uses the same label.
+"""
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.orm.attributes import set_committed_value
+
+from cookiecutter_mbam.database import db, in_transaction
+from .models import XNATIdSequence
+
+
+def reserve(name, count=1, floor=None):
+    """Reserve consecutive numbers from a sequence, creating it if it doesn't exist
+
+    :param str name: the name of the sequence
+    :param int count: how many numbers to reserve
+    :param function floor: returns the number the sequence starts after; only called if it doesn't exist yet
+    :return: the numbers reserved
+    :rtype: range
+    :raises ValueError: if count is less than one
+    """
+    if count < 1:
+        raise ValueError('Reserve at least one number, not {}'.format(count))
+    table = XNATIdSequence.__table__
+    update = table.update().where(table.c.name == name).values(last_value=table.c.last_value + count)
+    if db.engine.dialect.name == 'postgresql':
+        with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as connection:
+            last = connection.execute(update.returning(table.c.last_value)).scalar()
+            if last is None:
+                upsert = insert(table).values(name=name, last_value=(floor() if floor else 0) + count)
+                upsert = upsert.on_conflict_do_update(index_elements=[table.c.name],
+                                                      set_={'last_value': table.c.last_value + count})
+                last = connection.execute(upsert.returning(table.c.last_value)).scalar()
+    else:
+        connection = db.session.connection()
+        if not connection.execute(update).rowcount:
+            connection.execute(table.insert().values(name=name, last_value=(floor() if floor else 0) + count))
+        last = connection.execute(db.select([table.c.last_value]).where(table.c.name == name)).scalar()
+    return range(last - count + 1, last + 1)
+
+
+def subject_label(user_id):
+    """The XNAT label of a user's subject
+
+    :param int user_id: the user's id
+    :return: the label
+    :rtype: str
+    """
+    return str(user_id).zfill(6)
+
+
+def experiment_labels(user, count=1):
+    """Reserve the XNAT labels of new experiments of a user's
+
+    Call it before the new experiments are counted in the user's num_experiments, which the user's sequence starts
+    after.
+
+    :param User user: the user
+    :param int count: how many labels to reserve
+    :return: the labels
+    :rtype: list
+    """
+    subject = subject_label(user.id)
+    numbers = reserve('users/{}/experiments'.format(user.id), count, floor=lambda: user.num_experiments or 0)
+    return ['{}_MR{}'.format(subject, number) for number in numbers]
+
+
+def experiment_label(experiment):
+    """The XNAT label reserved for an experiment, reserving one if it was added without
+
+    The label is only set on the experiment if no other upload has set one first, and is committed straight away
+    outside a db_transaction block, so concurrent uploads agree on it.
+
+    :param Experiment experiment: the experiment
+    :return: the label
+    :rtype: str
+    """
+    if not experiment.xnat_label:
+        model = type(experiment)
+        model.query.filter_by(id=experiment.id, xnat_label=None).update(
+            {'xnat_label': experiment_labels(experiment.user)[0]}, synchronize_session=False)
+        label = db.session.query(model.xnat_label).filter_by(id=experiment.id).scalar()
+        set_committed_value(experiment, 'xnat_label', label)
+        if not in_transaction():
+            db.session.commit()
+    return experiment.xnat_label
+
+
+def scan_labels(experiment, count=1):
+    """Reserve the XNAT labels of new scans in an experiment
+
+    :param Experiment experiment: the experiment
+    :param int count: how many labels to reserve
+    :return: the labels
+    :rtype: list
+    """
+    numbers = reserve('experiments/{}/scans'.format(experiment.id), count, floor=lambda: experiment.num_scans or 0)
+    return ['T1_{}'.format(number) for number in numbers]
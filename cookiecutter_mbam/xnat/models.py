@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+"""XNAT models."""
+from cookiecutter_mbam.database import Column, Model, db
+
+
+class XNATIdSequence(Model):
+    """A named sequence that XNAT labels are numbered from (see cookiecutter_mbam.xnat.ids)."""
+
+    __tablename__ = 'xnat_id_sequences'
+    name = Column(db.String(120), primary_key=True)
+    #: The last number reserved
+    last_value = Column(db.BigInteger(), nullable=False, default=0)
+
+    def __repr__(self):
+        """Represent instance as a unique string."""
+        return '<XNATIdSequence({name}, {last_value})>'.format(name=self.name, last_value=self.last_value)
@@ -0,0 +1,159 @@
+# -*- coding: utf-8 -*-
+"""Plans of the requests that upload a scan to XNAT.
+
+Walking down the hierarchy one level at a time makes every request wait on the one before it: a listing to learn
+whether an object exists, then a PUT if it doesn't, for each of subject, experiment, scan and resource, and then the
+file.  plan_upload works the requests out up front instead, as stages whose requests don't depend on each other:
+
+* Objects known to exist, from the database or the app's cache, are neither checked nor PUT.
+* XNAT creates the subject of an experiment, and the resource of a file, when they don't exist yet.  A subject or
+  resource with nothing to set on it is never checked or PUT; it is created, if need be, along with its child.
+* The remaining existence checks are listings that don't depend on each other, so they make up the first stage.  A
+  listing under a parent that doesn't exist fails, which is read as the object not existing either.
+* The PUTs follow, one stage each, since every object needs its parent to exist.
+
+cookiecutter_mbam.xnat.protocol.upload_steps turns a plan into stages of requests, which XNATConnection and
+AsyncXNATConnection send together, waiting for all of a stage's requests before starting the next.
+"""
+import posixpath
+from collections import namedtuple
+
+#: The levels of the XNAT hierarchy a scan file is uploaded through
+XNAT_HIERARCHY = ['subject', 'experiment', 'scan', 'resource', 'file']
+
+
+def walk_hierarchy(prefix, xnat_ids, existing_xnat_ids, import_service=False):
+    """Walk down the XNAT hierarchy to a scan file
+
+    The import service creates the scan, resource and file itself, so only the subject and experiment are walked for
+    zip files.
+
+    :param str prefix: the project's URI in the archive or prearchive
+    :param dict xnat_ids: a dictionary of xnat identifiers and query strings for put urls
+    :param dict existing_xnat_ids: a dictionary of XNAT identifiers that already existed on user and experiment
+    :param bool import_service: whether the file goes to the import service
+    :return: a generator of (level, uri, query string, whether the object is known to exist) for each level
+    :rtype: generator
+    """
+    uri = prefix
+    for level in XNAT_HIERARCHY[:-3] if import_service else XNAT_HIERARCHY:
+        id = 'xnat_{}_id'.format(level)
+        exists_already = bool(existing_xnat_ids.get(id))
+        uri = posixpath.join(uri, level + 's', existing_xnat_ids[id] if exists_already else xnat_ids[level]['xnat_id'])
+        yield level, uri, xnat_ids[level].get('query_string', ''), exists_already
+
+
+#: The levels XNAT creates when a request is made to the level below them, keyed by the level below
+IMPLICIT_PARENTS = {'experiment': 'subject', 'file': 'resource'}
+
+#: A PUT in a plan, and the uris of the objects it creates implicitly
+PlannedPut = namedtuple('PlannedPut', ['level', 'uri', 'query', 'implicit'])
+
+
+def plan_upload(prefix, xnat_ids, existing_xnat_ids, known=None, import_service=False):
+    """Plan the requests that upload a scan
+
+    :param str prefix: the project's URI in the archive or prearchive
+    :param dict xnat_ids: a dictionary of xnat identifiers and query strings for put urls
+    :param dict existing_xnat_ids: a dictionary of XNAT identifiers that already existed on user and experiment
+    :param function known: called with an object's uri, whether it is known to exist, e.g. from a cache
+    :param bool import_service: whether the file goes to the import service
+    :return: the plan
+    :rtype: UploadPlan
+    """
+    known = known or (lambda uri: False)
+    steps = [(level, uri, query, exists_already or (level != 'file' and known(uri)))
+             for level, uri, query, exists_already in walk_hierarchy(prefix, xnat_ids, existing_xnat_ids,
+                                                                     import_service=import_service)]
+    return UploadPlan(steps)
+
+
+class UploadPlan:
+    """The requests that upload a scan, in stages
+
+    :param list steps: four-tuples of level, uri, query string and whether the object is known to exist, from the top
+        of the hierarchy down
+    """
+
+    def __init__(self, steps):
+        self.steps = steps
+        self.uris = {level: uri for level, uri, _, _ in steps}
+        levels = [level for level, _, _, _ in steps]
+        self._implicit = {}
+        for level, uri, query, exists in steps:
+            child = next((c for c, parent in IMPLICIT_PARENTS.items() if parent == level), None)
+            if not query and child in levels:
+                self._implicit[level] = child
+        #: The uris of the objects whose existence must be checked, all in the first stage
+        self.checks = [uri for level, uri, _, exists in steps
+                       if not exists and level != 'file' and level not in self._implicit]
+
+    def puts(self, found=()):
+        """The PUTs that create what doesn't exist and upload the file, in order
+
+        :param set found: the uris of the checked objects that turned out to exist
+        :return: the PUTs
+        :rtype: list
+        """
+        puts = []
+        implicit = []
+        parent_is_new = False
+        for level, uri, query, exists in self.steps:
+            if level in self._implicit:
+                implicit.append(uri)
+                continue
+            if level != 'file' and not parent_is_new and (exists or uri in found):
+                implicit = []
+                continue
+            puts.append(PlannedPut(level, uri, query, tuple(implicit)))
+            implicit = []
+            parent_is_new = True
+        return puts
+
+    def stages(self, found=()):
+        """The plan's requests in stages, each of which can be sent together
+
+        :param set found: the uris of the checked objects that turned out to exist
+        :return: lists of ('GET', uri) checks and PlannedPuts
+        :rtype: list
+        """
+        stages = [[('GET', uri) for uri in self.checks]] if self.checks else []
+        return stages + [[put] for put in self.puts(found)]
+
+    def walked_requests(self, found=()):
+        """The number of requests walking the hierarchy one level at a time would have made
+
+        :param set found: the uris of the checked objects that turned out to exist
+        :return: the number of requests, every one of them a sequential round trip
+        :rtype: int
+        """
+        requests = 0
+        parent_is_new = False
+        for level, uri, query, exists in self.steps:
+            if level == 'file':
+                requests += 1
+            elif exists:
+                parent_is_new = False
+            elif parent_is_new:
+                requests += 1
+            else:
+                # A listing, and a PUT if the object wasn't in it.  The plan never checks a parent XNAT creates
+                # implicitly, so one is taken to have existed, which can only understate what the plan saves.
+                exists = uri in found or level in self._implicit
+                requests += 1 if exists else 2
+                parent_is_new = not exists
+        return requests
+
+    def report(self, found=()):
+        """How much the plan saves over walking the hierarchy one level at a time
+
+        :param set found: the uris of the checked objects that turned out to exist
+        :return: the number of requests and sequential round trips the plan makes, and the requests and round trips it
+            saves
+        :rtype: dict
+        """
+        stages = self.stages(found)
+        walked = self.walked_requests(found)
+        requests = sum(len(stage) for stage in stages)
+        return {'requests': requests, 'round_trips': len(stages),
+                'requests_saved': walked - requests, 'round_trips_saved': walked - len(stages)}
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+"""A pool of authenticated XNAT sessions.
+
+Logging in to XNAT costs a TLS handshake and an authentication round trip, and uploading a scan takes up to five
+requests.  The pool keeps sessions open between requests, so their HTTP connections are kept alive and their JSESSION
+cookies reused, and hands them out to XNATConnection one at a time.
+
+Each process has a pool of its own: sessions opened before a fork are dropped, not shared, in the child.  A session
+that has sat idle for longer than XNAT_POOL_IDLE_TIMEOUT is closed, and one that hasn't been used for
+XNAT_POOL_CHECK_INTERVAL is checked with a GET of /data/JSESSION before it is handed out.  If a call on a session fails
+and the session turns out to have expired, it is replaced by a freshly authenticated one and the call is made again.
+"""
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import xnat
+
+
+class XNATPoolExhausted(Exception):
+    """No XNAT session became free before the timeout."""
+
+
+class _PooledSession:
+    """An open session and when it was last used and last known to be healthy."""
+
+    def __init__(self, key, session):
+        self.key = key
+        self.session = session
+        self.last_used = self.last_checked = time.monotonic()
+
+
+class XNATSessionPool:
+    """Per-process pools of open XNAT sessions, one for each server and user
+
+    Configured from the app with init_app, after which XNATConnection borrows from it through
+    ``current_app.extensions['xnat_pool']``.
+
+    :param Flask app: the app to configure the pool from
+    :param function connect: opens a session given server, user and password; xnat.connect by default
+    """
+
+    def __init__(self, app=None, connect=None):
+        self.size = 4
+        self.idle_timeout = 300
+        self.check_interval = 60
+        self.timeout = 30
+        self._connect = connect or xnat.connect
+        self._condition = threading.Condition()
+        self._reset()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        """Configure the pool from the app's XNAT_POOL_* settings and register it on the app
+
+        :param Flask app: the app
+        :return: None
+        """
+        self.size = app.config.get('XNAT_POOL_SIZE', self.size)
+        self.idle_timeout = app.config.get('XNAT_POOL_IDLE_TIMEOUT', self.idle_timeout)
+        self.check_interval = app.config.get('XNAT_POOL_CHECK_INTERVAL', self.check_interval)
+        self.timeout = app.config.get('XNAT_POOL_TIMEOUT', self.timeout)
+        app.extensions['xnat_pool'] = self
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = {}
+        self._open = {}
+
+    @contextmanager
+    def session(self, server, user, password):
+        """Borrow a session, returning it to the pool afterwards
+
+        If the body raises, the session is checked, and closed rather than returned if it is no longer usable.
+
+        :param str server: the XNAT server's URL
+        :param str user: the user to authenticate as
+        :param str password: the user's password
+        :return: an authenticated xnatpy session
+        :rtype: xnat.session.XNATSession
+        """
+        entry = self._acquire((server, user, password))
+        try:
+            yield entry.session
+        except Exception:
+            self._release(entry, discard=not self._is_healthy(entry))
+            raise
+        self._release(entry)
+
+    def run(self, func, server, user, password):
+        """Call func with a borrowed session, re-authenticating and calling it again if the session had expired
+
+        func may be called twice, so it must be safe to repeat.
+
+        :param function func: called with the session
+        :param str server: the XNAT server's URL
+        :param str user: the user to authenticate as
+        :param str password: the user's password
+        :return: what func returns
+        """
+        entry = self._acquire((server, user, password))
+        try:
+            result = func(entry.session)
+        except Exception:
+            if self._is_healthy(entry):
+                self._release(entry)
+                raise
+            self._release(entry, discard=True)
+            with self.session(server, user, password) as session:
+                return func(session)
+        self._release(entry)
+        return result
+
+    def _acquire(self, key):
+        with self._condition:
+            if os.getpid() != self._pid:
+                # The sockets belong to the parent process
+                self._reset()
+            stale = self._take_stale()
+            deadline = time.monotonic() + self.timeout
+            while True:
+                idle = self._idle.get(key)
+                if idle:
+                    entry = idle.pop()
+                    break
+                if self._open.get(key, 0) < self.size:
+                    self._open[key] = self._open.get(key, 0) + 1
+                    entry = None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise XNATPoolExhausted('All {} XNAT sessions for {} are in use'.format(self.size, key[1]))
+                self._condition.wait(remaining)
+        for session in stale:
+            _disconnect(session)
+        if entry is not None:
+            if time.monotonic() - entry.last_checked < self.check_interval or self._is_healthy(entry):
+                return entry
+            self._close(entry)
+        try:
+            return _PooledSession(key, self._connect(*key))
+        except Exception:
+            with self._condition:
+                self._open[key] -= 1
+                self._condition.notify()
+            raise
+
+    def _release(self, entry, discard=False):
+        if discard:
+            self._close(entry)
+            return
+        entry.last_used = time.monotonic()
+        with self._condition:
+            if os.getpid() == self._pid:
+                self._idle.setdefault(entry.key, []).append(entry)
+                self._condition.notify()
+
+    def _close(self, entry):
+        _disconnect(entry.session)
+        with self._condition:
+            if os.getpid() == self._pid:
+                self._open[entry.key] -= 1
+                self._condition.notify()
+
+    def _is_healthy(self, entry):
+        """Whether a session is still authenticated, by asking XNAT for its JSESSION id."""
+        try:
+            entry.session.get('/data/JSESSION')
+        except Exception:
+            return False
+        entry.last_checked = time.monotonic()
+        return True
+
+    def _take_stale(self):
+        """Remove the sessions that have been idle for longer than the idle timeout; called with the lock held."""
+        cutoff = time.monotonic() - self.idle_timeout
+        stale = []
+        for key, idle in self._idle.items():
+            expired = [entry.session for entry in idle if entry.last_used < cutoff]
+            idle[:] = [entry for entry in idle if entry.last_used >= cutoff]
+            self._open[key] -= len(expired)
+            stale.extend(expired)
+        return stale
+
+    def close(self):
+        """Close every idle session
+
+        :return: None
+        """
+        with self._condition:
+            idle, self._idle = self._idle, {}
+            for key, entries in idle.items():
+                self._open[key] -= len(entries)
+            self._condition.notify_all()
+        for entries in idle.values():
+            for entry in entries:
+                _disconnect(entry.session)
+
+
+def _disconnect(session):
+    try:
+        session.disconnect()
+    except Exception:
+        pass
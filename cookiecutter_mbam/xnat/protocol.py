@@ -0,0 +1,160 @@
+# -*- coding: utf-8 -*-
+"""The requests that upload a scan to XNAT, and what is made of the answers, apart from how they are sent.
+
+XNATConnection sends requests on sessions borrowed from the app's pool, a stage at a time on threads, and
+AsyncXNATConnection sends them over aiohttp on an event loop, but what they send and how they read the answers is the
+same.  upload_steps works an upload out as a generator of stages, each a list of Requests that don't depend on each
+other.  A client sends each stage's requests together, with its own methods of the names the requests give, and sends
+their answers back into the generator, in order, until it returns the uris of the upload.  The URLs, queries and
+readings of responses the clients share are here too, as functions of their arguments alone.
+"""
+import posixpath
+from collections import namedtuple
+from urllib.parse import urlencode
+
+from .planner import plan_upload
+
+
+class XNATUploadError(Exception):
+    """An object or file an upload needs couldn't be created in XNAT."""
+
+
+#: A request of an upload: the name of the client's method that sends it, and its positional and keyword arguments
+Request = namedtuple('Request', ['method', 'args', 'kwargs'])
+
+
+def xnat_url(server, uri, query=None):
+    """The URL of an XNAT URI on a server, which is also its key in the caches of objects and responses
+
+    :param str server: the server's URL
+    :param str uri: the URI
+    :param dict query: the query string's parameters, if any
+    :return: the URL
+    :rtype: str
+    """
+    return server.rstrip('/') + uri + ('?' + urlencode(sorted(query.items())) if query else '')
+
+
+def inbody_url(url):
+    """A PUT route that uploads the request's body as a file, rather than a file named in the query string"""
+    return url + ('&inbody=true' if '?' in url else '?inbody=true')
+
+
+def listing_changed_by(url):
+    """The URI of the collection whose listing a PUT to url adds to"""
+    return posixpath.dirname(url.split('?')[0])
+
+
+def import_query(project, subject, experiment):
+    """The parameters of a request to the import service that archives a zip into an experiment, replacing its files"""
+    return {'project': project, 'subject': subject, 'session': experiment, 'overwrite': 'delete'}
+
+
+def imported_uri(text):
+    """The URI of the experiment the import service archived into, from its answer, or None if it archived nothing"""
+    return text.strip() or None
+
+
+def listing_rows(listing):
+    """The rows of a JSON listing of a collection, or None if there was nothing to list
+
+    :param dict listing: the decoded listing, or None
+    :return: the ResultSet's rows
+    :rtype: list
+    :raises KeyError: if the listing has no ResultSet
+    """
+    return listing['ResultSet']['Result'] if listing is not None else None
+
+
+def member_uris(collection, members):
+    """The URIs a collection's members can be reached at, by ID and by label
+
+    :param str collection: the collection's URI
+    :param list members: the rows of the collection's listing
+    :return: a generator of URIs
+    :rtype: generator
+    """
+    return (posixpath.join(collection, member[field]) for member in members for field in ('ID', 'label')
+            if member.get(field))
+
+
+def new_scan(experiment_uri, scans, before=()):
+    """The scan an import added to an experiment
+
+    :param str experiment_uri: the experiment's URI
+    :param list scans: the rows of the listing of the experiment's scans after the import
+    :param iterable before: the ids of the experiment's scans before the import
+    :return: the URI of the first scan that wasn't there before, or of the last scan if the import replaced one,
+        or None if the experiment has no scans
+    :rtype: str
+    """
+    ids = [scan['ID'] for scan in scans if scan.get('ID')]
+    new = [id for id in ids if id not in set(before)] or ids[-1:]
+    return posixpath.join(experiment_uri, 'scans', new[0]) if new else None
+
+
+def upload_steps(config, cache, xnat_ids, existing_xnat_ids, image_file, import_service=False, progress=None,
+                 logger=None):
+    """The stages of requests that upload a scan, as a generator of lists of Requests
+
+    Plans the requests for subject, experiment, scan, resource, and file (see cookiecutter_mbam.xnat.planner), so
+    that objects recorded on the database objects or in the cache of XNAT objects are skipped.  The collections of
+    the objects left to check are listed together, once each, seeding the cache with their members, and the PUTs
+    follow in order, each seeding the cache with what it created.  A zip file goes to the import service, and the
+    scan it archived is found in a listing of the experiment's scans afterwards.
+
+    Each stage yielded is sent the answers to its requests, in order: a listing's rows, or None if it failed; whether
+    a PUT succeeded; and the URI the import service archived at, or None if the import failed.
+
+    :param XNATConfig config: the configuration of the XNAT the scan goes to
+    :param XNATExistenceCache cache: the cache of XNAT objects known to exist
+    :param dict xnat_ids: a dictionary of xnat identifiers and query strings for put urls
+    :param dict existing_xnat_ids: a dictionary of XNAT identifiers that already existed on user and experiment
+    :param file object image_file: the scan file to upload
+    :param bool import_service: whether to use the XNAT import service. True if file is a .zip, default False.
+    :param function progress: called with the bytes of the file sent so far and its size as it is sent
+    :param logging.Logger logger: where to log the plan, if anywhere
+    :return: a generator of stages, which returns the three-tuple of the xnat uris for subject, experiment, and scan
+    :rtype: generator
+    :raises XNATUploadError: if an object or the file couldn't be created, or the import failed or archived no scan
+    """
+    def key(uri):
+        return xnat_url(config.server, uri)
+
+    plan = plan_upload(config.archive_prefix, xnat_ids, existing_xnat_ids, known=lambda uri: key(uri) in cache,
+                       import_service=import_service)
+    collections = sorted({posixpath.dirname(uri) for uri in plan.checks if key(uri) not in cache})
+    listings = (yield [Request('xnat_list', (collection,), {}) for collection in collections]) if collections else []
+    for collection, members in zip(collections, listings):
+        cache.seed(key(uri) for uri in member_uris(collection, members or []))
+    found = {uri for uri in plan.checks if key(uri) in cache}
+
+    for put in plan.puts(found):
+        file = image_file if put.level == 'file' else None
+        created, = yield [Request('xnat_put', (put.uri + put.query,), {'file': file, 'progress': progress})]
+        if not created:
+            # Every object a PUT creates is needed by the ones after it
+            raise XNATUploadError('XNAT PUT of {} failed'.format(put.uri))
+        cache.seed(key(uri) for uri in (put.implicit if file else put.implicit + (put.uri,)))
+    if logger is not None:
+        logger.debug('XNAT upload plan: {}'.format(plan.report(found)))
+    uris = dict(plan.uris)
+
+    if import_service:
+        # The import service numbers the scans itself, so look for the scan it adds
+        before = []
+        if uris['experiment'] not in [put.uri for put in plan.puts(found)]:
+            before, = yield [Request('xnat_list', (uris['experiment'] + '/scans',), {})]
+        experiment, = yield [Request('xnat_import', (image_file,), {
+            'project': config.project, 'subject': xnat_ids['subject']['xnat_id'],
+            'experiment': xnat_ids['experiment']['xnat_id'], 'progress': progress})]
+        if experiment is None:
+            raise XNATUploadError('XNAT import into {} failed'.format(uris['experiment']))
+        if experiment.startswith(config.archive_prefix):
+            uris['experiment'] = experiment
+        scans, = yield [Request('xnat_list', (uris['experiment'] + '/scans',), {})]
+        uris['scan'] = new_scan(uris['experiment'], scans or [], [scan['ID'] for scan in before or []])
+        if uris['scan'] is None:
+            raise XNATUploadError('XNAT import into {} archived no scan'.format(uris['experiment']))
+
+    return (uris['subject'], uris['experiment'], uris['scan'])
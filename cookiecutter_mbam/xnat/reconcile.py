@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+"""Reconciliation of the XNAT identifiers recorded in the database with what XNAT holds.
+
+Users record the XNAT subject they were uploaded to, experiments their XNAT experiment and scans their URI, but objects
+can be deleted from XNAT behind the app's back, and records made before failed uploads were retried can point at
+objects that were never created.  reconcile checks every record against XNAT in bulk:
+
+* The project's subjects, and its experiments along with the subjects they belong to, are each read in one listing,
+  rather than an object at a time.  XNAT's archive listings take no offset to be read from, so they can't be paged;
+  the experiments are listed with only the four columns needed, and each listing is revalidated against the last one
+  read rather than downloaded again if it hasn't changed.  Rows without an ID or label, or experiments' rows without
+  their subject's, can't be what any record points at, and are left out.
+* The identifiers recorded in the database are read as plain columns, a page at a time, and indexed in sets, so each
+  kind of record is diffed against XNAT with set operations.
+* Scans can only be listed an experiment at a time, so the experiments that have scans recorded against them are
+  listed on a bounded pool of threads.
+* With repair, records of objects XNAT doesn't hold are cleared, in batches each committed on its own, so that the next
+  upload for the user or experiment creates the objects again.  Scans whose experiment couldn't be listed are left
+  alone.
+
+Each XNAT backend is reconciled with the records of the users assigned to it.  Run it with ``flask xnat-reconcile``.
+"""
+import posixpath
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app
+from sqlalchemy import or_
+
+from cookiecutter_mbam.database import db
+from cookiecutter_mbam.experiment.models import Experiment
+from cookiecutter_mbam.scan.models import Scan
+from cookiecutter_mbam.user.models import User
+from .config import DEFAULT_BACKEND, backend_config
+from .service import XNATConnection
+
+#: The records of one kind checked against XNAT: how many were checked, the ids and XNAT identifiers of those XNAT
+#: doesn't hold, the XNAT identifiers no record points at, and how many records couldn't be checked
+Discrepancies = namedtuple('Discrepancies', ['checked', 'missing', 'orphaned', 'unchecked'])
+
+
+def reconcile(backend=DEFAULT_BACKEND, xc=None, workers=None, repair=False, batch_size=1000):
+    """Check the XNAT identifiers of users, experiments and scans against an XNAT backend's project
+
+    :param str backend: the name of the backend, whose users' records are checked
+    :param XNATConnection xc: the connection to the backend; a new one by default
+    :param int workers: the number of experiments' scans listed at once; XNAT_POOL_SIZE by default
+    :param bool repair: whether to clear the records of objects XNAT doesn't hold
+    :param int batch_size: the number of records read, and cleared, at a time
+    :return: the Discrepancies of subjects, experiments and scans, by kind
+    :rtype: dict
+    :raises ValueError: if the project doesn't exist
+    :raises Exception: if the project's subjects or experiments can't be listed
+    """
+    xc = xc or XNATConnection(backend_config(backend))
+    on_backend = User.xnat_backend == backend
+    if backend == DEFAULT_BACKEND:
+        on_backend = or_(on_backend, User.xnat_backend.is_(None))
+    workers = workers or current_app.config.get('XNAT_POOL_SIZE', 4)
+    prefix = xc.archive_prefix + '/subjects'
+
+    subject_rows = [row for row in _rows(xc.xnat_get(prefix), prefix) if row.get('ID') or row.get('label')]
+    subjects = {row[field] for row in subject_rows for field in ('ID', 'label') if row.get(field)}
+    experiment_rows = _rows(xc.xnat_get(xc.archive_prefix + '/experiments',
+                                        query={'columns': 'ID,label,subject_ID,subject_label'}), xc.archive_prefix)
+    experiment_rows = [row for row in experiment_rows if _pairs(row)]
+    experiments = set().union(*map(_pairs, experiment_rows))
+
+    query = db.session.query(User.id, User.xnat_subject_id).filter(User.xnat_subject_id.isnot(None), on_backend)
+    users = dict(_columns(query, batch_size))
+    recorded = set(users.values())
+    report = {'subjects': Discrepancies(
+        checked=len(users),
+        missing={id: subject for id, subject in users.items() if subject not in subjects},
+        orphaned=sorted(row.get('label') or row['ID'] for row in subject_rows
+                        if recorded.isdisjoint((row.get('ID'), row.get('label')))),
+        unchecked=0)}
+
+    query = db.session.query(Experiment.id, User.xnat_subject_id, Experiment.xnat_experiment_id).join(User) \
+        .filter(Experiment.xnat_experiment_id.isnot(None), on_backend)
+    pairs = {id: (subject, experiment) for id, subject, experiment in _columns(query, batch_size)}
+    recorded = set(pairs.values())
+    report['experiments'] = Discrepancies(
+        checked=len(pairs),
+        missing={id: posixpath.join(*pair) for id, pair in pairs.items() if pair not in experiments},
+        orphaned=sorted(posixpath.join(*_pairs(row)[-1]) for row in experiment_rows
+                        if recorded.isdisjoint(_pairs(row))),
+        unchecked=0)
+
+    query = db.session.query(Scan.id, Scan.xnat_uri).join(Experiment).join(User) \
+        .filter(Scan.xnat_uri.isnot(None), on_backend)
+    report['scans'] = _reconcile_scans(xc, query, prefix, experiments, workers, batch_size)
+
+    if repair:
+        _clear(User, 'xnat_subject_id', report['subjects'].missing, batch_size)
+        _clear(Experiment, 'xnat_experiment_id', report['experiments'].missing, batch_size)
+        _clear(Scan, 'xnat_uri', report['scans'].missing, batch_size)
+    return report
+
+
+def _reconcile_scans(xc, query, prefix, experiments, workers, batch_size):
+    """Check scans' URIs against the listings of the experiments they belong to
+
+    Scans in experiments XNAT doesn't hold are missing without their experiment being listed, and scans outside the
+    project, or in experiments whose listing fails, are left unchecked.
+    """
+    scans = dict(_columns(query, batch_size))
+    by_experiment = {}
+    unchecked = set()
+    for id, uri in scans.items():
+        experiment = posixpath.dirname(posixpath.dirname(uri))
+        parts = experiment[len(prefix):].split('/')
+        if not experiment.startswith(prefix + '/') or len(parts) != 4 or parts[2] != 'experiments':
+            unchecked.add(id)
+        elif (parts[1], parts[3]) in experiments:
+            by_experiment.setdefault(experiment, {})[uri] = id
+    listed = _map_in_app_context(lambda experiment: xc.xnat_list(experiment + '/scans'), sorted(by_experiment),
+                                 workers)
+
+    held = set()
+    orphaned = []
+    for experiment, members in zip(sorted(by_experiment), listed):
+        if members is None:
+            unchecked.update(by_experiment[experiment].values())
+            continue
+        uris = {posixpath.join(experiment, 'scans', member['ID']) for member in members if member.get('ID')}
+        held |= uris
+        orphaned.extend(uris.difference(by_experiment[experiment]))
+    return Discrepancies(
+        checked=len(scans) - len(unchecked),
+        missing={id: uri for id, uri in scans.items() if id not in unchecked and uri not in held},
+        orphaned=sorted(orphaned),
+        unchecked=len(unchecked))
+
+
+def _rows(listing, uri):
+    if listing is None:
+        raise ValueError('XNAT has nothing at {}'.format(uri))
+    return listing['ResultSet']['Result']
+
+
+def _pairs(row):
+    """The (subject, experiment) pairs an experiment's row can be recorded as, by ID or label, labels last"""
+    return [(subject, experiment) for subject in (row.get('subject_ID'), row.get('subject_label')) if subject
+            for experiment in (row.get('ID'), row.get('label')) if experiment]
+
+
+def _columns(query, batch_size):
+    """The rows of a query of columns, fetched a page at a time"""
+    return [tuple(row) for row in query.yield_per(batch_size)]
+
+
+def _map_in_app_context(func, items, workers):
+    """Call func on each of items on a pool of threads, each in the app's context, and return the results in order"""
+    app = current_app._get_current_object()
+
+    def call(item):
+        with app.app_context():
+            return func(item)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        return list(executor.map(call, items))
+
+
+def _clear(model, column, records, batch_size):
+    """Clear a column of the records with the given ids, committing a batch at a time"""
+    ids = sorted(records)
+    for start in range(0, len(ids), batch_size):
+        model.query.filter(model.id.in_(ids[start:start + batch_size])).update({column: None},
+                                                                               synchronize_session=False)
+        db.session.commit()
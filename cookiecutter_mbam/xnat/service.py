@@ -1,146 +1,229 @@
-import os
-import xnat
-import configparser
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 from flask import current_app
+
+from .config import DEFAULT_BACKEND, backend_config, backend_names
+from .planner import XNAT_HIERARCHY
+from .protocol import (import_query, imported_uri, inbody_url, listing_changed_by, listing_rows, upload_steps,
+                       xnat_url)
+from .sharding import hash_ring
+from .transfer import UploadStream, upload_bucket
 def debug():
     assert current_app.debug == False, "Don't panic! You're here by request of debug()"
 
-class XNATConnection:
-
-    def __init__(self):
-        self._read_config()
-        self._set_attributes()
-        self.xnat_hierarchy = ['subject', 'experiment', 'scan', 'resource', 'file']
-
-    def _read_config(self):
-        """ Read config file
-
-        Part of the instance initialization, reads config file for XNAT variables and uploaded file destination
 
-        :return: None
+class XNATConnection:
+    """Uploads to XNAT
+
+    Cheap to create: the configuration is read once, when the app is created (see cookiecutter_mbam.xnat.config), and
+    sessions are borrowed from the app's pool.
+
+    :param XNATConfig config: the XNAT configuration; the app's by default
+    """
+
+    def __init__(self, config=None):
+        self.config = config or current_app.config['XNAT']
+        self.server, self.user, self.password, self.project = self.config[:4]
+        self.archive_prefix = self.config.archive_prefix
+        self.prearchive_prefix = self.config.prearchive_prefix
+        self.file_dest = self.config.file_dest
+        self.xnat_hierarchy = XNAT_HIERARCHY
+
+    @staticmethod
+    def backend_for(user, xnat_subject_id):
+        """The XNAT backend a user's subject is on, or is to be created on if it is new
+
+        A new subject goes to a backend chosen by consistent hashing of its id over XNAT_BACKENDS (see
+        cookiecutter_mbam.xnat.sharding), which every process agrees on.  Users whose subjects predate the assignments
+        are on the default backend.  The user isn't changed; ScanService.process records the assignment with the
+        upload that creates the subject.
+
+        :param User user: the user
+        :param str xnat_subject_id: the id of the user's XNAT subject
+        :return: the name of the backend
+        :rtype: str
+        """
+        if user.xnat_backend:
+            return user.xnat_backend
+        return DEFAULT_BACKEND if user.xnat_subject_id else hash_ring(backend_names()).node(xnat_subject_id)
+
+    @classmethod
+    def for_user(cls, user, xnat_subject_id):
+        """A connection to the XNAT backend a user's subject is on, or is to be created on (see backend_for)
+
+        :param User user: the user
+        :param str xnat_subject_id: the id of the user's XNAT subject
+        :return: the connection
+        :rtype: XNATConnection
+        :raises KeyError: if the user is assigned to a backend that is no longer configured
         """
-        config = configparser.ConfigParser()
-        config.read('/Users/katie/spiro/cookiecutter_mbam/setup.cfg')
-        self.xnat_config = config['XNAT']
-        self.upload_config = config['uploads']
+        return cls(backend_config(cls.backend_for(user, xnat_subject_id)))
 
+    @property
+    def pool(self):
+        """The app's pool of XNAT sessions (see cookiecutter_mbam.xnat.pool)"""
+        return current_app.extensions['xnat_pool']
 
-    def _set_attributes(self):
-        """ Set attributes on self
+    @property
+    def cache(self):
+        """The app's cache of XNAT objects known to exist (see cookiecutter_mbam.xnat.cache)"""
+        return current_app.extensions['xnat_cache']
 
-        Part of the instance initialization, sets XNAT server, user, password, and project, paths to the XNAT archive
-        and prearchive, and the destination for uploaded files.
+    @property
+    def responses(self):
+        """The app's cache of XNAT responses to revalidate (see cookiecutter_mbam.xnat.cache)"""
+        return current_app.extensions['xnat_responses']
 
-        :return: None
-        """
-        [setattr(self, k, v) for k, v in self.xnat_config.items()]
-        for dest in ['archive', 'prearchive']:
-            setattr(self, dest + '_prefix', '/data/{}/projects/{}'.format(dest, self.project))
-            self.file_dest = self.upload_config['uploaded_scans_dest']
+    def _stream(self, file, progress=None):
+        """Wrap a file to be streamed to XNAT, capped at the process's share of XNAT_UPLOAD_BANDWIDTH"""
+        bucket = upload_bucket(current_app.config.get('XNAT_UPLOAD_BANDWIDTH'))
+        return UploadStream(getattr(file, 'stream', file), progress=progress, bucket=bucket)
 
-    def xnat_put(self, url='', file=None, imp=False, **kwargs):
+    def xnat_put(self, url='', file=None, imp=False, progress=None, **kwargs):
         """ The method to create an XNAT object
 
-        Uses the xnatpy session.put, session.upload, or session.services.import_ to add an object to XNAT.
+        Uses the xnatpy session.put or session.upload_stream to add an object to XNAT, on a session borrowed from the
+        app's pool.  A file is streamed as the body of the request (see cookiecutter_mbam.xnat.transfer).
 
         :param str url: a put route in the XNAT URI
         :param file object file: a file object to upload
         :param bool imp: whether to use the import service (True if file is zip of dicoms, otherwise False)
-        :param kwargs kwargs:
-        :return: None
+        :param function progress: called with the bytes of the file sent so far and its size as it is sent
+        :param kwargs kwargs: the project, subject and experiment for the import service
+        :return: whether the object was created
+        :rtype: bool
         """
-        with xnat.connect(self.server, self.user, self.password) as session:
-            try:
-                if imp:
-                    file_path = os.path.join(self.file_dest, file.filename)
-                    file.save(file_path)
-                    session.services.import_(file_path, overwrite='delete', **kwargs)
-                    os.remove(file_path)
-                    # todo: need to call something like xnat_get to get the scan uri and return it to calling method
-                elif file:
-                    session.upload(url, file)
-                else:
-                    session.put(url)
-            except:
-                # todo
-                # what should we do with errors?
-                # probably depends on what the error is.  if we don't succeed in uploading the file
-                # we need to send a message back to the user
-                # but some errors here could be recoverable.
-
-                pass
-
-    def xnat_get(self):
-        # todo: This needs to be a method that gets the name of the scan uri some how.
-        pass
-
-    # todo: fix the fake scan uri
-    def upload_scan(self, xnat_ids, existing_xnat_ids, image_file, import_service=False):
+        def put(session):
+            if file is not None:
+                # upload_stream rewinds the stream, so the pool can call put again after re-authenticating
+                session.upload_stream(inbody_url(url), self._stream(file, progress))
+            else:
+                session.put(url)
+
+        if imp:
+            return self.xnat_import(file, progress=progress, **kwargs) is not None
+        try:
+            self.pool.run(put, self.server, self.user, self.password)
+        except Exception:
+            # todo: some of these errors are recoverable, and if the file didn't make it the user needs to know
+            current_app.logger.exception('XNAT PUT of {} failed'.format(url))
+            return False
+        # The listing the new object belongs to has changed, perhaps within the second its Last-Modified resolves
+        self.responses.discard(xnat_url(self.server, listing_changed_by(url)))
+        return True
+
+    def xnat_import(self, file, project, subject, experiment, progress=None):
+        """Send a zip of DICOM files to the XNAT import service
+
+        The zip is streamed from the upload as the body of the request, without being saved anywhere first.
+
+        :param file object file: the zip file, a werkzeug FileStorage
+        :param str project: the project to import into
+        :param str subject: the subject to import into
+        :param str experiment: the experiment to import into
+        :param function progress: called with the bytes of the file sent so far and its size as it is sent
+        :return: the URI XNAT archived the experiment at, or None if the import failed
+        :rtype: str
+        """
+        query = import_query(project, subject, experiment)
+
+        def import_(session):
+            # Rather than session.services.import_, which fetches the experiment back to wrap it in an object
+            response = session.upload_stream('/data/services/import', self._stream(file, progress), query=query,
+                                             content_type='application/zip', method='post')
+            return imported_uri(response.text)
+
+        try:
+            uri = self.pool.run(import_, self.server, self.user, self.password)
+        except Exception:
+            current_app.logger.exception('XNAT import of {} failed'.format(file.filename))
+            return None
+        return uri
+
+    def xnat_get(self, uri, query=None):
+        """Read JSON from XNAT, revalidating the last response from the same URL rather than downloading it again
+
+        :param str uri: the URI to read
+        :param dict query: the query string's parameters
+        :return: the decoded body, which is shared with the cache and must not be modified, or None if there is
+            nothing at uri
+        :raises Exception: if XNAT can't be reached or answers with an error
+        """
+        url = xnat_url(self.server, uri, query)
+        cached = self.responses.get(url)
+        headers = cached.validators if cached else {}
+
+        def get(session):
+            # A 404 is an answer, not a failure, so it mustn't cost the pool a check of the session
+            return session.get(uri, format='json', query=query, accepted_status=[200, 304, 404], headers=headers)
+
+        response = self.pool.run(get, self.server, self.user, self.password)
+        if response.status_code == 404:
+            return None
+        if response.status_code == 304 and cached:
+            return cached.body
+        body = response.json()
+        self.responses.store(url, body, response.headers)
+        return body
+
+    def xnat_list(self, uri):
+        """List the members of an XNAT collection
+
+        :param str uri: the collection's URI, e.g. a project's subjects
+        :return: the members' rows from the listing's ResultSet, or None if the collection's parent doesn't exist or
+            the listing failed
+        :rtype: list
+        """
+        try:
+            return listing_rows(self.xnat_get(uri))
+        except Exception:
+            current_app.logger.exception('XNAT listing of {} failed'.format(uri))
+            return None
+
+    def _in_parallel(self, funcs):
+        """Call funcs on threads, each in the app's context, and return their results in order."""
+        if len(funcs) < 2:
+            return [func() for func in funcs]
+        app = current_app._get_current_object()
+
+        def call(func):
+            with app.app_context():
+                return func()
+        with ThreadPoolExecutor(max_workers=len(funcs)) as executor:
+            return list(executor.map(call, funcs))
+
+    def upload_scan(self, xnat_ids, existing_xnat_ids, image_file, import_service=False, progress=None):
         """The method to upload a scan to XNAT
 
-        Iteratively constructs the uris for subject and experiment (if they do not exist).  Constructs the uris for scan,
-        resource, and file (if not using the import service).  Calls xnat_put on the generated uris to create objects if
-        they do not exist.  Calls xnat_put with a file to upload it, invoking the import service if it is a zip file.
-        Returns uris for subject, experiment, and scan so they can be attached to their database objects.
+        Plans the requests for subject, experiment, scan, resource, and file (see cookiecutter_mbam.xnat.planner), so
+        that objects recorded on the database objects or in the app's cache of XNAT objects are skipped, the remaining
+        existence checks are sent together, and parents XNAT creates implicitly aren't PUT on their own.  Runs the plan,
+        uploading the file, or invokes the import service if it is a zip file and finds the scan it archived.  Returns
+        uris for subject, experiment, and scan so they can be attached to their database objects.
+
+        The stages of requests come from cookiecutter_mbam.xnat.protocol.upload_steps, which AsyncXNATConnection
+        shares; the requests of each stage are sent together, on threads.
 
         :param dict xnat_ids: a dictionary of xnat identifiers and query strings for put urls
         :param dict existing_xnat_ids: a dictionary of XNAT identifiers that already existed on user and experiment
         :param file object image_file: the scan file to upload
         :param bool import_service: whether to use the XNAT import service. True if file is a .zip, default False.
+        :param function progress: called with the bytes of the file sent so far and its size as it is sent
         :return: three-tuple of the xnat uris for subject, experiment, and scan
         :rtype: tuple
+        :raises XNATUploadError: if an object or the file couldn't be created, or the import failed or archived no scan
         """
 
         self.xnat_ids = xnat_ids
-        uri = self.archive_prefix # todo: decide whether to use prearchive
-        uris = {}
-
-        if import_service:
-            levels = self.xnat_hierarchy[:-3]
-        else:
-            levels = self.xnat_hierarchy
-
-        for level in levels:
-            id = 'xnat_{}_id'.format(level)
-            exists_already = id in existing_xnat_ids and len(existing_xnat_ids[id])
-            if exists_already:
-                uri = os.path.join(uri, level + 's', existing_xnat_ids[id])
-            else:
-                uri = os.path.join(uri, level + 's', xnat_ids[level]['xnat_id'])
-
-            uris[level] = uri
-
+        # todo: decide whether to use prearchive
+        steps = upload_steps(self.config, self.cache, xnat_ids, existing_xnat_ids, image_file,
+                             import_service=import_service, progress=progress, logger=current_app.logger)
+        answers = None
+        while True:
             try:
-                query = xnat_ids[level]['query_string']
-            except: #todo specify KeyError here?
-                query = ''
-
-            if level == 'file':
-                self.xnat_put(url=uri + query, file=image_file)
-            else:
-                if not exists_already: self.xnat_put(url=uri + query)
-
-        if import_service:
-            self.xnat_put(file=image_file, imp=True, project=self.project,
-                          subject = self.xnat_ids['subject']['xnat_id'],
-                          experiment = self.xnat_ids['experiment']['xnat_id'])
-
-        # todo: make this the real scan uri!
-        try:
-            uris['scan']
-        except:
-            uris['scan'] = 'hello'
-
-        return (uris['subject'], uris['experiment'], uris['scan'])
-
-
-
-
-
-
-
-
-
-
-
+                stage = steps.send(answers)
+            except StopIteration as stop:
+                return stop.value
+            answers = self._in_parallel([partial(getattr(self, request.method), *request.args, **request.kwargs)
+                                         for request in stage])
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""Consistent hashing of XNAT subjects onto backends.
+
+Each backend is given many points on a ring of 32-bit hashes, and a subject belongs to the backend whose point follows
+the hash of its XNAT subject id.  Adding a backend takes over only the subjects whose hashes fall just before its own
+points, on average 1/n of them with n backends, instead of reshuffling nearly all of them as hashing modulo the number
+of backends would.  Subjects that already have a backend keep it regardless (see XNATConnection.backend_for), so the
+ring only decides where new subjects go.
+"""
+import bisect
+import hashlib
+from functools import lru_cache
+
+#: The number of points each backend has on the ring; more points spread subjects more evenly
+REPLICAS = 128
+
+
+def _hash(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:4], 'big')
+
+
+class HashRing:
+    """A consistent hash ring of backends
+
+    :param iterable names: the names of the backends
+    :param int replicas: the number of points each backend has on the ring
+    """
+
+    def __init__(self, names, replicas=REPLICAS):
+        points = sorted((_hash('{}#{}'.format(name, i)), name) for name in names for i in range(replicas))
+        if not points:
+            raise ValueError('A hash ring needs at least one backend')
+        self._hashes = [point for point, _ in points]
+        self._names = [name for _, name in points]
+
+    def node(self, key):
+        """The backend a key belongs to
+
+        :param str key: the key, e.g. an XNAT subject id
+        :return: the name of the backend
+        :rtype: str
+        """
+        return self._names[bisect.bisect(self._hashes, _hash(key)) % len(self._hashes)]
+
+
+@lru_cache(maxsize=8)
+def hash_ring(names):
+    """The hash ring of a tuple of backend names, built once
+
+    :param tuple names: the names of the backends
+    :return: the ring
+    :rtype: HashRing
+    """
+    return HashRing(names)
@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""Streaming file transfers to XNAT.
+
+Files are sent as the body of the request, read from the upload's stream or the staged file a block at a time as the
+connection takes them, so nothing is copied to disk or read into memory first.  Every chunk sent is reported to an
+optional progress callback, and a token bucket shared by the process can cap the rate it sends at, so that a few huge
+uploads don't take all of the link to XNAT.
+
+The cap is XNAT_UPLOAD_BANDWIDTH, in bytes a second for each worker process; 0, the default, leaves it uncapped.
+"""
+import io
+import os
+import threading
+import time
+
+#: The number of bytes sent between reports of progress
+CHUNK_SIZE = 1024 * 1024
+
+_buckets = {}
+
+
+class TokenBucket:
+    """A rate limit on the bytes sent, which lets short bursts through
+
+    Bytes are taken from the bucket as they are sent, and it refills at rate bytes a second up to capacity.  Taking
+    more than the bucket holds leaves it in debt, and the caller waits until the debt is paid off, so threads sharing a
+    bucket share its rate between them.
+
+    :param float rate: the bytes a second let through
+    :param float capacity: the most bytes let through in a burst; a quarter of a second's worth by default
+    :param function clock: returns the time in seconds
+    :param function sleep: waits for a number of seconds
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate / 4)
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = self.capacity
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def delay(self, size):
+        """Take size bytes from the bucket
+
+        :param int size: the number of bytes about to be sent
+        :return: the seconds to wait before sending them
+        :rtype: float
+        """
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate) - size
+            self._last = now
+            return -self._tokens / self.rate if self._tokens < 0 else 0.0
+
+    def consume(self, size):
+        """Take size bytes from the bucket, waiting until they may be sent
+
+        :param int size: the number of bytes about to be sent
+        :return: None
+        """
+        wait = self.delay(size)
+        if wait:
+            self._sleep(wait)
+
+
+def upload_bucket(rate):
+    """The token bucket shared by every upload in this process
+
+    :param int rate: the bytes a second the process may send; 0 or None for no cap
+    :return: the bucket, or None if there is no cap
+    :rtype: TokenBucket
+    """
+    if not rate:
+        return None
+    key = (os.getpid(), rate)
+    if key not in _buckets:
+        _buckets[key] = TokenBucket(rate)
+    return _buckets[key]
+
+
+class UploadStream(io.RawIOBase):
+    """A file being uploaded, which reports its progress and keeps to a bandwidth cap as it is read
+
+    Sized and seekable, so requests sends it with a Content-Length, a block at a time, and xnatpy can rewind it to send
+    it again.
+
+    :param file file: a seekable binary file object, sent from the start
+    :param function progress: called with the number of bytes sent so far and the total, after every chunk_size bytes
+        and at the end
+    :param TokenBucket bucket: the bandwidth cap; none if None
+    :param int chunk_size: the number of bytes sent between reports of progress
+    """
+
+    def __init__(self, file, progress=None, bucket=None, chunk_size=CHUNK_SIZE):
+        super().__init__()
+        self.file = file
+        self.progress = progress
+        self.bucket = bucket
+        self.chunk_size = chunk_size
+        file.seek(0, io.SEEK_END)
+        self.size = file.tell()
+        self.seek(0)
+
+    def __len__(self):
+        return self.size
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        data = self.file.read() if size is None or size < 0 else self.file.read(min(size, self.chunk_size))
+        if not data:
+            return data
+        if self.bucket is not None:
+            self.bucket.consume(len(data))
+        self.sent += len(data)
+        if self.progress is not None and (self.sent >= self._next_report or self.sent == self.size):
+            self._next_report = self.sent + self.chunk_size
+            self.progress(self.sent, self.size)
+        return data
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        position = self.file.seek(offset, whence)
+        self.sent = self.file.tell()
+        self._next_report = self.sent + self.chunk_size
+        return position
+
+    def tell(self):
+        return self.file.tell()
@@ -0,0 +1,44 @@
+"""add scan upload jobs
+
+Revision ID: 7d2f0c1b9e4a
+Revises: 41c4afae419c
+Create Date: 2018-12-03 10:12:41.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7d2f0c1b9e4a'
+down_revision = '41c4afae419c'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('scan_upload_jobs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('status', sa.String(length=16), nullable=False),
+    sa.Column('filename', sa.String(length=255), nullable=False),
+    sa.Column('path', sa.String(length=1024), nullable=False),
+    sa.Column('attempts', sa.Integer(), nullable=False),
+    sa.Column('error', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('run_after', sa.DateTime(), nullable=False),
+    sa.Column('locked_until', sa.DateTime(), nullable=True),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('experiment_id', sa.Integer(), nullable=False),
+    sa.Column('scan_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['experiment_id'], ['experiments.id'], ),
+    sa.ForeignKeyConstraint(['scan_id'], ['scan.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_scan_upload_jobs_status'), 'scan_upload_jobs', ['status'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_scan_upload_jobs_status'), table_name='scan_upload_jobs')
+    op.drop_table('scan_upload_jobs')
@@ -0,0 +1,24 @@
+"""add the xnat backend of each user's subject
+
+Revision ID: a5c8e2f41d93
+Revises: f2a9d4c70e58
+Create Date: 2019-01-07 11:42:18.203516
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a5c8e2f41d93'
+down_revision = 'f2a9d4c70e58'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('users', sa.Column('xnat_backend', sa.String(length=80), nullable=True))
+
+
+def downgrade():
+    op.drop_column('users', 'xnat_backend')
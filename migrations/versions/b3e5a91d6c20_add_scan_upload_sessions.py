@@ -0,0 +1,43 @@
+"""add scan upload sessions
+
+Revision ID: b3e5a91d6c20
+Revises: 7d2f0c1b9e4a
+Create Date: 2018-12-05 16:40:09.552871
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3e5a91d6c20'
+down_revision = '7d2f0c1b9e4a'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('scan_upload_sessions',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('token', sa.String(length=32), nullable=False),
+    sa.Column('filename', sa.String(length=255), nullable=False),
+    sa.Column('path', sa.String(length=1024), nullable=False),
+    sa.Column('length', sa.BigInteger(), nullable=False),
+    sa.Column('offset', sa.BigInteger(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('expires_at', sa.DateTime(), nullable=False),
+    sa.Column('user_id', sa.Integer(), nullable=False),
+    sa.Column('experiment_id', sa.Integer(), nullable=False),
+    sa.Column('job_id', sa.Integer(), nullable=True),
+    sa.ForeignKeyConstraint(['experiment_id'], ['experiments.id'], ),
+    sa.ForeignKeyConstraint(['job_id'], ['scan_upload_jobs.id'], ),
+    sa.ForeignKeyConstraint(['user_id'], ['users.id'], ),
+    sa.PrimaryKeyConstraint('id'),
+    sa.UniqueConstraint('token')
+    )
+    op.create_index(op.f('ix_scan_upload_sessions_expires_at'), 'scan_upload_sessions', ['expires_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_scan_upload_sessions_expires_at'), table_name='scan_upload_sessions')
+    op.drop_table('scan_upload_sessions')
@@ -0,0 +1,23 @@
+"""index experiments by user, date and id for paging
+
+Revision ID: b7d1f3e5a920
+Revises: a5c8e2f41d93
+Create Date: 2019-01-09 16:05:37.418902
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7d1f3e5a920'
+down_revision = 'a5c8e2f41d93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index('ix_experiments_user_id_date_id', 'experiments', ['user_id', 'date', 'id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_experiments_user_id_date_id', table_name='experiments')
@@ -0,0 +1,26 @@
+"""add dicom index to scans and upload jobs
+
+Revision ID: c81f4e0a27d3
+Revises: b3e5a91d6c20
+Create Date: 2018-12-10 11:05:32.904417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c81f4e0a27d3'
+down_revision = 'b3e5a91d6c20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('scan', sa.Column('dicom_index', sa.Text(), nullable=True))
+    op.add_column('scan_upload_jobs', sa.Column('dicom_index', sa.Text(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('scan_upload_jobs', 'dicom_index')
+    op.drop_column('scan', 'dicom_index')
@@ -0,0 +1,48 @@
+"""index the foreign keys and xnat ids looked up on every upload and listing
+
+Revision ID: c92e4b7a1f05
+Revises: b7d1f3e5a920
+Create Date: 2019-01-11 10:27:53.640118
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c92e4b7a1f05'
+down_revision = 'b7d1f3e5a920'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # experiments.user_id is served by ix_experiments_user_id_date_id
+    op.create_index('ix_scan_experiment_id', 'scan', ['experiment_id'], unique=False)
+    op.create_index('ix_users_xnat_subject_id', 'users', ['xnat_subject_id'], unique=False)
+    op.create_index('ix_experiments_xnat_experiment_id', 'experiments', ['xnat_experiment_id'], unique=False)
+
+    # Roles granted twice, or to no one, would break the unique constraint
+    roles_users = sa.table('roles_users', sa.column('user_id', sa.Integer()), sa.column('role_id', sa.Integer()))
+    connection = op.get_bind()
+    connection.execute(roles_users.delete().where(sa.or_(roles_users.c.user_id.is_(None),
+                                                         roles_users.c.role_id.is_(None))))
+    duplicates = connection.execute(sa.select([roles_users.c.user_id, roles_users.c.role_id])
+                                    .group_by(roles_users.c.user_id, roles_users.c.role_id)
+                                    .having(sa.func.count() > 1)).fetchall()
+    for user_id, role_id in duplicates:
+        connection.execute(roles_users.delete().where(sa.and_(roles_users.c.user_id == user_id,
+                                                              roles_users.c.role_id == role_id)))
+        connection.execute(roles_users.insert().values(user_id=user_id, role_id=role_id))
+    with op.batch_alter_table('roles_users') as batch_op:
+        batch_op.create_unique_constraint('uq_roles_users_user_id_role_id', ['user_id', 'role_id'])
+    op.create_index('ix_roles_users_role_id', 'roles_users', ['role_id'], unique=False)
+
+
+def downgrade():
+    op.drop_index('ix_roles_users_role_id', table_name='roles_users')
+    with op.batch_alter_table('roles_users') as batch_op:
+        batch_op.drop_constraint('uq_roles_users_user_id_role_id', type_='unique')
+    op.drop_index('ix_experiments_xnat_experiment_id', table_name='experiments')
+    op.drop_index('ix_users_xnat_subject_id', table_name='users')
+    op.drop_index('ix_scan_experiment_id', table_name='scan')
@@ -0,0 +1,26 @@
+"""add sha256 to scans
+
+Revision ID: d4a7b2e19f06
+Revises: c81f4e0a27d3
+Create Date: 2018-12-12 09:47:18.230561
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4a7b2e19f06'
+down_revision = 'c81f4e0a27d3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('scan', sa.Column('sha256', sa.String(length=64), nullable=True))
+    op.create_index(op.f('ix_scan_sha256'), 'scan', ['sha256'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_scan_sha256'), table_name='scan')
+    op.drop_column('scan', 'sha256')
@@ -0,0 +1,28 @@
+"""add the sequences xnat labels are numbered from
+
+Revision ID: d4a8f1c6e372
+Revises: c92e4b7a1f05
+Create Date: 2019-01-14 11:42:08.517264
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd4a8f1c6e372'
+down_revision = 'c92e4b7a1f05'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('xnat_id_sequences',
+    sa.Column('name', sa.String(length=120), nullable=False),
+    sa.Column('last_value', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('name')
+    )
+
+
+def downgrade():
+    op.drop_table('xnat_id_sequences')
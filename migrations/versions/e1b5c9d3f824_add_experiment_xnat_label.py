@@ -0,0 +1,24 @@
+"""add the xnat label reserved for each experiment
+
+Revision ID: e1b5c9d3f824
+Revises: d4a8f1c6e372
+Create Date: 2019-01-15 09:18:44.207531
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e1b5c9d3f824'
+down_revision = 'd4a8f1c6e372'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('experiments', sa.Column('xnat_label', sa.String(length=80), nullable=True))
+
+
+def downgrade():
+    op.drop_column('experiments', 'xnat_label')
@@ -0,0 +1,52 @@
+"""add nifti header geometry to scans
+
+Revision ID: e6c3f85a1b27
+Revises: d4a7b2e19f06
+Create Date: 2018-12-14 11:02:45.118093
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e6c3f85a1b27'
+down_revision = 'd4a7b2e19f06'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('scan', sa.Column('nifti_version', sa.SmallInteger(), nullable=True))
+    op.add_column('scan', sa.Column('datatype', sa.SmallInteger(), nullable=True))
+    op.add_column('scan', sa.Column('qform_code', sa.SmallInteger(), nullable=True))
+    op.add_column('scan', sa.Column('sform_code', sa.SmallInteger(), nullable=True))
+    op.add_column('scan', sa.Column('dim_x', sa.Integer(), nullable=True))
+    op.add_column('scan', sa.Column('dim_y', sa.Integer(), nullable=True))
+    op.add_column('scan', sa.Column('dim_z', sa.Integer(), nullable=True))
+    op.add_column('scan', sa.Column('dim_t', sa.Integer(), nullable=True))
+    op.add_column('scan', sa.Column('pixdim_x', sa.Float(), nullable=True))
+    op.add_column('scan', sa.Column('pixdim_y', sa.Float(), nullable=True))
+    op.add_column('scan', sa.Column('pixdim_z', sa.Float(), nullable=True))
+    op.add_column('scan', sa.Column('tr', sa.Float(), nullable=True))
+    op.create_index('ix_scan_dims', 'scan', ['dim_x', 'dim_y', 'dim_z'], unique=False)
+    op.create_index('ix_scan_pixdims', 'scan', ['pixdim_x', 'pixdim_y', 'pixdim_z'], unique=False)
+    op.create_index(op.f('ix_scan_tr'), 'scan', ['tr'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_scan_tr'), table_name='scan')
+    op.drop_index('ix_scan_pixdims', table_name='scan')
+    op.drop_index('ix_scan_dims', table_name='scan')
+    op.drop_column('scan', 'tr')
+    op.drop_column('scan', 'pixdim_z')
+    op.drop_column('scan', 'pixdim_y')
+    op.drop_column('scan', 'pixdim_x')
+    op.drop_column('scan', 'dim_t')
+    op.drop_column('scan', 'dim_z')
+    op.drop_column('scan', 'dim_y')
+    op.drop_column('scan', 'dim_x')
+    op.drop_column('scan', 'sform_code')
+    op.drop_column('scan', 'qform_code')
+    op.drop_column('scan', 'datatype')
+    op.drop_column('scan', 'nifti_version')
@@ -0,0 +1,24 @@
+"""add qc metrics to scans
+
+Revision ID: f2a9d4c70e58
+Revises: e6c3f85a1b27
+Create Date: 2018-12-17 15:21:09.604417
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2a9d4c70e58'
+down_revision = 'e6c3f85a1b27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('scan', sa.Column('qc_metrics', sa.Text(), nullable=True))
+
+
+def downgrade():
+    op.drop_column('scan', 'qc_metrics')
@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
 """Defines fixtures available to all tests."""
 
+import os
+from functools import partial
+
 import pytest
+import xnat
 from webtest import TestApp
 
 from cookiecutter_mbam.app import create_app
 from cookiecutter_mbam.database import db as _db
+from cookiecutter_mbam.xnat.cache import XNATExistenceCache, XNATResponseCache
+from cookiecutter_mbam.xnat.fake import FakeXNAT
+from cookiecutter_mbam.xnat.pool import XNATSessionPool
 
 from .factories import UserFactory
 
@@ -42,9 +49,33 @@ def db(app):
     _db.drop_all()
 
 
+@pytest.fixture
+def postgres(app, request):
+    """A database for the tests on the Postgres server at TEST_POSTGRES_URL."""
+    url = os.environ.get('TEST_POSTGRES_URL')
+    if not url:
+        pytest.skip('TEST_POSTGRES_URL is not set')
+    app.config['SQLALCHEMY_DATABASE_URI'] = url
+    return request.getfixturevalue('db')
+
+
 @pytest.fixture
 def user(db):
     """A user for the tests."""
     user = UserFactory(password='myprecious')
     db.session.commit()
     return user
+
+
+@pytest.fixture
+def fake_xnat(app, tmpdir):
+    """A fake XNAT server, which the app uploads to instead of the configured one."""
+    config = app.config['XNAT']
+    with FakeXNAT(projects=(config.project,), users={config.user: config.password}) as server:
+        app.config['XNAT'] = config._replace(server=server.url, file_dest=str(tmpdir))
+        # The fake serves no data model, and the app doesn't use one
+        pool = XNATSessionPool(app, connect=partial(xnat.connect, no_parse_model=True))
+        XNATExistenceCache(app)
+        XNATResponseCache(app)
+        yield server
+        pool.close()
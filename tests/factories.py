@@ -1,5 +1,13 @@
 # -*- coding: utf-8 -*-
 """Factories to help in tests."""
+import io
+import struct
+import sys
+import zipfile
+from array import array
+
+import numpy as np
+
 from factory import PostGenerationMethodCall, Sequence
 from factory.alchemy import SQLAlchemyModelFactory
 
@@ -29,3 +37,70 @@ class UserFactory(BaseFactory):
         """Factory configuration."""
 
         model = User
+
+
+def nifti_bytes(shape=(8, 8, 8), pixdim=(1.0, 1.0, 1.0), tr=0.0, voxels=None, byteorder='<'):
+    """A minimal single-file NIfTI-1 image of int16 voxels, x varying fastest."""
+    dims = list(shape) + [1] * (7 - len(shape))
+    pixdims = list(pixdim) + [tr] + [0.0] * (7 - len(pixdim) - 1)
+    header = bytearray(352)
+    struct.pack_into(byteorder + 'i', header, 0, 348)
+    struct.pack_into(byteorder + '8h', header, 40, len(shape), *dims)
+    struct.pack_into(byteorder + 'hh', header, 70, 4, 16)  # datatype DT_INT16, bitpix
+    struct.pack_into(byteorder + '8f', header, 76, 1.0, *pixdims)
+    struct.pack_into(byteorder + 'f', header, 108, 352.0)  # vox_offset
+    struct.pack_into('<B', header, 123, 2 | 8)  # xyzt_units: mm and s
+    struct.pack_into(byteorder + 'hh', header, 252, 1, 1)  # qform_code, sform_code
+    header[344:348] = b'n+1\0'
+    count = 1
+    for d in shape:
+        count *= d
+    if voxels is None:
+        voxels = [i % 1000 for i in range(count)]
+    voxels = array('h', voxels)
+    if byteorder != ('<' if sys.byteorder == 'little' else '>'):
+        voxels.byteswap()
+    return bytes(header) + voxels.tobytes()
+
+
+def phantom_voxels(shape=(32, 32, 24), signal=500, noise=5, ghost=50, seed=0):
+    """The voxels of a noisy sphere with a Nyquist ghost shifted half the field of view along y, x varying fastest."""
+    nx, ny, nz = shape
+    x, y, z = np.ogrid[:nx, :ny, :nz]
+    sphere = (x - nx / 2) ** 2 + (y - ny / 2) ** 2 + (z - nz / 2) ** 2 < (min(shape) / 3) ** 2
+    volume = np.random.RandomState(seed).normal(4 * noise, noise, shape)
+    volume[sphere] += signal
+    volume[np.roll(sphere, ny // 2, axis=1) & ~sphere] += ghost
+    return np.clip(volume, 0, None).astype('int16').flatten(order='F').tolist()
+
+
+def _dicom_element(group, element, vr, value):
+    """An explicit VR little endian data element."""
+    if len(value) % 2:
+        value += b'\0' if vr == b'UI' else b' '
+    if vr in (b'OB', b'OW', b'SQ', b'UN', b'UT'):
+        return struct.pack('<HH2s2xI', group, element, vr, len(value)) + value
+    return struct.pack('<HH2sH', group, element, vr, len(value)) + value
+
+
+def dicom_bytes(series_uid='1.2.3.1', instance_uid='1.2.3.1.1', modality='MR', pixels=64):
+    """A minimal DICOM Part 10 file with the tags the zip inspector reads."""
+    meta = _dicom_element(0x0002, 0x0010, b'UI', b'1.2.840.10008.1.2.1')
+    body = b''.join([
+        _dicom_element(0x0008, 0x0018, b'UI', instance_uid.encode()),
+        _dicom_element(0x0008, 0x0060, b'CS', modality.encode()),
+        _dicom_element(0x0020, 0x000D, b'UI', b'1.2.3'),
+        _dicom_element(0x0020, 0x000E, b'UI', series_uid.encode()),
+        _dicom_element(0x7FE0, 0x0010, b'OW', bytes(pixels)),
+    ])
+    return (bytes(128) + b'DICM' + _dicom_element(0x0002, 0x0000, b'UL', struct.pack('<I', len(meta))) + meta +
+            body)
+
+
+def zip_bytes(members, compression=zipfile.ZIP_DEFLATED):
+    """A zip archive of the given {name: bytes} members."""
+    buffer = io.BytesIO()
+    with zipfile.ZipFile(buffer, 'w', compression) as archive:
+        for name, data in members.items():
+            archive.writestr(name, data)
+    return buffer.getvalue()
@@ -1,4 +1,6 @@
 """Settings module for test app."""
+import tempfile
+
 ENV = 'development'
 TESTING = True
 SQLALCHEMY_DATABASE_URI = 'sqlite://'
@@ -9,3 +11,6 @@ CACHE_TYPE = 'simple'  # Can be "memcached", "redis", etc.
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 WEBPACK_MANIFEST_PATH = 'webpack/manifest.json'
 WTF_CSRF_ENABLED = False  # Allows form testing
+UPLOAD_FOLDER = tempfile.mkdtemp()
+SCAN_GZIP_LEVEL = 6
+SCAN_GZIP_WORKERS = 4
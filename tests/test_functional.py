@@ -3,11 +3,16 @@
 
 See: http://webtest.readthedocs.org/
 """
+import base64
+import datetime as dt
+
 from flask import url_for
 
+from cookiecutter_mbam.experiment.models import Experiment
+from cookiecutter_mbam.scan.models import UploadJob, UploadSession
 from cookiecutter_mbam.user.models import User
 
-from .factories import UserFactory
+from .factories import UserFactory, nifti_bytes
 
 
 class TestLoggingIn:
@@ -118,3 +123,143 @@ class TestRegistering:
         res = form.submit()
         # sees error
         assert 'Username already registered' in res
+
+
+class TestExperimentListing:
+    """Listing experiments."""
+
+    def test_json_pages_link_to_the_next(self, user, testapp):
+        """The JSON listing pages through the user's experiments with their scans."""
+        for day in range(1, 4):
+            Experiment.create(date=dt.date(2019, 1, day), scanner='GE', num_scans=0, user_id=user.id)
+        res = testapp.get('/')
+        form = res.forms['loginForm']
+        form['username'] = user.username
+        form['password'] = 'myprecious'
+        form.submit().follow()
+        res = testapp.get(url_for('experiment.experiments_json', per_page=2))
+        assert [e['date'] for e in res.json['experiments']] == ['2019-01-03', '2019-01-02']
+        assert res.json['experiments'][0]['scans'] == []
+        res = testapp.get(res.json['next'])
+        assert [e['date'] for e in res.json['experiments']] == ['2019-01-01']
+        assert res.json['next'] is None
+        assert testapp.get(url_for('experiment.experiments')).status_code == 200
+        assert testapp.get(url_for('experiment.experiments', cursor='nonsense'), status=400)
+
+    def test_other_users_experiments_are_not_found(self, user, testapp):
+        """An experiment can only be viewed by the user it belongs to."""
+        other = UserFactory(password='myprecious')
+        mine = Experiment.create(date=dt.date(2019, 1, 1), scanner='GE', num_scans=0, user_id=user.id)
+        theirs = Experiment.create(date=dt.date(2019, 1, 1), scanner='GE', num_scans=0, user_id=other.id)
+        res = testapp.get('/')
+        form = res.forms['loginForm']
+        form['username'] = user.username
+        form['password'] = 'myprecious'
+        form.submit().follow()
+        assert testapp.get(url_for('experiment.single_experiment', id=mine.id)).status_code == 200
+        testapp.get(url_for('experiment.single_experiment', id=theirs.id), status=404)
+
+
+def log_in(testapp, user):
+    """Log a user in through the navbar's form."""
+    form = testapp.get('/').forms['loginForm']
+    form['username'] = user.username
+    form['password'] = 'myprecious'
+    form.submit().follow()
+
+
+class TestScanJobs:
+    """Queued scan uploads."""
+
+    def test_upload_is_queued_with_its_status_url(self, user, testapp):
+        """A scan posted by a JSON client is answered 202 with the queued job, whose status it can then read."""
+        log_in(testapp, user)
+        form = testapp.get(url_for('experiment.add')).forms['newSessionForm']
+        form['date'] = '2019-01-01'
+        form['num_scans'] = '1'
+        form.submit().follow()
+        res = testapp.post(url_for('scan.add'), upload_files=[('scan_file', 'T1.nii', nifti_bytes())],
+                           headers={'Accept': 'application/json'}, status=202)
+        assert res.json['status'] == 'queued'
+        assert res.json['filename'] == 'T1.nii'
+        assert res.headers['Location'].endswith(url_for('scan.job_status', job_id=res.json['id']))
+        status = testapp.get(res.headers['Location'])
+        assert status.json == dict(res.json, experiment_id=Experiment.query.one().id)
+
+    def test_job_status_is_reported_as_json(self, user, testapp):
+        experiment = Experiment.create(date=dt.date(2019, 1, 1), scanner='GE', num_scans=1, user_id=user.id)
+        job = UploadJob.create(user_id=user.id, experiment_id=experiment.id, filename='T1.nii', path='/tmp/T1.nii',
+                               status=UploadJob.FAILED, attempts=5, error='XNAT is down')
+        log_in(testapp, user)
+        res = testapp.get(url_for('scan.job_status', job_id=job.id))
+        assert res.json['status'] == 'failed'
+        assert (res.json['attempts'], res.json['error'], res.json['scan_id']) == (5, 'XNAT is down', None)
+
+    def test_other_users_jobs_are_not_found(self, user, testapp):
+        """A job's status can only be read by the user who queued it."""
+        other = UserFactory(password='myprecious')
+        experiment = Experiment.create(date=dt.date(2019, 1, 1), scanner='GE', num_scans=1, user_id=other.id)
+        job = UploadJob.create(user_id=other.id, experiment_id=experiment.id, filename='T1.nii', path='/tmp/T1.nii')
+        log_in(testapp, user)
+        testapp.get(url_for('scan.job_status', job_id=job.id), status=404)
+        testapp.get(url_for('scan.job_status', job_id=job.id + 1), status=404)
+
+
+class TestResumableUploads:
+    """Resumable, chunked scan uploads."""
+
+    @staticmethod
+    def start(testapp, experiment, data, filename='T1.nii'):
+        metadata = 'filename {},experiment {}'.format(base64.b64encode(filename.encode()).decode(),
+                                                      base64.b64encode(str(experiment.id).encode()).decode())
+        return testapp.post(url_for('scan.create_upload'), headers={'Upload-Length': str(len(data)),
+                                                                    'Upload-Metadata': metadata}, status=201)
+
+    @staticmethod
+    def patch(testapp, location, offset, chunk, status=204):
+        return testapp.patch(location, params=chunk, content_type='application/offset+octet-stream',
+                             headers={'Upload-Offset': str(offset)}, status=status)
+
+    def test_chunks_are_appended_and_the_last_queues_a_job(self, user, testapp):
+        """
+        Given a resumable upload, started with the file's length and name
+        When its chunks are sent in order, one of them twice
+        Then each is acknowledged with the new offset, the repeat conflicts, and the last queues the file's upload
+        """
+        experiment = Experiment.create(date=dt.date(2019, 1, 1), scanner='GE', num_scans=1, user_id=user.id)
+        data = nifti_bytes()
+        log_in(testapp, user)
+        res = self.start(testapp, experiment, data)
+        location = res.headers['Location']
+        assert location.endswith(url_for('scan.upload_session', token=UploadSession.query.one().token))
+        assert (res.headers['Upload-Offset'], res.headers['Upload-Length']) == ('0', str(len(data)))
+
+        assert self.patch(testapp, location, 0, data[:1000]).headers['Upload-Offset'] == '1000'
+        res = self.patch(testapp, location, 0, data[:1000], status=409)
+        assert 'error' in res.json
+        assert testapp.head(location).headers['Upload-Offset'] == '1000'
+        assert UploadJob.query.count() == 0
+
+        res = self.patch(testapp, location, 1000, data[1000:])
+        assert res.headers['Upload-Offset'] == str(len(data))
+        job = UploadJob.query.one()
+        assert res.headers['Upload-Job'] == url_for('scan.job_status', job_id=job.id)
+        assert (job.filename, job.status, job.experiment_id) == ('T1.nii', UploadJob.QUEUED, experiment.id)
+        with open(job.path, 'rb') as f:
+            assert f.read() == data
+
+    def test_other_users_uploads_are_not_found(self, db, user, testapp):
+        """An upload can only be read, continued or abandoned by the user who started it."""
+        other = UserFactory(password='myprecious')
+        db.session.commit()
+        experiment = Experiment.create(date=dt.date(2019, 1, 1), scanner='GE', num_scans=1, user_id=other.id)
+        data = nifti_bytes()
+        log_in(testapp, other)
+        location = self.start(testapp, experiment, data).headers['Location']
+        testapp.get(url_for('public.logout'))
+        log_in(testapp, user)
+        testapp.head(location, status=404)
+        self.patch(testapp, location, 0, data, status=404)
+        testapp.delete(location, status=404)
+        assert UploadSession.query.one().offset == 0
+        assert UploadJob.query.count() == 0
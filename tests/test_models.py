@@ -1,9 +1,17 @@
 # -*- coding: utf-8 -*-
 """Model unit tests."""
 import datetime as dt
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
+from sqlalchemy import event
 
+from cookiecutter_mbam.database import db_transaction
+from cookiecutter_mbam.experiment.models import Experiment
+from cookiecutter_mbam.experiment.service import ExperimentService, InvalidCursor
+from cookiecutter_mbam.scan.models import Scan
+from cookiecutter_mbam.scan.service import ScanService
 from cookiecutter_mbam.user.models import Role, User
 
 from .factories import UserFactory
@@ -65,3 +73,143 @@ class TestUser:
         user.roles.append(role)
         user.save()
         assert role in user.roles
+
+
+@pytest.mark.usefixtures('db')
+class TestDBTransaction:
+    """Unit of work tests."""
+
+    @pytest.fixture
+    def commits(self, db):
+        commits = []
+        listener = lambda session: commits.append(session)  # noqa: E731
+        event.listen(db.session, 'after_commit', listener)
+        yield commits
+        event.remove(db.session, 'after_commit', listener)
+
+    def test_changes_are_committed_once_at_the_end(self, commits):
+        """Create and update in a block commit once, when the outermost block exits."""
+        with db_transaction():
+            user = User.create(username='foo', email='foo@bar.com')
+            with db_transaction():
+                user.update(first_name='Foo')
+            user.roles.append(Role(name='admin'))
+            user.save()
+            assert not commits
+        assert len(commits) == 1
+        assert User.query.filter_by(first_name='Foo').one().roles[0].name == 'admin'
+
+    def test_changes_are_rolled_back_on_error(self, commits):
+        """Nothing in a block that raises is committed."""
+        with pytest.raises(RuntimeError):
+            with db_transaction():
+                User.create(username='foo', email='foo@bar.com')
+                raise RuntimeError
+        assert not commits
+        assert User.query.count() == 0
+        User.create(username='bar', email='bar@bar.com')
+        assert len(commits) == 1
+
+    def test_adding_an_experiment_is_one_transaction(self, user, commits):
+        ExperimentService().add(user, date=dt.date(2019, 1, 1), scanner='GE', num_scans=1)
+        assert len(commits) == 1
+        assert User.get_by_id(user.id).num_experiments == 1
+
+
+@pytest.mark.usefixtures('db')
+class TestCounters:
+    """Counter column tests."""
+
+    def test_increment_adds_to_the_stored_value(self, db, user):
+        """An increment builds on writes the record hasn't seen, and leaves the record unchanged."""
+        experiment = Experiment.create(date=dt.date(2019, 1, 1), scanner='GE', num_scans=None, user_id=user.id)
+        assert experiment.increment('num_scans') == 1
+        Experiment.query.filter_by(id=experiment.id).update({'num_scans': 5})
+        db.session.commit()
+        assert experiment.increment('num_scans', by=2) == 7
+        assert experiment.num_scans == 7
+        assert experiment not in db.session.dirty
+
+    def test_increment_is_rolled_back_with_its_transaction(self, user):
+        """An increment in a block that raises is rolled back with the rest of the block."""
+        user_id = user.id
+        with pytest.raises(RuntimeError):
+            with db_transaction():
+                user.increment('num_experiments')
+                raise RuntimeError
+        assert User.get_by_id(user_id).num_experiments == 0
+
+
+class TestConcurrentCounters:
+    """Counter tests under concurrent writers, against Postgres."""
+
+    def test_parallel_uploads_count_every_scan_and_experiment(self, app, postgres):
+        """Uploads to one experiment on many threads, each adding an experiment too, lose no increments."""
+        threads, uploads = 8, 25
+        user = User.create(username='foo', email='foo@bar.com', num_experiments=0)
+        experiment = Experiment.create(date=dt.date(2019, 1, 1), scanner='GE', num_scans=0, user_id=user.id)
+        user_id, experiment_id = user.id, experiment.id
+        postgres.session.remove()
+        barrier = threading.Barrier(threads)
+
+        def upload(thread):
+            with app.app_context():
+                try:
+                    barrier.wait()
+                    for i in range(uploads):
+                        service = ScanService(user_id, experiment_id)
+                        with db_transaction():
+                            service._add_scan(sha256='{:032x}{:032x}'.format(thread, i))
+                        ExperimentService().add(User.get_by_id(user_id), date=dt.date(2019, 1, 2), scanner='GE',
+                                                num_scans=0)
+                finally:
+                    postgres.session.remove()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            list(executor.map(upload, range(threads)))
+
+        assert Scan.query.filter_by(experiment_id=experiment_id).count() == threads * uploads
+        assert Experiment.get_by_id(experiment_id).num_scans == threads * uploads
+        assert User.get_by_id(user_id).num_experiments == threads * uploads
+
+
+@pytest.mark.usefixtures('db')
+class TestExperimentPages:
+    """Experiment listing tests."""
+
+    @pytest.fixture
+    def experiments(self, user):
+        other = UserFactory()
+        dates = [dt.date(2019, 1, day) for day in (3, 1, 2, 2, 2, 1)]
+        experiments = [Experiment.create(date=date, scanner='GE', num_scans=1, user_id=user.id) for date in dates]
+        Experiment.create(date=dt.date(2019, 1, 4), scanner='GE', num_scans=1, user_id=other.id)
+        for experiment in experiments:
+            Scan.create(experiment_id=experiment.id)
+        return sorted(experiments, key=lambda e: (e.date, e.id), reverse=True)
+
+    def test_pages_follow_on_by_date_and_id(self, user, experiments):
+        """Each page picks up where the last left off, through experiments on the same date, and only the user's."""
+        pages, cursor = [], None
+        while True:
+            page, cursor = ExperimentService().page(user, cursor=cursor, per_page=4 if not pages else 1)
+            pages.append(page)
+            if cursor is None:
+                break
+        assert [len(page) for page in pages] == [4, 1, 1]
+        assert sum(pages, []) == experiments
+
+    def test_scans_are_loaded_with_the_page(self, db, user, experiments):
+        statements = []
+        listener = lambda *args: statements.append(args)  # noqa: E731
+        db.session.expire_all()
+        assert user.id
+        event.listen(db.engine, 'before_cursor_execute', listener)
+        try:
+            page, _ = ExperimentService().page(user, per_page=6)
+            assert [len(experiment.scans) for experiment in page] == [1] * 6
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', listener)
+        assert len(statements) == 2
+
+    def test_unreadable_cursors_are_rejected(self, user):
+        with pytest.raises(InvalidCursor):
+            ExperimentService().page(user, cursor='yesterday')
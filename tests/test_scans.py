@@ -1,11 +1,29 @@
+import datetime as dt
+import gzip
+import hashlib
+import os
+import struct
+import zlib
+from io import BytesIO
+
+import numpy as np
 import pytest
-from pytest_mock import mocker
 from datetime import datetime
 from werkzeug.datastructures import FileStorage
 from cookiecutter_mbam.user import User
-from cookiecutter_mbam.xnat import XNATConnection
 from cookiecutter_mbam.experiment.service import ExperimentService
-from cookiecutter_mbam.scan.service import ScanService
+from cookiecutter_mbam.scan.dicom import inspect_dicom_zip
+from cookiecutter_mbam.scan.jobs import claim_job, run_job
+from cookiecutter_mbam.scan.models import Scan, UploadJob
+from cookiecutter_mbam.scan.nifti import read_nifti_header, read_nifti_file_header
+from cookiecutter_mbam.scan.qc import compute_qc_metrics, process_pool
+from cookiecutter_mbam.scan.preview import AXES, encode_png, mid_slices, preview_path
+from cookiecutter_mbam.scan.service import (ScanService, preview_folder, UploadSessionService, OffsetMismatch,
+                                            ChecksumMismatch, SessionExpired)
+from cookiecutter_mbam.scan.utils import (gzip_file, sniff_file_type, UnsupportedScanFile, NIFTI, NIFTI_GZ, DICOM,
+                                          DICOM_ZIP, NIFTI_ZIP, UNKNOWN)
+
+from .factories import nifti_bytes, dicom_bytes, phantom_voxels, zip_bytes
 
 
 @pytest.fixture(scope='function')
@@ -21,6 +39,7 @@ def new_scan_service(db):
     ss2 = ScanService(user.id, experiment2.id)
     return ss2
 
+
 class TestScanUpload:
 
     def test_uncompressed_scan(self, new_scan_service):
@@ -30,41 +49,33 @@ class TestScanUpload:
         _process_file returns a two tuple: (the gzipped file object, False)
         """
 
-        with open('/Users/katie/spiro/cookiecutter_mbam/files/T1.nii', 'rb') as f:
-            file_object, import_service = new_scan_service._process_file(f)
-            assert not import_service
-            assert type(file_object).__name__ == 'GzipFile'
+        data = nifti_bytes(shape=(32, 32, 32))
+        f = FileStorage(BytesIO(data), filename='T1.nii')
+        file_object, import_service = new_scan_service._process_file(f)
+        assert not import_service
+        assert file_object.tell() == 0
+        assert gzip.decompress(file_object.read()) == data
 
-    def test_zip_file(self, new_scan_service, mocker):
+    def test_zip_file(self, fake_xnat, new_scan_service, mocker):
         """
         Given that an zip folder of dicoms is passed to the scan service upload method
         When the upload method calls _process file
         1) _process_file returns a two tuple: (the file object, True)
         2) _generate_xnat_identifers returns a dict in which the 'resource' type is 'DICOM'
-        3) xnat_put is called with expected args, including imp=True
+        3) the zip is sent to the import service, and the scan XNAT archived is recorded
         """
-
-        with open('/Users/katie/spiro/cookiecutter_mbam/files/DICOM.zip', 'rb') as f:
-            file = FileStorage(f)
-            file.save('/Users/katie/spiro/cookiecutter_mbam/files/DICOM1.zip')
-            print(type(file))
-            print(file.filename)
-
-        print("hey ", type(file))
+        file = FileStorage(BytesIO(zip_bytes({'1.dcm': dicom_bytes()})), filename='DICOM.zip')
         file_object, import_service = new_scan_service._process_file(file)
         assert import_service
-        xc = XNATConnection()
-        xc.xnat_put = mocker.MagicMock()
-        mocker.spy(new_scan_service.xc, 'xnat_put')
         mocker.spy(new_scan_service, '_generate_xnat_identifiers')
-        new_scan_service.upload(f)
+        scan = new_scan_service.process(file)
         new_scan_service._generate_xnat_identifiers.assert_called_with(dcm=True)
         xnat_ids = new_scan_service._generate_xnat_identifiers(dcm=True)
         assert xnat_ids['resource']['xnat_id'] == 'DICOM'
-        new_scan_service.xc.xnat_put.assert_called_with(file=f, imp=True, project= 'MBAM_TEST',
-                                                                   subject='000001', experiment='000001_MR2')
-
-
+        assert fake_xnat.count('POST', '/data/services/import') == 1
+        experiment = new_scan_service.xc.archive_prefix + '/subjects/000001/experiments/000001_MR2'
+        assert scan.xnat_uri == experiment + '/scans/1'
+        assert fake_xnat.files[experiment + '/scans/1/resources/DICOM/files/dicoms.zip'] == file.stream.getvalue()
 
     def test_xnat_ids_correctly_generated_for_multiple_experiments_and_scans(self, new_scan_service):
         """
@@ -72,8 +83,401 @@ class TestScanUpload:
         When xnat ids are generated
         Then test that xnat_experiment_id and xnat_scan_id are as expected
         """
+        xnat_ids = new_scan_service._generate_xnat_identifiers()
+        assert xnat_ids['experiment']['xnat_id'] == '000001_MR2'
+        assert xnat_ids['scan']['xnat_id'] == 'T1_2'
+
+    def test_xnat_ids_are_recorded_for_later_uploads(self, new_scan_service, mocker):
+        """
+        Given a user and experiment without XNAT ids
+        When a scan is processed
+        Then the ids are recorded, so the next upload knows the subject and experiment exist
+        """
+        upload_scan = mocker.patch.object(new_scan_service.xc, 'upload_scan', return_value=('s', 'e', 'x'))
+        assert new_scan_service.user.xnat_backend is None
+        scan = new_scan_service.process(FileStorage(BytesIO(nifti_bytes()), filename='T1.nii'))
+        assert new_scan_service.user.xnat_subject_id == '000001'
+        assert User.get_by_id(new_scan_service.user_id).xnat_backend == 'default'
+        assert new_scan_service.experiment.xnat_experiment_id == '000001_MR2'
+        assert scan.xnat_uri == 'x'
+        new_scan_service.process(FileStorage(BytesIO(nifti_bytes(shape=(4, 4, 4))), filename='T1.nii'))
+        assert upload_scan.call_args[0][1] == {'xnat_subject_id': '000001', 'xnat_experiment_id': '000001_MR2'}
+
+
+class TestDeduplication:
+
+    def test_repeat_upload_short_circuits_to_existing_scan(self, new_scan_service, mocker):
+        """
+        Given a scan the user has already uploaded
+        When the same content is uploaded again, under another name
+        Then no XNAT upload happens and the existing scan is returned
+        """
+        upload_scan = mocker.patch.object(new_scan_service.xc, 'upload_scan', return_value=('s', 'e', 'x'))
+        data = nifti_bytes()
+        first = new_scan_service.process(FileStorage(BytesIO(data), filename='T1.nii'))
+        assert first.sha256 == hashlib.sha256(data).hexdigest()
+        assert upload_scan.call_count == 1
+
+        again = new_scan_service.process(FileStorage(BytesIO(data), filename='T1_again.nii'))
+        assert again.id == first.id
+        assert upload_scan.call_count == 1
+
+        other = new_scan_service.process(FileStorage(BytesIO(nifti_bytes(shape=(4, 4, 4))), filename='T1.nii'))
+        assert other.id != first.id
+        assert upload_scan.call_count == 2
+
+    def test_repeat_upload_is_not_compressed_or_checked(self, new_scan_service, mocker):
+        """
+        Given a scan the user has already uploaded
+        When the same content is uploaded again
+        Then it is recognised before it is gzipped or its QC started
+        """
+        mocker.patch.object(new_scan_service.xc, 'upload_scan', return_value=('s', 'e', 'x'))
+        compress = mocker.patch('cookiecutter_mbam.scan.service.gzip_file', wraps=gzip_file)
+        submit_qc = mocker.spy(new_scan_service, '_submit_qc')
+        data = nifti_bytes()
+        first = new_scan_service.process(FileStorage(BytesIO(data), filename='T1.nii'))
+        assert compress.call_count == submit_qc.call_count == 1
+
+        assert new_scan_service.process(FileStorage(BytesIO(data), filename='T1_again.nii')).id == first.id
+        assert compress.call_count == submit_qc.call_count == 1
+
+
+class TestNiftiHeader:
+
+    @pytest.mark.parametrize('byteorder', ['<', '>'])
+    def test_reads_geometry_in_either_byte_order(self, byteorder):
+        data = nifti_bytes(shape=(4, 5, 6, 3), pixdim=(1.0, 1.5, 2.0), tr=2.5, byteorder=byteorder)
+        assert read_nifti_header(data) == {
+            'nifti_version': 1, 'datatype': 4, 'qform_code': 1, 'sform_code': 1,
+            'dim_x': 4, 'dim_y': 5, 'dim_z': 6, 'dim_t': 3,
+            'pixdim_x': 1.0, 'pixdim_y': 1.5, 'pixdim_z': 2.0, 'tr': 2.5,
+        }
+
+    def test_reads_nifti2_and_converts_units(self):
+        header = bytearray(544)
+        struct.pack_into('<i8sh', header, 0, 540, b'n+2\0\r\n\x1a\n', 16)
+        struct.pack_into('<8q', header, 16, 4, 64, 64, 30, 100, 1, 1, 1)
+        struct.pack_into('<8d', header, 104, 1.0, 0.002, 0.002, 0.004, 800.0, 0, 0, 0)
+        struct.pack_into('<2i', header, 344, 0, 4)
+        struct.pack_into('<i', header, 500, 1 | 16)  # meters and milliseconds
+        geometry = read_nifti_header(bytes(header))
+        assert geometry['nifti_version'] == 2
+        assert (geometry['dim_x'], geometry['dim_y'], geometry['dim_z'], geometry['dim_t']) == (64, 64, 30, 100)
+        assert geometry['pixdim_x'] == pytest.approx(2.0)
+        assert geometry['pixdim_z'] == pytest.approx(4.0)
+        assert geometry['tr'] == pytest.approx(0.8)
+        assert (geometry['qform_code'], geometry['sform_code']) == (0, 4)
+
+    def test_reads_gzipped_files_without_consuming_them(self):
+        f = BytesIO(gzip.compress(nifti_bytes(shape=(16, 16, 16))))
+        assert read_nifti_file_header(f)['dim_t'] is None
+        assert f.tell() == 0
+        assert read_nifti_file_header(BytesIO(zip_bytes({'IM1': dicom_bytes()}))) is None
+
+    def test_scans_can_be_queried_by_geometry(self, new_scan_service, mocker):
+        """
+        Given NIfTI scans of different geometries
+        When they are processed
+        Then their header fields are stored, and the query helpers find them by geometry
+        """
+        mocker.patch.object(new_scan_service.xc, 'upload_scan', return_value=('s', 'e', 'x'))
+        iso = new_scan_service.process(FileStorage(BytesIO(nifti_bytes(pixdim=(1.0, 1.0, 1.0))), filename='a.nii'))
+        aniso = new_scan_service.process(FileStorage(BytesIO(gzip.compress(nifti_bytes(pixdim=(1.0, 1.0, 3.0)))),
+                                                     filename='b.nii.gz'))
+        assert (aniso.dim_x, aniso.pixdim_z, aniso.datatype) == (8, 3.0, 4)
+        assert Scan.isotropic(1.0).all() == [iso]
+        assert Scan.with_geometry(shape=(8, 8, 8), voxel_size=(1.0, 1.0, 3.0)).all() == [aniso]
+        assert Scan.with_geometry(shape=(8, 8, 9)).count() == 0
+
+
+class TestPreviews:
+
+    def test_memory_mapped_and_streamed_slices_agree(self, tmpdir):
+        """
+        Given the same volume as an uncompressed file on disk and as a .nii.gz
+        When the mid-slices are extracted by memory map and by streaming
+        Then they are identical, and are the slices through the middle of the volume
+        """
+        shape = (6, 5, 4)
+        voxels = list(range(6 * 5 * 4))
+        path = str(tmpdir.join('T1.nii'))
+        with open(path, 'wb') as f:
+            f.write(nifti_bytes(shape=shape, voxels=voxels, byteorder='>'))
+        with open(path, 'rb') as f:
+            mapped = mid_slices(f)
+        streamed = mid_slices(BytesIO(gzip.compress(nifti_bytes(shape=shape, voxels=voxels, byteorder='>'))))
+        volume = np.array(voxels).reshape(shape, order='F')
+        expected = [volume[3, :, :], volume[:, 2, :], volume[:, :, 2]]
+        for image, streamed_image, slice_ in zip(mapped, streamed, expected):
+            assert (image == streamed_image).all()
+            assert (image == np.flipud(slice_.T)).all()
+
+    def test_encodes_a_valid_png(self):
+        image = np.arange(12, dtype=np.uint8).reshape((3, 4))
+        png = encode_png(image)
+        assert png.startswith(b'\x89PNG\r\n\x1a\n')
+        width, height = struct.unpack('>II', png[16:24])
+        assert (width, height) == (4, 3)
+        idat_length = struct.unpack('>I', png[33:37])[0]
+        raw = zlib.decompress(png[41:41 + idat_length])
+        assert raw == b''.join(b'\0' + row.tobytes() for row in image)
+
+    def test_processing_a_nifti_caches_its_previews(self, new_scan_service, mocker):
+        mocker.patch.object(new_scan_service.xc, 'upload_scan', return_value=('s', 'e', 'x'))
+        scan = new_scan_service.process(FileStorage(BytesIO(nifti_bytes(shape=(16, 16, 8))), filename='T1.nii'))
+        for axis in AXES:
+            with open(preview_path(preview_folder(), scan.id, axis), 'rb') as f:
+                assert f.read(8) == b'\x89PNG\r\n\x1a\n'
+
+
+class TestQualityControl:
+
+    def test_metrics_of_a_phantom(self, tmpdir):
+        """
+        Given a noisy sphere with a faint ghost
+        When its QC metrics are computed serially and on a process pool
+        Then both agree, and they find the sphere, its SNR and the ghost
+        """
+        path = str(tmpdir.join('phantom.nii'))
+        with open(path, 'wb') as f:
+            f.write(nifti_bytes(shape=(32, 32, 24), voxels=phantom_voxels()))
+        metrics = compute_qc_metrics(path, slab_size=5)
+        assert compute_qc_metrics(path, executor=process_pool(2), slab_size=5) == metrics
+        assert metrics['min'] <= metrics['robust_min'] < metrics['robust_max'] <= metrics['max']
+        assert sum(metrics['histogram']['counts']) == 32 * 32 * 24
+        assert 0.05 < metrics['foreground_fraction'] < 0.2
+        assert metrics['snr'] > 20
+        assert 0.05 < metrics['ghosting_ratio'] < 0.15
+
+    def test_processing_a_nifti_stores_its_metrics(self, new_scan_service, mocker):
+        mocker.patch.object(new_scan_service.xc, 'upload_scan', return_value=('s', 'e', 'x'))
+        data = gzip.compress(nifti_bytes(shape=(32, 32, 24), voxels=phantom_voxels()))
+        scan = new_scan_service.process(FileStorage(BytesIO(data), filename='T1.nii.gz'))
+        assert Scan.get_by_id(scan.id).qc_metrics['snr'] > 20
+
+
+class TestUploadJobs:
+
+    def test_upload_queues_a_job_that_a_worker_runs(self, new_scan_service, mocker):
+        """
+        Given an uploaded file
+        When the scan service upload method is called
+        Then the file is staged and a job queued, and a worker claims the job once, processes it and cleans up
+        """
+        data = nifti_bytes()
+        job = new_scan_service.upload(FileStorage(BytesIO(data), filename='T1.nii'))
+        assert job.status == UploadJob.QUEUED
+        with open(job.path, 'rb') as f:
+            assert f.read() == data
 
-        with open('/Users/katie/spiro/cookiecutter_mbam/files/T1.nii.gz', 'rb') as f:
-            xnat_ids = new_scan_service._generate_xnat_identifiers()
-            assert xnat_ids['experiment']['xnat_id'] == '000001_MR2'
-            assert xnat_ids['scan']['xnat_id'] == 'T1_2'
+        scan = Scan.create(experiment_id=job.experiment_id)
+        process = mocker.patch.object(ScanService, 'process', return_value=scan)
+        claimed = claim_job()
+        assert claimed.id == job.id
+        assert claimed.status == UploadJob.RUNNING
+        assert claimed.attempts == 1
+        assert claim_job() is None
+
+        run_job(claimed)
+        assert process.call_args[0][0].filename == 'T1.nii'
+        assert job.status == UploadJob.DONE
+        assert job.scan_id == scan.id
+        assert not os.path.exists(job.path)
+
+    def test_failing_job_is_retried_until_out_of_attempts(self, new_scan_service, mocker, app):
+        """
+        Given a job whose processing raises
+        When workers run it
+        Then it is requeued until SCAN_JOB_MAX_ATTEMPTS is reached, and then marked failed
+        """
+        app.config.update(SCAN_JOB_MAX_ATTEMPTS=2, SCAN_JOB_RETRY_DELAY=0)
+        mocker.patch.object(ScanService, 'process', side_effect=RuntimeError('XNAT is down'))
+        job = new_scan_service.upload(FileStorage(BytesIO(zip_bytes({'IM0001': dicom_bytes()})), filename='DICOM.zip'))
+
+        run_job(claim_job())
+        assert job.status == UploadJob.QUEUED
+        assert 'XNAT is down' in job.error
+
+        run_job(claim_job())
+        assert job.status == UploadJob.FAILED
+        assert job.attempts == 2
+        assert claim_job() is None
+
+    def test_job_whose_upload_to_xnat_fails_is_retried(self, new_scan_service, fake_xnat, app):
+        """
+        Given a job whose file XNAT fails to store
+        When a worker runs it
+        Then no scan is recorded, and the job is requeued
+        """
+        app.config.update(SCAN_JOB_RETRY_DELAY=0)
+        scans = Scan.query.count()
+        job = new_scan_service.upload(FileStorage(BytesIO(nifti_bytes()), filename='T1.nii'))
+        fake_xnat.fail(count=10, status=500, method='PUT')
+        run_job(claim_job())
+        assert job.status == UploadJob.QUEUED
+        assert 'XNATUploadError' in job.error
+        assert Scan.query.count() == scans
+
+
+class TestResumableUpload:
+
+    def test_chunks_resume_from_the_recorded_offset(self, new_scan_service):
+        """
+        Given a resumable upload
+        When chunks arrive, including a retried chunk with a stale offset and a corrupted chunk
+        Then only in-order, verified chunks are written, and the complete file is queued as a job
+        """
+        data = zip_bytes({'IM{:04}'.format(i): dicom_bytes(pixels=1000) for i in range(4)}, compression=0)
+        service = UploadSessionService(new_scan_service.user.id, new_scan_service.experiment.id)
+        upload = service.create('DICOM.zip', len(data))
+
+        UploadSessionService.append(upload, 0, BytesIO(data[:1000]))
+        assert upload.offset == 1000
+        with pytest.raises(OffsetMismatch):
+            UploadSessionService.append(upload, 0, BytesIO(data[:1000]))
+        with pytest.raises(ChecksumMismatch):
+            UploadSessionService.append(upload, 1000, BytesIO(data[1000:]), checksum=('sha256', b'wrong'))
+        assert upload.offset == 1000
+        assert os.path.getsize(upload.path) == 1000
+
+        UploadSessionService.append(upload, 1000, BytesIO(data[1000:]),
+                                    checksum=('sha256', hashlib.sha256(data[1000:]).digest()))
+        assert upload.is_complete
+        assert upload.job.status == UploadJob.QUEUED
+        assert upload.job.path == upload.path
+        with open(upload.path, 'rb') as f:
+            assert f.read() == data
+
+    def test_abandoned_uploads_expire(self, new_scan_service):
+        """
+        Given a resumable upload that has seen no chunks before its expiry
+        When a chunk arrives, or the expiry sweep runs
+        Then the chunk is refused, and the sweep removes the session and its staged file
+        """
+        service = UploadSessionService(new_scan_service.user.id, new_scan_service.experiment.id)
+        upload = service.create('T1.nii', 10)
+        upload.update(expires_at=dt.datetime.utcnow() - dt.timedelta(seconds=1))
+        with pytest.raises(SessionExpired):
+            UploadSessionService.append(upload, 0, BytesIO(b'0123456789'))
+        path = upload.path
+        assert UploadSessionService.expire_sessions() == 1
+        assert not os.path.exists(path)
+
+
+class TestGzipFile:
+
+    def test_streams_in_chunks_and_reports_stats(self):
+        """
+        Given an uncompressed file larger than the chunk size
+        When it is gzipped
+        Then the result is a readable stream at position 0 that decompresses to the input, and the stats count the bytes
+        """
+        data = os.urandom(10000)
+        gzipped, stats = gzip_file(BytesIO(data), compresslevel=1, chunk_size=1024, spool_size=2048)
+        assert gzipped.tell() == 0
+        assert gzip.decompress(gzipped.read()) == data
+        assert stats.bytes_in == len(data)
+        assert stats.bytes_out == gzipped.tell()
+        assert stats.sha256 == hashlib.sha256(data).hexdigest()
+        assert stats.throughput > 0
+
+    def test_parallel_output_is_a_valid_gzip_stream(self):
+        """
+        Given an input spanning several blocks
+        When it is gzipped on more than one worker
+        Then the concatenated members decompress to the input, in order
+        """
+        data = os.urandom(5000) + bytes(5000) + os.urandom(123)
+        gzipped, stats = gzip_file(BytesIO(data), workers=3, block_size=1000)
+        assert gzip.decompress(gzipped.read()) == data
+        assert stats.bytes_in == len(data)
+        assert stats.sha256 == hashlib.sha256(data).hexdigest()
+        assert gzip.decompress(gzip_file(BytesIO(b''), workers=3)[0].read()) == b''
+
+
+class TestSniffFileType:
+
+    @pytest.mark.parametrize('data, file_type', [
+        (nifti_bytes(), NIFTI),
+        (gzip.compress(nifti_bytes()), NIFTI_GZ),
+        (dicom_bytes(), DICOM),
+        (zip_bytes({'scans/': b'', 'scans/IM0001': dicom_bytes()}), DICOM_ZIP),
+        (zip_bytes({'IM0001': dicom_bytes()}, compression=0), DICOM_ZIP),
+        (zip_bytes({'T1.nii.gz': gzip.compress(nifti_bytes())}), NIFTI_ZIP),
+        (zip_bytes({'scan': nifti_bytes()}), NIFTI_ZIP),
+        (gzip.compress(b'not a scan' * 100), UNKNOWN),
+        (b'plain text', UNKNOWN),
+    ])
+    def test_detects_type_from_header_without_consuming(self, data, file_type):
+        """
+        Given a file of a known type, whatever it is named
+        When its type is sniffed
+        Then the type is detected from its content, and the stream is still at its start
+        """
+        f = FileStorage(BytesIO(data), filename='scan.gz')
+        assert sniff_file_type(f) == file_type
+        assert f.read() == data
+
+    def test_zip_of_nifti_is_rejected(self, new_scan_service):
+        """
+        Given a zip of NIfTI files named like a DICOM zip
+        When it is uploaded
+        Then it is refused before anything is staged or sent to XNAT
+        """
+        f = FileStorage(BytesIO(zip_bytes({'T1.nii': nifti_bytes()})), filename='DICOM.zip')
+        with pytest.raises(UnsupportedScanFile):
+            new_scan_service.upload(f)
+        assert UploadJob.query.count() == 0
+
+
+class TestInspectDicomZip:
+
+    def test_indexes_series_without_extracting(self):
+        """
+        Given a zip of DICOM files from two series, plus a stray file
+        When it is inspected
+        Then the index counts series, instances and modalities, and the stream is left where it was
+        """
+        f = BytesIO(zip_bytes({
+            'scans/': b'',
+            'scans/1/IM1': dicom_bytes('1.1', '1.1.1'),
+            'scans/1/IM2': dicom_bytes('1.1', '1.1.2'),
+            'scans/2/IM1': dicom_bytes('1.2', '1.2.1', modality='CT'),
+            'README.txt': b'hello',
+        }))
+        index = inspect_dicom_zip(f)
+        assert f.tell() == 0
+        assert index['dicom_files'] == 3
+        assert index['other_files'] == 1
+        assert index['modalities'] == ['CT', 'MR']
+        assert [(s['uid'], s['instances']) for s in index['series']] == [('1.1', 2), ('1.2', 1)]
+
+    @pytest.mark.parametrize('members, kwargs', [
+        ({'README.txt': b'hello'}, {}),
+        ({'IM{}'.format(i): dicom_bytes() for i in range(3)}, {'max_members': 2}),
+        ({'IM1': dicom_bytes(pixels=10000)}, {'max_uncompressed_size': 5000}),
+        ({'IM1': dicom_bytes(pixels=1000000)}, {}),
+        ({'../../etc/IM1': dicom_bytes()}, {}),
+    ])
+    def test_rejects_bad_archives(self, members, kwargs):
+        """
+        Given a zip that holds no DICOM files, too many or too large files, a zip bomb, or unsafe paths
+        When it is inspected
+        Then it is rejected
+        """
+        with pytest.raises(UnsupportedScanFile):
+            inspect_dicom_zip(BytesIO(zip_bytes(members)), **kwargs)
+
+    def test_index_is_stored_with_the_scan(self, new_scan_service, mocker):
+        """
+        Given an uploaded zip of DICOM files
+        When the queued job is processed
+        Then the scan records the index built at upload time
+        """
+        mocker.patch.object(new_scan_service.xc, 'upload_scan', return_value=('s', 'e', 'x'))
+        job = new_scan_service.upload(FileStorage(BytesIO(zip_bytes({'IM1': dicom_bytes()})), filename='DICOM.zip'))
+        assert job.dicom_index['dicom_files'] == 1
+        with open(job.path, 'rb') as f:
+            scan = new_scan_service.process(FileStorage(f, filename=job.filename), dicom_index=job.dicom_index)
+        assert Scan.get_by_id(scan.id).dicom_index == job.dicom_index
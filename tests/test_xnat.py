@@ -0,0 +1,674 @@
+# -*- coding: utf-8 -*-
+"""XNAT client, configuration, session pool, cache and upload plan tests."""
+import asyncio
+import datetime as dt
+import posixpath
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+from .factories import UserFactory
+
+from cookiecutter_mbam.commands import xnat_reconcile
+from cookiecutter_mbam.experiment.models import Experiment
+from cookiecutter_mbam.scan.models import Scan
+from cookiecutter_mbam.user.models import User
+from cookiecutter_mbam.xnat import XNATConfig, XNATConnection, XNATUploadError, load_xnat_config
+from cookiecutter_mbam.xnat.config import load_xnat_backends
+from cookiecutter_mbam.experiment.service import ExperimentService
+from cookiecutter_mbam.xnat.ids import experiment_label, experiment_labels, reserve, scan_labels
+from cookiecutter_mbam.xnat.cache import XNATExistenceCache, XNATResponseCache
+from cookiecutter_mbam.xnat.planner import plan_upload
+from cookiecutter_mbam.xnat.pool import XNATPoolExhausted, XNATSessionPool
+from cookiecutter_mbam.xnat.protocol import Request, upload_steps
+from cookiecutter_mbam.xnat.reconcile import Discrepancies, reconcile
+from cookiecutter_mbam.xnat.sharding import HashRing, hash_ring
+from cookiecutter_mbam.xnat.transfer import TokenBucket, UploadStream
+
+
+class TestXNATConfig:
+
+    def test_file_settings_can_be_overridden(self, tmpdir):
+        path = tmpdir.join('setup.cfg')
+        path.write('[XNAT]\nuser = admin\npassword = admin\nserver = http://xnat\nproject = P\n'
+                   '[uploads]\nuploaded_scans_dest = /tmp/files\n')
+        config = load_xnat_config(str(path), password='secret', project='Q')
+        assert config == XNATConfig(server='http://xnat', user='admin', password='secret', project='Q',
+                                    archive_prefix='/data/archive/projects/Q',
+                                    prearchive_prefix='/data/prearchive/projects/Q', file_dest='/tmp/files')
+
+    def test_connections_use_the_config_loaded_with_the_app(self, app):
+        assert isinstance(app.config['XNAT'], XNATConfig)
+        xc = XNATConnection()
+        assert xc.config is app.config['XNAT']
+        assert xc.archive_prefix == '/data/archive/projects/{}'.format(xc.project)
+
+    def test_backends_default_to_the_xnat_section(self, tmpdir):
+        path = tmpdir.join('setup.cfg')
+        path.write('[XNAT]\nuser = admin\npassword = admin\nserver = http://xnat\nproject = P\n'
+                   '[XNAT:second]\nserver = http://xnat2\n')
+        backends = load_xnat_backends(str(path), project='Q')
+        assert list(backends) == ['default', 'second']
+        assert backends['default'].project == 'Q'
+        assert backends['second'] == backends['default']._replace(server='http://xnat2', project='P',
+                                                                  archive_prefix='/data/archive/projects/P',
+                                                                  prearchive_prefix='/data/prearchive/projects/P')
+
+
+class TestSharding:
+
+    def test_adding_a_backend_moves_only_its_share_of_subjects(self):
+        keys = [str(i).zfill(6) for i in range(10000)]
+        before = HashRing(['a', 'b', 'c'])
+        after = HashRing(['a', 'b', 'c', 'd'])
+        moved = [key for key in keys if before.node(key) != after.node(key)]
+        assert {after.node(key) for key in moved} == {'d'}
+        assert 0.15 < len(moved) / len(keys) < 0.35
+        shares = [sum(before.node(key) == name for key in keys) / len(keys) for name in 'abc']
+        assert all(0.25 < share < 0.42 for share in shares)
+
+    def test_new_subjects_are_assigned_a_backend_and_keep_it(self, app, db):
+        app.config['XNAT_BACKENDS'] = OrderedDict([('default', app.config['XNAT']),
+                                                   ('second', app.config['XNAT']._replace(server='http://xnat2'))])
+        new, legacy = UserFactory(), UserFactory(xnat_subject_id='000002')
+        backend = XNATConnection.backend_for(new, '000001')
+        assert backend == hash_ring(('default', 'second')).node('000001')
+        xc = XNATConnection.for_user(new, '000001')
+        assert xc.server == ('http://xnat2' if backend == 'second' else app.config['XNAT'].server)
+        assert new.xnat_backend is None
+        assert XNATConnection.for_user(legacy, '000002').config is app.config['XNAT']
+        legacy.xnat_backend = 'second'
+        assert XNATConnection.for_user(legacy, '000002').server == 'http://xnat2'
+
+
+class FakeResponse:
+
+    def __init__(self, status_code, body=None, headers=None, text=''):
+        self.status_code = status_code
+        self.body = body
+        self.headers = headers or {}
+        self.text = text
+
+    def json(self):
+        return self.body
+
+
+class FakeSession:
+    """Stands in for an xnatpy session, counting the requests made on it."""
+
+    def __init__(self, objects=None):
+        self.expired = False
+        self.disconnected = False
+        self.requests = []
+        self.statuses = []
+        self.objects = objects if objects is not None else set()
+
+    def get(self, path, format=None, query=None, accepted_status=None, headers=None):
+        if self.expired:
+            raise RuntimeError('Invalid response from XNATSession (status 401)')
+        self.requests.append(('GET', path))
+        body = {'ResultSet': {'Result': [{'ID': posixpath.basename(uri)} for uri in sorted(self.objects)
+                                         if posixpath.dirname(uri) == path]}}
+        etag = '"{:x}"'.format(hash(repr(body)) & 0xffffffff)
+        status = 304 if (headers or {}).get('If-None-Match') == etag else 200
+        self.statuses.append(status)
+        return FakeResponse(status, body if status == 200 else None, {'ETag': etag})
+
+    def put(self, path):
+        if self.expired:
+            raise RuntimeError('Invalid response from XNATSession (status 401)')
+        self.requests.append(('PUT', path))
+        self.objects.add(path.split('?')[0])
+
+    def upload_stream(self, uri, stream, query=None, content_type=None, method='put'):
+        """A file upload, or the import service, which archives the zip's one series as scan 4."""
+        self.requests.append((method.upper(), uri))
+        stream.seek(0)
+        while stream.read(8192):
+            pass
+        if uri != '/data/services/import':
+            return FakeResponse(200, headers={}, text='')
+        experiment = '/data/archive/projects/{project}/subjects/{subject}/experiments/{session}'.format(**query)
+        self.objects.add(experiment + '/scans/4')
+        return FakeResponse(200, headers={}, text=experiment + '\r\n')
+
+    def disconnect(self):
+        self.disconnected = True
+
+
+@pytest.fixture
+def sessions():
+    return []
+
+
+@pytest.fixture
+def pool(sessions):
+    def connect(server, user, password):
+        sessions.append(FakeSession())
+        return sessions[-1]
+    return XNATSessionPool(connect=connect)
+
+
+CREDENTIALS = ('http://xnat', 'admin', 'admin')
+
+
+class TestXNATSessionPool:
+
+    def test_sessions_are_reused(self, pool, sessions):
+        for i in range(5):
+            pool.run(lambda session: session.put('/data/projects/P/subjects/{}'.format(i)), *CREDENTIALS)
+        assert len(sessions) == 1
+        assert len(sessions[0].requests) == 5
+
+    def test_expired_session_is_replaced_and_the_call_repeated(self, pool, sessions):
+        pool.run(lambda session: session.put('/a'), *CREDENTIALS)
+        sessions[0].expired = True
+        pool.run(lambda session: session.put('/b'), *CREDENTIALS)
+        assert len(sessions) == 2
+        assert sessions[0].disconnected
+        assert sessions[1].requests == [('PUT', '/b')]
+
+    def test_errors_on_healthy_sessions_propagate(self, pool, sessions):
+        def fail(session):
+            raise ValueError('conflict')
+        with pytest.raises(ValueError):
+            pool.run(fail, *CREDENTIALS)
+        assert len(sessions) == 1
+        assert not sessions[0].disconnected
+        pool.run(lambda session: session.put('/a'), *CREDENTIALS)
+        assert len(sessions) == 1
+
+    def test_stale_sessions_are_checked_and_idle_ones_evicted(self, pool, sessions):
+        pool.check_interval = 0
+        pool.run(lambda session: session.put('/a'), *CREDENTIALS)
+        pool.run(lambda session: session.put('/b'), *CREDENTIALS)
+        assert sessions[0].requests[1] == ('GET', '/data/JSESSION')
+
+        pool.idle_timeout = 0
+        pool.run(lambda session: session.put('/c'), *CREDENTIALS)
+        assert sessions[0].disconnected
+        assert len(sessions) == 2
+
+    def test_pool_is_bounded(self, pool, sessions):
+        pool.size = 2
+        pool.timeout = 0.01
+        with pool.session(*CREDENTIALS), pool.session(*CREDENTIALS):
+            with pytest.raises(XNATPoolExhausted):
+                with pool.session(*CREDENTIALS):
+                    pass
+        with pool.session(*CREDENTIALS):
+            pass
+        assert len(sessions) == 2
+
+
+class TestXNATExistenceCache:
+
+    def test_entries_expire(self):
+        now = [0]
+        cache = XNATExistenceCache(ttl=10, clock=lambda: now[0])
+        cache.add('/a')
+        assert '/a' in cache
+        now[0] = 11
+        assert '/a' not in cache
+        assert not len(cache)
+
+    def test_least_recently_used_entries_are_evicted(self):
+        cache = XNATExistenceCache(maxsize=2)
+        cache.seed(['/a', '/b'])
+        assert '/a' in cache
+        cache.add('/c')
+        assert '/a' in cache and '/c' in cache
+        assert '/b' not in cache
+
+
+@pytest.fixture
+def xnat(app):
+    objects = set()
+    sessions = []
+
+    def connect(server, user, password):
+        sessions.append(FakeSession(objects))
+        return sessions[-1]
+    app.extensions['xnat_pool'] = XNATSessionPool(connect=connect)
+    app.extensions['xnat_cache'] = XNATExistenceCache()
+    app.extensions['xnat_responses'] = XNATResponseCache()
+    xc = XNATConnection(XNATConfig('http://xnat', 'admin', 'admin', 'P', '/data/archive/projects/P',
+                                   '/data/prearchive/projects/P', '/tmp'))
+    return xc, objects, sessions
+
+
+class TestUploadScan:
+
+    @staticmethod
+    def xnat_ids(subject, experiment, scan):
+        return {'subject': {'xnat_id': subject},
+                'experiment': {'xnat_id': experiment, 'query_string': '?xnat:mrSessionData/date=06/01/2005'},
+                'scan': {'xnat_id': scan, 'query_string': '?xsiType=xnat:mrScanData'},
+                'resource': {'xnat_id': 'NIFTI'},
+                'file': {'xnat_id': 'T1.nii.gz', 'query_string': '?xsi:type=xnat:mrScanData'}}
+
+    def test_only_missing_objects_are_put(self, xnat):
+        """
+        Given an XNAT project
+        When a new subject uploads, then uploads again into a new experiment, without their XNAT ids on record
+        Then listings tell which objects exist, and only the objects that don't, and that XNAT doesn't create along
+        with their children, are PUT
+        """
+        xc, objects, sessions = xnat
+        xc.upload_scan(self.xnat_ids('000001', '000001_MR1', 'T1_1'), {}, BytesIO(b'scan'))
+        requests = sorted(request for session in sessions for request in session.requests)
+        assert requests[:2] == [('GET', '/data/archive/projects/P/subjects/000001/experiments'),
+                                ('GET', '/data/archive/projects/P/subjects/000001/experiments/000001_MR1/scans')]
+        assert [method for method, _ in requests[2:]] == ['PUT', 'PUT', 'PUT']
+
+        for session in sessions:
+            del session.requests[:]
+        xc.upload_scan(self.xnat_ids('000001', '000001_MR2', 'T1_1'), {}, BytesIO(b'scan'))
+        requests = [request for session in sessions for request in session.requests]
+        assert sorted(method for method, _ in requests) == ['GET', 'GET', 'PUT', 'PUT', 'PUT']
+        assert requests[-3][1].startswith('/data/archive/projects/P/subjects/000001/experiments/000001_MR2?')
+
+    def test_objects_on_record_are_not_checked(self, xnat):
+        xc, objects, sessions = xnat
+        existing = {'xnat_subject_id': '000001', 'xnat_experiment_id': '000001_MR1'}
+        xc.upload_scan(self.xnat_ids('000001', '000001_MR1', 'T1_2'), existing, BytesIO(b'scan'))
+        scan = '/data/archive/projects/P/subjects/000001/experiments/000001_MR1/scans/T1_2'
+        assert sessions[0].requests == [
+            ('GET', posixpath.dirname(scan)),
+            ('PUT', scan + '?xsiType=xnat:mrScanData'),
+            ('PUT', scan + '/resources/NIFTI/files/T1.nii.gz?xsi:type=xnat:mrScanData&inbody=true')]
+
+
+class TestXNATGet:
+
+    def test_unchanged_listings_are_revalidated_not_downloaded(self, xnat):
+        """
+        Given a listing that has been read before
+        When it is read again
+        Then XNAT answers with a 304 and the cached body is returned, until an object is PUT into it
+        """
+        xc, objects, sessions = xnat
+        subjects = '/data/archive/projects/P/subjects'
+        objects.add(subjects + '/000001')
+        assert xc.xnat_list(subjects) == [{'ID': '000001'}]
+        assert xc.xnat_list(subjects) == [{'ID': '000001'}]
+        assert sessions[0].statuses == [200, 304]
+
+        xc.xnat_put(subjects + '/000002')
+        assert xc.xnat_list(subjects) == [{'ID': '000001'}, {'ID': '000002'}]
+        assert sessions[0].statuses[-1] == 200
+
+    def test_imported_scan_is_found(self, xnat, tmpdir):
+        """
+        Given an experiment with a scan
+        When a zip of DICOM files is imported into it
+        Then the scan XNAT archived is found and its uri returned
+        """
+        xc, objects, sessions = xnat
+        xc.file_dest = str(tmpdir)
+        experiment = '/data/archive/projects/P/subjects/000001/experiments/000001_MR1'
+        objects.update([experiment, experiment + '/scans/2'])
+        existing = {'xnat_subject_id': '000001', 'xnat_experiment_id': '000001_MR1'}
+        uris = xc.upload_scan(TestUploadScan.xnat_ids('000001', '000001_MR1', 'T1_2'), existing,
+                              FileStorage(BytesIO(b'PK'), filename='dicoms.zip'), import_service=True)
+        assert uris == ('/data/archive/projects/P/subjects/000001', experiment, experiment + '/scans/4')
+        assert not tmpdir.listdir()
+
+
+class TestUploadPlan:
+
+    PREFIX = '/data/archive/projects/P'
+
+    def test_implicit_parents_are_created_with_their_children(self):
+        plan = plan_upload(self.PREFIX, TestUploadScan.xnat_ids('000001', '000001_MR1', 'T1_1'), {})
+        assert plan.checks == [self.PREFIX + '/subjects/000001/experiments/000001_MR1',
+                               self.PREFIX + '/subjects/000001/experiments/000001_MR1/scans/T1_1']
+        puts = plan.puts()
+        assert [put.level for put in puts] == ['experiment', 'scan', 'file']
+        assert puts[0].implicit == (self.PREFIX + '/subjects/000001',)
+        assert puts[2].implicit == (plan.uris['resource'],)
+        assert plan.report() == {'requests': 5, 'round_trips': 4, 'requests_saved': 1, 'round_trips_saved': 2}
+
+    def test_objects_found_to_exist_are_not_put(self):
+        plan = plan_upload(self.PREFIX, TestUploadScan.xnat_ids('000001', '000001_MR1', 'T1_2'), {})
+        found = {plan.uris['experiment']}
+        assert [put.level for put in plan.puts(found)] == ['scan', 'file']
+        assert plan.report(found) == {'requests': 4, 'round_trips': 3, 'requests_saved': 2, 'round_trips_saved': 3}
+
+    def test_known_objects_are_not_checked(self):
+        known = {self.PREFIX + '/subjects/000001/experiments/000001_MR1/scans/T1_1'}
+        plan = plan_upload(self.PREFIX, TestUploadScan.xnat_ids('000001', '000001_MR1', 'T1_1'),
+                           {'xnat_experiment_id': '000001_MR1'}, known=known.__contains__)
+        assert plan.checks == []
+        assert plan.stages() == [[plan.puts()[0]]]
+        assert plan.puts()[0].level == 'file'
+
+    def test_import_service_plans_stop_at_the_experiment(self):
+        plan = plan_upload(self.PREFIX, TestUploadScan.xnat_ids('000001', '000001_MR1', 'T1_1'), {},
+                           import_service=True)
+        assert [put.level for put in plan.puts()] == ['experiment']
+        assert 'scan' not in plan.uris
+
+
+class TestUploadSteps:
+
+    CONFIG = XNATConfig('http://xnat', 'admin', 'admin', 'P', '/data/archive/projects/P', '/data/prearchive/projects/P',
+                        '/tmp')
+    PREFIX = '/data/archive/projects/P'
+
+    def test_collections_are_listed_once_together_and_puts_follow_in_order(self):
+        """
+        Given a new subject's first upload
+        When its steps are run without any transport
+        Then the collections of the objects to check are listed in one stage, and each PUT is a stage of its own
+        """
+        cache = XNATExistenceCache()
+        steps = upload_steps(self.CONFIG, cache, TestUploadScan.xnat_ids('000001', '000001_MR1', 'T1_1'), {}, 'file')
+        experiment = self.PREFIX + '/subjects/000001/experiments/000001_MR1'
+        assert next(steps) == [Request('xnat_list', (posixpath.dirname(experiment),), {}),
+                               Request('xnat_list', (experiment + '/scans',), {})]
+        puts = [steps.send([[{'ID': '000001_MR1'}], None])]
+        with pytest.raises(StopIteration) as stop:
+            while True:
+                puts.append(steps.send([True]))
+        assert [stage[0].method for stage in puts] == ['xnat_put', 'xnat_put']
+        assert puts[-1][0].kwargs['file'] == 'file'
+        assert stop.value.value == (self.PREFIX + '/subjects/000001', experiment, experiment + '/scans/T1_1')
+        assert 'http://xnat' + experiment + '/scans/T1_1' in cache
+
+    def test_failed_puts_and_imports_raise(self):
+        steps = upload_steps(self.CONFIG, XNATExistenceCache(),
+                             TestUploadScan.xnat_ids('000001', '000001_MR1', 'T1_1'), {}, 'file')
+        next(steps)
+        steps.send([None, None])
+        with pytest.raises(XNATUploadError):
+            steps.send([False])
+
+        existing = {'xnat_subject_id': '000001', 'xnat_experiment_id': '000001_MR1'}
+        steps = upload_steps(self.CONFIG, XNATExistenceCache(),
+                             TestUploadScan.xnat_ids('000001', '000001_MR1', 'T1_1'), existing, 'zip',
+                             import_service=True)
+        assert next(steps)[0].method == 'xnat_list'
+        assert steps.send([[{'ID': '1'}]])[0].method == 'xnat_import'
+        with pytest.raises(XNATUploadError):
+            steps.send([None])
+
+    def test_imported_scan_is_the_new_one(self):
+        existing = {'xnat_subject_id': '000001', 'xnat_experiment_id': '000001_MR1'}
+        steps = upload_steps(self.CONFIG, XNATExistenceCache(),
+                             TestUploadScan.xnat_ids('000001', '000001_MR1', 'T1_1'), existing, 'zip',
+                             import_service=True)
+        experiment = self.PREFIX + '/subjects/000001/experiments/000001_MR1'
+        next(steps)
+        steps.send([[{'ID': '1'}, {'ID': '2'}]])
+        steps.send([experiment])
+        with pytest.raises(StopIteration) as stop:
+            steps.send([[{'ID': '1'}, {'ID': '2'}, {'ID': '3'}]])
+        assert stop.value.value[2] == experiment + '/scans/3'
+
+
+class TestAsyncXNATConnection:
+
+    def test_uploads_run_concurrently_with_the_same_semantics(self, app, fake_xnat):
+        """
+        Given a slow XNAT server
+        When several scans are uploaded at once
+        Then their requests overlap, up to the per-host limit, each file arrives whole, and objects are PUT once
+        """
+        from cookiecutter_mbam.xnat.aio import AsyncXNATConnection
+
+        fake_xnat.latency = 0.05
+        uploads = [(TestUploadScan.xnat_ids('00000{}'.format(i), '00000{}_MR1'.format(i), 'T1_1'), {},
+                    BytesIO(bytes([i]) * 3000), False) for i in range(6)]
+
+        async def run():
+            async with AsyncXNATConnection(limit_per_host=4, chunk_size=1024) as xc:
+                return await xc.upload_scans(uploads)
+
+        results = asyncio.run(run())
+        prefix = app.config['XNAT'].archive_prefix
+        assert results[2] == (prefix + '/subjects/000002', prefix + '/subjects/000002/experiments/000002_MR1',
+                              prefix + '/subjects/000002/experiments/000002_MR1/scans/T1_1')
+        assert 1 < fake_xnat.most_in_flight <= 4
+        assert fake_xnat.count('PUT') == 6 * 3
+        assert fake_xnat.files[results[3][2] + '/resources/NIFTI/files/T1.nii.gz'] == bytes([3]) * 3000
+
+    def test_failed_uploads_raise(self, app, fake_xnat):
+        from cookiecutter_mbam.xnat.aio import AsyncXNATConnection
+
+        fake_xnat.fail(count=10, status=500, method='PUT')
+
+        async def run():
+            async with AsyncXNATConnection() as xc:
+                return await xc.upload_scans([(TestUploadScan.xnat_ids('000001', '000001_MR1', 'T1_1'), {},
+                                               BytesIO(b'scan'), False)])
+
+        assert isinstance(asyncio.run(run())[0], XNATUploadError)
+
+
+class TestAgainstFakeXNAT:
+
+    @staticmethod
+    def xnat_ids(subject, experiment, scan):
+        return TestUploadScan.xnat_ids(subject, experiment, scan)
+
+    def test_scan_is_archived(self, app, fake_xnat):
+        """
+        Given a fake XNAT server
+        When a scan is uploaded twice, for a new subject and then into the same experiment
+        Then the objects and file are archived, and the second upload only creates the new scan
+        """
+        xc = XNATConnection()
+        prefix = xc.archive_prefix
+        uris = xc.upload_scan(self.xnat_ids('000001', '000001_MR1', 'T1_1'), {}, BytesIO(b'scan' * 1000))
+        assert uris[2] == prefix + '/subjects/000001/experiments/000001_MR1/scans/T1_1'
+        assert fake_xnat.files[uris[2] + '/resources/NIFTI/files/T1.nii.gz'] == b'scan' * 1000
+        assert fake_xnat.exists(prefix + '/subjects/000001')
+
+        puts = fake_xnat.count('PUT')
+        xc.upload_scan(self.xnat_ids('000001', '000001_MR1', 'T1_2'), {}, BytesIO(b'scan'))
+        assert fake_xnat.count('PUT') - puts == 2
+
+    def test_failed_puts_are_reported(self, app, fake_xnat):
+        xc = XNATConnection()
+        fake_xnat.fail(status=500, method='PUT')
+        assert not xc.xnat_put(xc.archive_prefix + '/subjects/000001/experiments/000001_MR1')
+        assert xc.xnat_put(xc.archive_prefix + '/subjects/000001/experiments/000001_MR1')
+
+    def test_failed_uploads_raise(self, app, fake_xnat):
+        """An upload whose file PUT or import fails raises, rather than returning URIs of objects that don't exist."""
+        xc = XNATConnection()
+        fake_xnat.fail(count=10, status=500, method='PUT')
+        with pytest.raises(XNATUploadError):
+            xc.upload_scan(self.xnat_ids('000001', '000001_MR1', 'T1_1'), {}, BytesIO(b'scan'))
+        fake_xnat.fail(count=10, status=500, method='POST')
+        with pytest.raises(XNATUploadError):
+            xc.upload_scan(self.xnat_ids('000002', '000002_MR1', 'T1_1'), {}, BytesIO(b'scan'), import_service=True)
+
+    def test_latency_and_bandwidth_are_injected(self, app, fake_xnat):
+        xc = XNATConnection()
+        xc.xnat_list(xc.archive_prefix + '/subjects')
+        fake_xnat.latency = 0.05
+        fake_xnat.bandwidth = 1024 * 1024
+        start = time.monotonic()
+        xc.upload_scan(self.xnat_ids('000001', '000001_MR1', 'T1_1'), {}, BytesIO(bytes(256 * 1024)))
+        # Five requests, and a quarter of a second to send the file
+        assert time.monotonic() - start >= 5 * 0.05 + 0.25
+
+    def test_uploads_report_progress_and_keep_to_the_bandwidth_cap(self, app, fake_xnat):
+        """
+        Given a cap of 1 MB/s on uploads
+        When a 512 KB scan is uploaded
+        Then progress is reported as it is sent, the file arrives whole, and it takes at least the quarter of a second
+        the cap allows beyond its burst
+        """
+        app.config['XNAT_UPLOAD_BANDWIDTH'] = 1024 * 1024
+        xc = XNATConnection()
+        reports = []
+        start = time.monotonic()
+        uris = xc.upload_scan(self.xnat_ids('000001', '000001_MR1', 'T1_1'), {}, BytesIO(b'scan' * 128 * 1024),
+                              progress=lambda sent, total: reports.append((sent, total)))
+        assert time.monotonic() - start >= 0.25
+        assert fake_xnat.files[uris[2] + '/resources/NIFTI/files/T1.nii.gz'] == b'scan' * 128 * 1024
+        assert reports[-1] == (512 * 1024, 512 * 1024)
+        assert [sent for sent, _ in reports] == sorted(sent for sent, _ in reports)
+
+    def test_zips_are_streamed_to_the_import_service(self, app, fake_xnat, tmpdir):
+        xc = XNATConnection()
+        reports = []
+        uris = xc.upload_scan(self.xnat_ids('000001', '000001_MR1', 'T1_1'), {},
+                              FileStorage(BytesIO(b'PK' + bytes(1000)), filename='dicoms.zip'), import_service=True,
+                              progress=lambda sent, total: reports.append((sent, total)))
+        assert uris[2] == xc.archive_prefix + '/subjects/000001/experiments/000001_MR1/scans/1'
+        assert reports == [(1002, 1002)]
+        assert not tmpdir.listdir()
+
+
+class TestUploadStream:
+
+    def test_bucket_makes_callers_wait_off_their_debt(self):
+        now = [0.0]
+        waits = []
+        bucket = TokenBucket(1000, capacity=500, clock=lambda: now[0], sleep=waits.append)
+        bucket.consume(500)
+        bucket.consume(250)
+        bucket.consume(250)
+        assert waits == [0.25, 0.5]
+        now[0] = 2.0
+        bucket.consume(500)
+        assert waits == [0.25, 0.5]
+
+    def test_progress_is_reported_each_chunk_and_at_the_end(self):
+        reports = []
+        stream = UploadStream(BytesIO(bytes(2500)), progress=lambda sent, total: reports.append((sent, total)),
+                              chunk_size=1000)
+        assert len(stream) == 2500
+        while stream.read(300):
+            pass
+        assert reports == [(1200, 2500), (2400, 2500), (2500, 2500)]
+        stream.seek(0)
+        assert stream.read() == bytes(2500)
+        assert reports[-1] == (2500, 2500)
+
+
+class TestReconcile:
+
+    @pytest.fixture
+    def records(self, db, user, fake_xnat):
+        """Two users, one of whose subjects XNAT holds, with an experiment holding one of the two scans recorded"""
+        xc = XNATConnection()
+        subject = xc.archive_prefix + '/subjects/000001'
+        experiment = subject + '/experiments/000001_MR1'
+        for uri in (subject, experiment, experiment + '/scans/T1_1', xc.archive_prefix + '/subjects/000009'):
+            fake_xnat.create(uri)
+        user.update(xnat_subject_id='000001')
+        lost = UserFactory(xnat_subject_id='000002')
+        db.session.commit()
+        held = Experiment(date=dt.date(2019, 1, 1), scanner='GE', num_scans=2, user_id=user.id,
+                          xnat_experiment_id='000001_MR1').save()
+        lost_experiment = Experiment(date=dt.date(2019, 1, 1), scanner='GE', num_scans=1, user_id=lost.id,
+                                     xnat_experiment_id='000002_MR1').save()
+        scans = [Scan(held.id, xnat_uri=experiment + '/scans/T1_1').save(),
+                 Scan(held.id, xnat_uri=experiment + '/scans/T1_2').save(),
+                 Scan(lost_experiment.id,
+                      xnat_uri=xc.archive_prefix + '/subjects/000002/experiments/000002_MR1/scans/T1_1').save()]
+        return user, lost, held, lost_experiment, scans
+
+    def test_discrepancies_are_found_and_repaired(self, app, records):
+        """
+        Given records of a subject, an experiment and scans XNAT doesn't hold, and a subject XNAT holds with no record
+        When the database is reconciled with XNAT, with repair
+        Then each discrepancy is reported, and the records of what XNAT doesn't hold are cleared
+        """
+        user, lost, held, lost_experiment, scans = records
+        report = reconcile(workers=2, repair=True, batch_size=1)
+        assert report['subjects'] == Discrepancies(2, {lost.id: '000002'}, ['000009'], 0)
+        assert report['experiments'] == Discrepancies(2, {lost_experiment.id: '000002/000002_MR1'}, [], 0)
+        assert set(report['scans'].missing) == {scans[1].id, scans[2].id}
+        assert report['scans'].checked == 3
+        assert [u.xnat_subject_id for u in (user, lost)] == ['000001', None]
+        assert [e.xnat_experiment_id for e in (held, lost_experiment)] == ['000001_MR1', None]
+        assert [s.xnat_uri is not None for s in scans] == [True, False, False]
+
+    def test_rows_without_identifiers_are_left_out(self, app, records):
+        """Listing rows that no record could point at are neither orphans nor errors."""
+        xc = XNATConnection()
+        get = xc.xnat_get
+
+        def xnat_get(uri, query=None):
+            listing = get(uri, query=query)
+            rows = listing['ResultSet']['Result'] + [{'ID': '', 'label': ''}, {'ID': '000003_MR1', 'label': ''}]
+            return {'ResultSet': {'Result': rows}}
+        xc.xnat_get = xnat_get
+        report = reconcile(xc=xc)
+        assert report['subjects'].orphaned == ['000003_MR1', '000009']
+        assert report['experiments'] == Discrepancies(2, {records[3].id: '000002/000002_MR1'}, [], 0)
+
+    def test_command_fails_on_discrepancies_without_repairing_them(self, app, records):
+        lost = records[1].id
+        result = app.test_cli_runner().invoke(xnat_reconcile, ['--verbose'])
+        assert result.exit_code == 1
+        assert 'default subjects: 2 checked, 1 missing from XNAT, 1 not in the database, 0 unchecked' in result.output
+        assert 'missing: {} 000002'.format(lost) in result.output
+        assert User.get_by_id(lost).xnat_subject_id == '000002'
+
+
+class TestXNATIds:
+
+    def test_reservations_follow_on(self, db):
+        """Each reservation starts after the last, and a sequence starts after its floor."""
+        floors = []
+        assert reserve('s', floor=lambda: floors.append(1) or 10) == range(11, 12)
+        assert reserve('s', count=3, floor=lambda: floors.append(1) or 10) == range(12, 15)
+        assert reserve('t', count=2) == range(1, 3)
+        assert len(floors) == 1
+        with pytest.raises(ValueError):
+            reserve('s', count=0)
+
+    def test_labels_are_numbered_per_user_and_experiment(self, db, user):
+        user.update(num_experiments=2)
+        experiments = [Experiment.create(date=dt.date(2019, 1, 1), scanner='GE', num_scans=0, user_id=user.id)
+                       for _ in range(2)]
+        experiments[1].update(num_scans=4)
+        subject = str(user.id).zfill(6)
+        assert experiment_labels(user, count=2) == [subject + '_MR3', subject + '_MR4']
+        assert scan_labels(experiments[0]) == ['T1_1']
+        assert scan_labels(experiments[0], count=2) == ['T1_2', 'T1_3']
+        assert scan_labels(experiments[1]) == ['T1_5']
+
+    def test_experiments_are_labelled_once_when_added(self, db, user):
+        """A user's first experiment is MR1, and an experiment keeps the label it was added with."""
+        subject = str(user.id).zfill(6)
+        first = ExperimentService().add(user, date=dt.date(2019, 1, 1), scanner='GE', num_scans=0)
+        second = ExperimentService().add(user, date=dt.date(2019, 1, 2), scanner='GE', num_scans=0)
+        assert [first.xnat_label, second.xnat_label] == [subject + '_MR1', subject + '_MR2']
+        assert experiment_label(first) == experiment_label(first) == subject + '_MR1'
+
+    def test_experiments_added_without_a_label_are_labelled_once(self, db, user):
+        experiment = Experiment.create(date=dt.date(2019, 1, 1), scanner='GE', num_scans=0, user_id=user.id)
+        label = experiment_label(experiment)
+        assert label == str(user.id).zfill(6) + '_MR1'
+        assert experiment_label(experiment) == label
+        assert Experiment.get_by_id(experiment.id).xnat_label == label
+
+    def test_concurrent_reservations_are_disjoint(self, app, postgres):
+        """Threads reserving from one sequence at once, against Postgres, are never given the same number."""
+        threads, reservations = 8, 50
+        barrier = threading.Barrier(threads)
+
+        def numbers(thread):
+            with app.app_context():
+                try:
+                    barrier.wait()
+                    return [number for _ in range(reservations) for number in reserve('s', count=thread + 1)]
+                finally:
+                    postgres.session.commit()
+                    postgres.session.remove()
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            reserved = [number for numbers in executor.map(numbers, range(threads)) for number in numbers]
+        assert sorted(reserved) == list(range(1, len(reserved) + 1))